@@ -0,0 +1,65 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+"""
+Compare the per-task overhead of SecretScanner.scan_concurrently in a process pool when locators are pickled
+with every task (bound method) versus sent once per worker process (worker resident locators).
+
+Usage: python benchmarks/bench_scan_task_overhead.py [--rules default] [--num-files 2000] [--max-workers 4]
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from apkscan.secret_scanner import SecretScanner
+
+
+def make_tiny_files(directory: Path, num_files: int) -> list[Path]:
+    file_paths = []
+    for i in range(num_files):
+        file_path = directory / f"Class{i}.java"
+        file_path.write_text(f"package com.example;\n\npublic class Class{i} {{\n    int value = {i};\n}}\n")
+        file_paths.append(file_path)
+    return file_paths
+
+
+def time_scan(file_paths: list[Path], rules: list[Path], **scanner_kwargs) -> float:
+    scanner = SecretScanner(concurrency_type="process", **scanner_kwargs)
+    scanner.load_secret_locators(rules)
+    start = perf_counter()
+    for _ in scanner.scan_concurrently(file_paths):
+        pass
+    return perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark per-task overhead of scanning in a process pool.")
+    parser.add_argument("--rules", type=Path, nargs="+", default=[Path("default")])
+    parser.add_argument("--num-files", type=int, default=2000)
+    parser.add_argument("--max-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmpdir:
+        file_paths = make_tiny_files(Path(tmpdir), args.num_files)
+        timings = {}
+        for worker_resident_locators in (False, True):
+            # One file per task so the elapsed time is dominated by per-task overhead
+            timings[worker_resident_locators] = time_scan(
+                file_paths,
+                args.rules,
+                worker_resident_locators=worker_resident_locators,
+                batch_size_bytes=0,
+                max_workers=args.max_workers,
+            )
+
+    print(f"\n{'locators sent':<24}{'elapsed (s)':>14}{'per task (ms)':>16}")
+    for worker_resident_locators, elapsed in timings.items():
+        label = "once per worker" if worker_resident_locators else "with every task"
+        print(f"{label:<24}{elapsed:>14.3f}{elapsed / args.num_files * 1000:>16.3f}")
+    print(f"\nSpeedup: {timings[False] / timings[True]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
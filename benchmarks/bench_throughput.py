@@ -0,0 +1,346 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+"""
+Measure scanning throughput (files/s, MB/s), startup time, and peak RSS of SecretScanner on a synthetic decompiled
+tree across concurrency types, worker counts, scan modes, and matcher backends, the cost of each locator, and an end
+to end decompile and scan with a fake decompiler. Results are written as JSON and compared against a baseline from an
+earlier run, exiting with status 1 when any measurement regressed by more than the tolerance.
+
+Each configuration runs in a fresh interpreter so startup time and peak RSS are not shared between configurations.
+
+Usage: python benchmarks/bench_throughput.py [--num-files 2000] [--max-workers 1 4] [--output bench_results.json]
+                                             [--baseline bench_results.json] [--tolerance 0.2]
+"""
+
+import sys
+from argparse import ArgumentParser
+from itertools import product
+from json import dump as json_dump, dumps as json_dumps, load as json_load, loads as json_loads
+from os import cpu_count
+from pathlib import Path
+from platform import platform, python_implementation, python_version
+from subprocess import DEVNULL, run
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from synthetic_corpus import iter_corpus_files, load_manifest, make_corpus, write_fake_decompiler
+
+try:
+    from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+except ImportError:
+    # Not available on Windows. Peak RSS is reported as None.
+    getrusage = None  # type: ignore
+
+RESULTS_VERSION = 1
+# Measurements compared against the baseline, whether higher values are better, and the smallest absolute change
+# counted as a regression so noise in short startups and small processes is not reported
+COMPARED_FIELDS = {
+    "files_per_second": (True, 0.0),
+    "mb_per_second": (True, 0.0),
+    "startup_seconds": (False, 0.1),
+    "peak_rss_mb": (False, 8.0),
+}
+
+
+def peak_rss_mb() -> dict[str, float | None]:
+    """Peak RSS of this process and of the largest of its finished child processes (process pool workers)."""
+    if getrusage is None:
+        return {"self": None, "children": None}
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    scale = 1 << 20 if sys.platform == "darwin" else 1 << 10
+    return {
+        "self": round(getrusage(RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(getrusage(RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+
+def count_planted_found(corpus_dir: Path, file_results: list, planted: list[dict]) -> int:
+    found = {
+        (file_path.relative_to(corpus_dir).as_posix(), result.line_number, result.secret)
+        for file_path, results in file_results
+        for result in results
+    }
+    return sum(
+        any(
+            path == planted_secret["path"]
+            and line_number == planted_secret["line_number"]
+            and planted_secret["secret"].encode() in secret
+            for path, line_number, secret in found
+        )
+        for planted_secret in planted
+    )
+
+
+def run_scan(config: dict) -> dict:
+    corpus_dir = Path(config["corpus_dir"])
+    manifest = load_manifest(corpus_dir)
+    file_paths = list(iter_corpus_files(corpus_dir))
+
+    # apkscan is imported here so importing it counts towards startup time
+    start = perf_counter()
+    from apkscan.secret_scanner import SecretScanner
+
+    scanner = SecretScanner(
+        concurrency_type=config["concurrency_type"],
+        max_workers=config["max_workers"],
+        scan_mode=config["scan_mode"],
+        matcher_backend=config["matcher_backend"],
+        locator_cache_dir=config["locator_cache_dir"],
+        profile_locators=config.get("profile_locators", False),
+    )
+    scanner.load_secret_locators(list(map(Path, config["rules"])))
+    startup_seconds = perf_counter() - start
+
+    elapsed = float("inf")
+    for _ in range(config["repeat"]):
+        start = perf_counter()
+        file_results = list(scanner.scan_concurrently(file_paths))
+        elapsed = min(elapsed, perf_counter() - start)
+
+    result = {
+        "startup_seconds": round(startup_seconds, 4),
+        "scan_seconds": round(elapsed, 4),
+        "files_per_second": round(len(file_paths) / elapsed, 1),
+        "mb_per_second": round(manifest["num_bytes"] / (1 << 20) / elapsed, 2),
+        "num_results": sum(len(results) for _, results in file_results),
+        "planted_found": count_planted_found(corpus_dir, file_results, manifest["planted"]),
+        "num_locators": len(scanner.secret_locators),
+    }
+    if scanner.locator_profiler is not None:
+        locators = list(scanner.secret_locators.values())
+        result["locators"] = list(scanner.locator_profiler.iter_report(locators))[: config["top_locators"]]
+    return result
+
+
+def run_end_to_end(config: dict) -> dict:
+    work_dir = Path(config["work_dir"])
+    fake_jadx = write_fake_decompiler(work_dir / "jadx", Path(config["corpus_dir"]))
+    input_files = [work_dir / f"app{i}.apk" for i in range(config["num_apks"])]
+    for input_file in input_files:
+        input_file.write_bytes(b"PK")
+
+    start = perf_counter()
+    from apkscan.apkscan import APKScanner
+
+    apk_scanner = APKScanner(
+        {"binaries": {"jadx": fake_jadx}, "working_dir": work_dir / "decompiled"},
+        {
+            "secret_locator_files": list(map(Path, config["rules"])),
+            "concurrency_type": config["concurrency_type"],
+            "max_workers": config["max_workers"],
+            "locator_cache_dir": config["locator_cache_dir"],
+            # Every APK decompiles to the same tree, which would otherwise only be scanned once
+            "dedupe_files": False,
+        },
+        output_file=work_dir / "secrets_output.json",
+    )
+    startup_seconds = perf_counter() - start
+    start = perf_counter()
+    apk_scanner.decompile_and_scan(input_files)
+    elapsed = perf_counter() - start
+    apk_scanner.do_cleanup()
+    return {
+        "startup_seconds": round(startup_seconds, 4),
+        "elapsed_seconds": round(elapsed, 4),
+        "num_apks": len(input_files),
+        "num_decompiled": apk_scanner.num_decompiled,
+        "num_scanned": apk_scanner.num_scanned,
+        "num_secrets": apk_scanner.num_secrets,
+        "files_per_second": round(apk_scanner.num_scanned / elapsed, 1),
+    }
+
+
+def run_config(config: dict) -> dict:
+    """Run config in a new interpreter and return its measurements."""
+    result_path = Path(config["work_dir"]) / "result.json"
+    # Scanner progress output is discarded. Errors still go to stderr.
+    run(
+        [sys.executable, __file__, "--run-config", json_dumps({**config, "result_path": str(result_path)})],
+        stdout=DEVNULL,
+        check=True,
+    )
+    with result_path.open() as f:
+        return json_load(f)
+
+
+def child_main(config: dict) -> None:
+    result = run_end_to_end(config) if config.get("end_to_end") else run_scan(config)
+    result["peak_rss_mb"] = peak_rss_mb()
+    with Path(config["result_path"]).open("w") as f:
+        json_dump(result, f)
+
+
+def config_key(run_result: dict) -> str:
+    return "/".join(
+        str(run_result[field]) for field in ("concurrency_type", "max_workers", "scan_mode", "matcher_backend")
+    )
+
+
+def get_compared_value(run_result: dict, field: str) -> float | None:
+    if field == "peak_rss_mb":
+        peak_rss = run_result["peak_rss_mb"]
+        return max((value for value in peak_rss.values() if value is not None), default=None)
+    return run_result.get(field)
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Descriptions of measurements in results worse than the same configuration in baseline by more than tolerance."""
+    regressions = []
+    baseline_runs = {config_key(run_result): run_result for run_result in baseline["runs"]}
+    print(f"\n{'configuration':<32}{'measurement':<20}{'baseline':>12}{'current':>12}{'change':>10}")
+    for run_result in results["runs"]:
+        if (baseline_run := baseline_runs.get(key := config_key(run_result))) is None:
+            continue
+        for field, (higher_is_better, min_change) in COMPARED_FIELDS.items():
+            current, previous = get_compared_value(run_result, field), get_compared_value(baseline_run, field)
+            if not current or not previous:
+                continue
+            change = current / previous - 1
+            worse_by = previous - current if higher_is_better else current - previous
+            regressed = worse_by > previous * tolerance and worse_by > min_change
+            print(f"{key:<32}{field:<20}{previous:>12.2f}{current:>12.2f}{change:>+10.1%}{' !' if regressed else ''}")
+            if regressed:
+                regressions.append(f"{key} {field}: {previous:.2f} -> {current:.2f} ({change:+.1%})")
+    return regressions
+
+
+def print_results(results: dict) -> None:
+    corpus = results["corpus"]
+    print(
+        f"\nCorpus: {corpus['num_files']} files, {corpus['num_bytes'] / (1 << 20):.1f} MB, "
+        f"{len(corpus['planted'])} planted secrets. Cold startup: {results['cold_startup_seconds']:.3f}s"
+    )
+    print(
+        f"\n{'configuration':<32}{'startup (s)':>12}{'files/s':>10}{'MB/s':>8}{'results':>9}"
+        f"{'planted':>9}{'RSS (MB)':>10}{'workers RSS':>13}"
+    )
+    for run_result in results["runs"]:
+        peak_rss = run_result["peak_rss_mb"]
+        print(
+            f"{config_key(run_result):<32}{run_result['startup_seconds']:>12.3f}{run_result['files_per_second']:>10.1f}"
+            f"{run_result['mb_per_second']:>8.2f}{run_result['num_results']:>9}"
+            f"{run_result['planted_found']:>5}/{len(corpus['planted']):<3}"
+            f"{peak_rss['self'] or 0:>10.1f}{peak_rss['children'] or 0:>13.1f}"
+        )
+
+    if results["locators"]:
+        print(f"\n{'locator':<48}{'calls':>10}{'matches':>9}{'total (s)':>11}{'gate (s)':>10}{'max (ms)':>10}")
+        for row in results["locators"]:
+            print(
+                f"{str(row['locator_id'])[:47]:<48}{row['calls']:>10}{row['matches']:>9}{row['total_seconds']:>11.4f}"
+                f"{row['gate_seconds']:>10.4f}{row['max_milliseconds']:>10.3f}"
+            )
+
+    if end_to_end := results["end_to_end"]:
+        print(
+            f"\nEnd to end: {end_to_end['num_apks']} APKs decompiled with a fake jadx and {end_to_end['num_scanned']} "
+            f"files scanned in {end_to_end['elapsed_seconds']:.3f}s ({end_to_end['files_per_second']:.1f} files/s)"
+        )
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark SecretScanner throughput on a synthetic decompiled tree.")
+    parser.add_argument("--rules", type=Path, nargs="+", default=[Path("default")])
+    parser.add_argument("--num-files", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency-types", nargs="+", default=["main", "thread", "process"])
+    parser.add_argument("--max-workers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--scan-modes", nargs="+", default=["line"])
+    parser.add_argument("--matcher-backends", nargs="+", default=["re"])
+    parser.add_argument("--repeat", type=int, default=3, help="Scans per configuration. The fastest is kept.")
+    parser.add_argument("--top-locators", type=int, default=20, help="Slowest locators to profile. 0 to skip.")
+    parser.add_argument("--num-apks", type=int, default=4, help="Fake APKs to decompile and scan. 0 to skip.")
+    parser.add_argument("--output", type=Path, default=None, help="Write results as JSON to this file.")
+    parser.add_argument("--baseline", type=Path, default=None, help="Compare results to a JSON file from --output.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change allowed before regressing.")
+    parser.add_argument("--run-config", default=None, help="(Internal) Run one configuration from JSON.")
+    args = parser.parse_args()
+
+    if args.run_config:
+        return child_main(json_loads(args.run_config))
+
+    with TemporaryDirectory() as tmpdir:
+        tmpdir_path = Path(tmpdir)
+        corpus_dir = tmpdir_path / "corpus"
+        manifest = make_corpus(corpus_dir, args.num_files, args.seed)
+        base_config = {
+            "corpus_dir": str(corpus_dir),
+            "work_dir": tmpdir,
+            "rules": list(map(str, args.rules)),
+            "locator_cache_dir": str(tmpdir_path / "locator_cache"),
+            "repeat": args.repeat,
+            "top_locators": args.top_locators,
+        }
+        main_config = {"concurrency_type": "main", "max_workers": 1, "scan_mode": "line", "matcher_backend": "re"}
+
+        # The first run builds and caches the locators. Every later run starts from the cache like repeat scans do.
+        cold_run = run_config({**base_config, **main_config, "repeat": 1})
+        runs = []
+        for concurrency_type, max_workers, scan_mode, matcher_backend in product(
+            args.concurrency_types, args.max_workers, args.scan_modes, args.matcher_backends
+        ):
+            if concurrency_type == "main" and max_workers != min(args.max_workers):
+                continue
+            config = {
+                "concurrency_type": concurrency_type,
+                "max_workers": 1 if concurrency_type == "main" else max_workers,
+                "scan_mode": scan_mode,
+                "matcher_backend": matcher_backend,
+            }
+            print(f"Running {config_key(config)}")
+            runs.append({**config, **run_config({**base_config, **config})})
+
+        locators = []
+        if args.top_locators:
+            print("Profiling locators")
+            profile_run = run_config({**base_config, **main_config, "repeat": 1, "profile_locators": True})
+            locators = profile_run["locators"]
+
+        end_to_end = None
+        if args.num_apks:
+            print(f"Decompiling and scanning {args.num_apks} fake APKs")
+            end_to_end = run_config(
+                {
+                    **base_config,
+                    "end_to_end": True,
+                    "num_apks": args.num_apks,
+                    "concurrency_type": "process",
+                    "max_workers": max(args.max_workers),
+                }
+            )
+
+    results = {
+        "version": RESULTS_VERSION,
+        "machine": {
+            "python": f"{python_implementation()} {python_version()}",
+            "platform": platform(),
+            "cpu_count": cpu_count(),
+        },
+        "corpus": {key: manifest[key] for key in ("num_files", "num_bytes", "seed", "planted")},
+        "cold_startup_seconds": cold_run["startup_seconds"],
+        "runs": runs,
+        "locators": locators,
+        "end_to_end": end_to_end,
+    }
+    print_results(results)
+
+    if args.output:
+        with args.output.open("w") as f:
+            json_dump(results, f, indent=4)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with args.baseline.open() as f:
+            baseline = json_load(f)
+        if baseline["corpus"]["num_files"] != manifest["num_files"] or baseline["corpus"]["seed"] != args.seed:
+            print("\nBaseline was measured on a different corpus. Use the same --num-files and --seed to compare.")
+        elif regressions := compare_to_baseline(results, baseline, args.tolerance):
+            print(f"\n{len(regressions)} regressions over {args.tolerance:.0%}:\n" + "\n".join(regressions))
+            sys.exit(1)
+        else:
+            print(f"\nNo regressions over {args.tolerance:.0%}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,21 @@ try:
             [
                 "src/apkscan/apkscan.py",
                 "src/apkscan/concurrent_executor.py",
+                "src/apkscan/decompile_cache.py",
                 "src/apkscan/decompiler.py",
+                "src/apkscan/decompiler_daemon.py",
+                "src/apkscan/file_index.py",
+                "src/apkscan/locator_cache.py",
+                "src/apkscan/locator_lint.py",
+                "src/apkscan/locator_matcher.py",
+                "src/apkscan/locator_profiler.py",
+                "src/apkscan/matcher_backend.py",
+                "src/apkscan/output_writers.py",
+                "src/apkscan/prescan.py",
+                "src/apkscan/resource_scheduler.py",
+                "src/apkscan/result_cache.py",
+                "src/apkscan/result_store.py",
+                "src/apkscan/scan_filter.py",
                 "src/apkscan/secret_scanner.py",
             ]
         )
@@ -37,6 +51,7 @@ setup(
     package_data={
         "": ["LICENSE"],
         "apkscan.secret_locators": ["*.json", "*.yaml", "*.yml", "*.toml"],
+        "apkscan.daemons": ["*.java"],
     },
     include_package_data=True,
     exclude_package_data={"": [".gitignore", ".pre-commit-config.yaml"]},
@@ -47,7 +62,9 @@ setup(
         "mypyc": [
             "mypy[mypyc]",
             "mypy_extensions",
-        ]
+        ],
+        "re2": ["google-re2"],
+        "hyperscan": ["hyperscan"],
     },
     entry_points={
         "console_scripts": [
@@ -2,13 +2,16 @@
 # Licensed under the MIT License (see LICENSE for details).
 # For commercial use, see LICENSE for additional terms.
 from pathlib import Path
-from typing import Optional, Generator, Iterable, Literal
+from typing import Optional, Generator, Iterable, Iterator, Literal
 from datetime import datetime, timedelta
 from yaml import dump as yaml_dump  # type: ignore
 from json import dump as json_dump
 
 from .decompiler import Decompiler
+from .file_index import FileIndex
 from .secret_scanner import SecretScanner, SecretResult
+from .result_store import SecretResultStore
+from .output_writers import ResultWriter, JSONLinesWriter, RESULT_WRITERS, iter_jsonl_records, group_records
 
 
 class APKScanner:
@@ -20,6 +23,9 @@ class APKScanner:
         output_format: str = "json",
         groupby: Literal["file", "locator", "both"] = "both",
         cleanup: bool = True,
+        prescan: Literal["never", "before", "only"] = "never",
+        dedupe_results: bool = True,
+        keep_results: bool = True,
     ):
         # workers
         self.decompiler = Decompiler(**decompiler_kwargs)
@@ -31,6 +37,12 @@ class APKScanner:
         self.output_format = output_format
         self.groupby = groupby
         self.cleanup = cleanup
+        self.prescan = prescan
+        self.dedupe_results = dedupe_results
+        self.keep_results = keep_results
+        # jsonl, sarif, and csv output is written as results are found. Other formats are grouped at the end from
+        # results written to a partial JSON lines file next to the output file.
+        self.result_writer: Optional[ResultWriter] = None
         self.output_written = False
         self.cleaned_up = False
         # state tracking
@@ -41,6 +53,7 @@ class APKScanner:
         self.scanning: set[Path] = set()
         self.scan_start_time: Optional[datetime] = None
         self.scan_elapsed_time: Optional[timedelta] = None
+        self.prescan_elapsed_time: Optional[timedelta] = None
         self.last_scanned: Optional[Path] = None
         self.last_secret: Optional[bytes] = None
         # counters
@@ -50,12 +63,22 @@ class APKScanner:
         self.num_decompile_errors = 0
         self.num_scanning = 0
         self.num_scanned = 0
+        self.num_prescanned = 0
         self.num_secrets = 0
         self.num_unique_secrets = 0
+        self.num_duplicate_results = 0
         # results
-        self.decompile_results: dict[Path, tuple[Path, Optional[set[Path]], bool]] = {}
-        self.secrets_results: list[SecretResult] = []
+        # Input file, number of decompiled files, and success of each output dir
+        self.decompile_results: dict[Path, tuple[Path, Optional[int], bool]] = {}
+        self.num_streamed_files: dict[Path, int] = {}
+        # (input file, output dir) of each SecretResult.origin id and the id of each output dir
+        self.origins: list[tuple[Path, Path]] = []
+        self.origin_ids: dict[Path, int] = {}
+        self.secrets_results = SecretResultStore()
         self.unique_secrets: set[bytes] = set()
+        # Result id of each (secret, locator id, input file, logical path) and the other locations found when keep_results
+        self.result_indices: dict[tuple[bytes, str, Path, str], int] = {}
+        self.result_locations: dict[int, list[tuple[Path, int]]] = {}
 
         print(f"\nInitialized Decompiler:\n- {self.decompiler}")
         print(f"\nInitialized Secret Scanner:\n- {self.secret_scanner}")
@@ -110,24 +133,55 @@ class APKScanner:
             self.print_status()
             yield file_path.resolve()
 
-    def decompiled_files_generator(self, file_paths: Iterable[Path]) -> Generator[Path, None, None]:
-        for file_path, output_dir, decompiled_files, success in self.decompiler.decompile_concurrently(file_paths):
-            self.decompile_results[output_dir] = (file_path, decompiled_files, success)
-            self.decompiling[file_path.stem] -= 1
+    def files_to_scan_generator(self, decompiled_files: Iterable[Path]) -> Generator[Path, None, None]:
+        if not self.scan_start_time:
+            self.scan_start_time = datetime.now()
+            print(f"\nScanning started at {self.scan_start_time.strftime('%H:%M:%S:%SS')}\n")
 
-            if success and decompiled_files:
-                self.num_decompile_success += 1
+        for decompiled_file in decompiled_files:
+            self.num_scanning += 1
+            self.scanning.add(decompiled_file)
+            self.print_status()
+            yield decompiled_file
+
+    def add_origin(self, file_path: Path, output_dir: Path) -> int:
+        if (origin_id := self.origin_ids.get(output_dir)) is None:
+            origin_id = self.origin_ids[output_dir] = len(self.origins)
+            self.origins.append((file_path, output_dir))
+        return origin_id
 
-                if not self.scan_start_time:
-                    self.scan_start_time = datetime.now()
-                    print(f"\nScanning started at {self.scan_start_time.strftime('%H:%M:%S:%SS')}\n")
+    def find_origin(self, file_path: Path) -> int:
+        """Origin id of the output dir file_path is in found by walking up its parents, or -1 if not in any."""
+        for output_dir in file_path.parents:
+            if (origin_id := self.origin_ids.get(output_dir)) is not None:
+                return origin_id
+        return -1
 
-                for decompiled_file in decompiled_files:
-                    self.num_scanning += 1
-                    self.scanning.add(decompiled_file)
-                    self.print_status()
-                    yield decompiled_file
+    def decompiled_files_generator(self, file_paths: Iterable[Path]) -> Generator[Path, None, None]:
+        decompile_results: Iterator[tuple[Path, Path, Optional[FileIndex], Optional[bool]]]
+        if self.decompiler.stream_output:
+            decompile_results = self.decompiler.decompile_streaming_concurrently(file_paths)
+        else:
+            decompile_results = self.decompiler.decompile_concurrently(file_paths)
+
+        for file_path, output_dir, decompiled_files, success in decompile_results:
+            self.add_origin(file_path, output_dir)
+            if success is None:
+                # Files done being written while the decompiler is still running
+                self.num_streamed_files[output_dir] = self.num_streamed_files.get(output_dir, 0) + len(
+                    decompiled_files or ()
+                )
+                yield from self.files_to_scan_generator(decompiled_files or ())
+                continue
+
+            num_streamed_files = self.num_streamed_files.pop(output_dir, 0)
+            num_decompiled_files = len(decompiled_files) + num_streamed_files if decompiled_files is not None else None
+            self.decompile_results[output_dir] = (file_path, num_decompiled_files, success)
+            self.decompiling[file_path.stem] -= 1
 
+            if success and num_decompiled_files:
+                self.num_decompile_success += 1
+                yield from self.files_to_scan_generator(decompiled_files or ())
             else:
                 self.num_decompile_errors += 1
 
@@ -136,6 +190,7 @@ class APKScanner:
                 self.print_status("\n")
 
         self.decompiler.concurrent_executor.shutdown()
+        self.decompiler.close_daemons()
         if self.decompile_start_time:
             self.decompile_elapsed_time = datetime.now() - self.decompile_start_time
             print(
@@ -160,74 +215,214 @@ class APKScanner:
             print(
                 f"\nScanning COMPLETE. Scanned {self.num_scanned} files with {self.num_secrets} secrets found. Elapsed time: {self.scan_elapsed_time}\n"
             )
+        if result_cache := self.secret_scanner.result_cache:
+            print(f"Loaded results for {result_cache.num_hits} unchanged files from {result_cache.db_path}\n")
+        if self.secret_scanner.num_duplicates:
+            print(
+                f"Copied results to {self.secret_scanner.num_duplicates} files with the same content as a scanned file\n"
+            )
+        if (scan_filter := self.secret_scanner.scan_filter) and (
+            sampled_file_paths := self.secret_scanner.sampled_file_paths
+        ):
+            print(
+                f"Scanned only the first {scan_filter.max_file_size} bytes of {len(sampled_file_paths)} oversized files:\n- "
+                + "\n- ".join(map(str, sampled_file_paths))
+                + "\n"
+            )
+
+    def prescan_secret_results_generator(self, file_paths: Iterable[Path]) -> Generator[SecretResult, None, None]:
+        prescan_start_time = datetime.now()
+        print(f"\nPrescanning started at {prescan_start_time.strftime('%H:%M:%S:%SS')}\n")
+        input_files = {file_path.resolve(): file_path for file_path in file_paths}
+        for buffer_path, buffer_secret_results in self.secret_scanner.prescan_concurrently(input_files):
+            # Buffer paths are the input path or an entry path under it
+            for input_path in (buffer_path, *buffer_path.parents):
+                if input_path in input_files:
+                    # Grouped by input file like decompiled files but with the input path as the output dir
+                    origin_id = self.add_origin(input_files[input_path], input_path)
+                    _, num_entries, _ = self.decompile_results.get(input_path, (input_path, 0, True))
+                    self.decompile_results[input_path] = (input_files[input_path], (num_entries or 0) + 1, True)
+                    for secret_result in buffer_secret_results:
+                        secret_result.origin = origin_id
+                    break
 
-    def decompile_and_scan(self, file_paths: Iterable[Path]) -> list[SecretResult]:
+            self.num_prescanned += 1
+            self.last_scanned = buffer_path
+            self.print_status()
+            yield from buffer_secret_results
+
+        self.prescan_elapsed_time = datetime.now() - prescan_start_time
+        print(
+            f"\nPrescanning COMPLETE. Prescanned {self.num_prescanned} entries of {len(input_files)} files with {self.num_secrets} secrets found. Elapsed time: {self.prescan_elapsed_time}\n"
+        )
+
+    def get_result_key(self, secret_result: SecretResult) -> Optional[tuple[bytes, str, Path, str]]:
+        """Key that is the same for a secret found by a locator in the same class or resource of an input file."""
+        if secret_result.origin < 0:
+            return None
+        input_file, output_dir = self.origins[secret_result.origin]
+        logical_path = self.decompiler.get_logical_path(secret_result.file_path, output_dir)
+        return secret_result.secret, secret_result.locator.id, input_file, logical_path
+
+    def add_secret_result(self, secret_result: SecretResult) -> None:
+        if secret_result.origin < 0:
+            secret_result.origin = self.find_origin(secret_result.file_path)
+        if self.dedupe_results and (result_key := self.get_result_key(secret_result)) is not None:
+            if (result_id := self.result_indices.get(result_key)) is not None:
+                # Same hit from another decompiler or line so only its location is kept
+                self.open_result_writer().write(
+                    self.make_duplicate_record(
+                        result_id, secret_result.locator.id, secret_result.file_path, secret_result.line_number
+                    )
+                )
+                if self.keep_results:
+                    location = (secret_result.file_path, secret_result.line_number)
+                    self.result_locations.setdefault(result_id, []).append(location)
+                self.num_duplicate_results += 1
+                return
+            self.result_indices[result_key] = self.num_secrets
+        self.open_result_writer().write(self.make_result_record(secret_result, self.num_secrets))
+        self.num_secrets += 1
+        if self.keep_results:
+            self.secrets_results.append(secret_result)
+        if secret_result.secret not in self.unique_secrets:
+            self.num_unique_secrets += 1
+            self.print_secret_found(secret_result)
+            self.unique_secrets.add(secret_result.secret)
+        self.print_status()
+
+    def decompile_and_scan(self, file_paths: Iterable[Path]) -> SecretResultStore:
         self.decompile_and_scan_start_time = datetime.now()
         num_secrets_before = self.num_secrets
         num_unique_secrets_before = self.num_unique_secrets
 
-        files_to_decompile = self.files_to_decompile_generator(file_paths)
-        decompiled_files = self.decompiled_files_generator(files_to_decompile)
-        for secret_result in self.scan_secret_results_generator(decompiled_files):
-            self.num_secrets += 1
-            self.secrets_results.append(secret_result)
-            if secret_result.secret not in self.unique_secrets:
-                self.num_unique_secrets += 1
-                self.print_secret_found(secret_result)
-                self.unique_secrets.add(secret_result.secret)
-            self.print_status()
+        if self.prescan != "never":
+            # Report secrets found without decompiling first
+            file_paths = list(file_paths)
+            for secret_result in self.prescan_secret_results_generator(file_paths):
+                self.add_secret_result(secret_result)
+
+        if self.prescan != "only":
+            files_to_decompile = self.files_to_decompile_generator(file_paths)
+            decompiled_files = self.decompiled_files_generator(files_to_decompile)
+            for secret_result in self.scan_secret_results_generator(decompiled_files):
+                self.add_secret_result(secret_result)
 
         self.total_elapsed_time = datetime.now() - self.decompile_and_scan_start_time
         print(
             f"Found \033[92m{self.num_secrets - num_secrets_before} new secrets\033[0m ({self.num_unique_secrets - num_unique_secrets_before} unique)."
         )
+        if self.prescan != "never":
+            print(f"Prescanned {self.num_prescanned} APK/DEX entries in {self.prescan_elapsed_time}.")
         print(
             f"Decompiled {self.num_decompiled} files with {self.num_decompile_errors} errors in {self.decompile_elapsed_time}."
         )
         print(f"Scanned {self.num_scanned} files and found {self.num_secrets} secrets in {self.scan_elapsed_time}.")
+        if self.num_duplicate_results:
+            print(
+                f"Merged {self.num_duplicate_results} duplicate hits in the same class or resource into other_locations."
+            )
+        for output_dir, reason in self.decompiler.timed_out.items():
+            print(f"\033[93mDecompiler timed out\033[0m writing {output_dir}: {reason}")
+        self.secret_scanner.report_locator_profile()
         print(f"Total Elapsed time: {datetime.now() - self.decompile_and_scan_start_time}")
 
         return self.secrets_results
 
-    def make_secret_result_serializable(self, secret_result: SecretResult) -> dict[str, str | int]:
+    def make_secret_result_serializable(
+        self, secret_result: SecretResult, other_locations: Iterable[tuple[Path, int]] = ()
+    ) -> dict[str, str | int | list[str]]:
         try:
             secret_str = secret_result.secret.decode()
         except Exception as e:
             print(f"Error decoding secret: {e}")
             secret_str = f"{secret_result.secret!r}"
-        return {
+        serializable_secret_result: dict[str, str | int | list[str]] = {
             "secret": secret_str,
             "file_path": str(secret_result.file_path),
             "line_number": secret_result.line_number,
             "locator": secret_result.locator.name,
         }
+        if other_locations:
+            serializable_secret_result["other_locations"] = [
+                f"{file_path}:{line_number}" for file_path, line_number in other_locations
+            ]
+        return serializable_secret_result
+
+    def make_result_record(self, secret_result: SecretResult, result_id: int) -> dict:
+        """Record of a result for output writers. See output_writers.RESULT_FIELDS."""
+        input_file = str(self.origins[secret_result.origin][0]) if secret_result.origin >= 0 else None
+        return {
+            "id": result_id,
+            **self.make_secret_result_serializable(secret_result),
+            "locator_id": secret_result.locator.id,
+            "input_file": input_file,
+        }
 
-    def group_results_by_locator(self) -> dict[str, list[dict[str, str | int]]]:
-        results_by_locator: dict[str, list[dict[str, str | int]]] = {}
-        for secret_result in self.secrets_results:
-            serializable_secret_result = self.make_secret_result_serializable(secret_result)
-            results_by_locator.setdefault(secret_result.locator.id, []).append(serializable_secret_result)
-        return results_by_locator
-
-    def group_results_by_input_file(self) -> dict[str, list[dict[str, str | int]]]:
-        results_by_input_file: dict[str, list[dict[str, str | int]]] = {}
-        for secret_result in self.secrets_results:
-            for output_dir, (file_path, decompiled_files, success) in self.decompile_results.items():
-                # TODO maybe group by output_dir (decompilier) ?
-                if decompiled_files is not None and secret_result.file_path in decompiled_files:
-                    serializable_secret_result = self.make_secret_result_serializable(secret_result)
-                    results_by_input_file.setdefault(str(file_path), []).append(serializable_secret_result)
-                    break
-        return results_by_input_file
+    def make_duplicate_record(self, result_id: int, locator_id: str, file_path: Path, line_number: int) -> dict:
+        return {
+            "duplicate_of": result_id,
+            "file_path": str(file_path),
+            "line_number": line_number,
+            "locator_id": locator_id,
+        }
+
+    def iter_result_records(self) -> Iterator[dict]:
+        """Records of the results kept in memory in the order they were written."""
+        for result_id, secret_result in enumerate(self.secrets_results):
+            yield self.make_result_record(secret_result, result_id)
+            for file_path, line_number in self.result_locations.get(result_id, ()):
+                yield self.make_duplicate_record(result_id, secret_result.locator.id, file_path, line_number)
+
+    def group_results_by_locator(self) -> dict[str, list[dict[str, str | int | list[str]]]]:
+        return group_records(self.iter_result_records())[1]
+
+    def group_results_by_input_file(self) -> dict[str, list[dict[str, str | int | list[str]]]]:
+        return group_records(self.iter_result_records())[0]
+
+    def group_timeouts_by_input_file(self) -> dict[str, list[dict[str, str | int]]]:
+        timeouts_by_input_file: dict[str, list[dict[str, str | int]]] = {}
+        for output_dir, reason in self.decompiler.timed_out.items():
+            file_path, num_decompiled_files, _ = self.decompile_results.get(output_dir, (output_dir, None, False))
+            timeouts_by_input_file.setdefault(str(file_path), []).append(
+                {
+                    "decompiler": output_dir.name,
+                    "reason": reason,
+                    "partial_output_files": num_decompiled_files or 0,
+                }
+            )
+        return timeouts_by_input_file
+
+    def open_result_writer(self) -> ResultWriter:
+        if self.result_writer is None:
+            if (writer_class := RESULT_WRITERS.get(self.output_format)) is not None:
+                self.result_writer = writer_class(self.output_file)
+            else:
+                self.result_writer = JSONLinesWriter(
+                    self.output_file.with_name(f"{self.output_file.name}.partial.jsonl")
+                )
+        return self.result_writer
 
     def write_output(self):
         print(f"\nWriting output to {self.output_file}", end="\r")
+        result_writer = self.open_result_writer()
+        result_writer.close()
+        self.result_writer = None
+        if self.output_format in RESULT_WRITERS:
+            self.output_written = True
+            print(f"Output written to {self.output_file}")
+            return
+
+        # Group the results written so far without loading them all as SecretResults
+        results_by_input_file, results_by_locator = group_records(iter_jsonl_records(result_writer.output_file))
         if self.groupby == "file":
-            results = self.group_results_by_input_file()
+            results = results_by_input_file
         elif self.groupby == "locator":
-            results = self.group_results_by_locator()
+            results = results_by_locator
         elif self.groupby == "both":
-            results = {"by_file": self.group_results_by_input_file(), "by_locator": self.group_results_by_locator()}
+            results = {"by_file": results_by_input_file, "by_locator": results_by_locator}
+            if self.decompiler.timed_out:
+                results["decompile_timeouts"] = self.group_timeouts_by_input_file()
 
         with self.output_file.open("w") as f:
             if self.output_format == "json":
@@ -236,6 +431,7 @@ class APKScanner:
                 yaml_dump(results, f, default_flow_style=False)
             else:
                 f.write(str(results))
+        result_writer.output_file.unlink()
 
         self.output_written = True
         print(f"Output written to {self.output_file}")
@@ -248,7 +444,7 @@ class APKScanner:
         self.cleaned_up = True
 
     def __del__(self):
-        if getattr(self, "secrets_results", False) and not getattr(self, "output_written", False):
+        if getattr(self, "num_secrets", False) and not getattr(self, "output_written", False):
             self.write_output()
 
         if getattr(self, "cleanup", False) and not getattr(self, "cleaned_up", False):
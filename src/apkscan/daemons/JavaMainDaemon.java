@@ -0,0 +1,90 @@
+// © 2024 Lucas Faudman.
+// Licensed under the MIT License (see LICENSE for details).
+// For commercial use, see LICENSE for additional terms.
+//
+// Warm JVM daemon for decompilers whose main method returns instead of calling System.exit, like CFR.
+// Runs the main method of the class named by its first arg for each job it reads from stdin using the protocol
+// in decompiler_daemon.py. Run with the Java 11+ source launcher so nothing needs to be compiled first:
+//   java -cp /path/to/cfr.jar JavaMainDaemon.java org.benf.cfr.reader.Main
+
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.List;
+
+public class JavaMainDaemon {
+    static final String RESPONSE_PREFIX = "APKSCAN_DAEMON_RESPONSE ";
+
+    public static void main(String[] daemonArgs) throws Exception {
+        PrintStream responses = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        // Decompiler output goes to stderr so stdout only has responses
+        System.setOut(System.err);
+        Method main = Class.forName(daemonArgs[0]).getMethod("main", String[].class);
+        BufferedReader jobs = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        String line;
+        while ((line = jobs.readLine()) != null) {
+            String error = null;
+            try {
+                main.invoke(null, (Object) parseArgs(line));
+            } catch (InvocationTargetException e) {
+                error = String.valueOf(e.getCause());
+            } catch (Exception e) {
+                error = String.valueOf(e);
+            }
+            System.err.flush();
+            if (error == null) {
+                responses.println(RESPONSE_PREFIX + "{\"success\": true}");
+            } else {
+                responses.println(RESPONSE_PREFIX + "{\"success\": false, \"error\": " + quote(error) + "}");
+            }
+        }
+    }
+
+    // Parse the strings in the args array of a {"args": [...]} job written by json.dumps
+    static String[] parseArgs(String line) {
+        List<String> args = new ArrayList<>();
+        int i = line.indexOf('[', line.indexOf("\"args\"")) + 1;
+        while (i < line.length() && line.charAt(i) != ']') {
+            if (line.charAt(i++) != '"') {
+                continue;
+            }
+            StringBuilder arg = new StringBuilder();
+            for (char c; (c = line.charAt(i++)) != '"'; arg.append(c)) {
+                if (c != '\\') {
+                    continue;
+                }
+                switch (c = line.charAt(i++)) {
+                    case 'b': c = '\b'; break;
+                    case 'f': c = '\f'; break;
+                    case 'n': c = '\n'; break;
+                    case 'r': c = '\r'; break;
+                    case 't': c = '\t'; break;
+                    case 'u': c = (char) Integer.parseInt(line.substring(i, i + 4), 16); i += 4; break;
+                    default: break;
+                }
+            }
+            args.add(arg.toString());
+        }
+        return args.toArray(new String[0]);
+    }
+
+    static String quote(String value) {
+        StringBuilder quoted = new StringBuilder("\"");
+        for (char c : value.toCharArray()) {
+            if (c == '"' || c == '\\') {
+                quoted.append('\\').append(c);
+            } else if (c < 0x20 || c > 0x7e) {
+                quoted.append(String.format("\\u%04x", (int) c));
+            } else {
+                quoted.append(c);
+            }
+        }
+        return quoted.append('"').toString();
+    }
+}
@@ -0,0 +1,122 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from pathlib import Path
+from hashlib import sha256
+from json import load as json_load, dump as json_dump, JSONDecodeError
+from os import link, replace, getpid
+from shutil import copy2, rmtree
+from time import time
+from typing import Optional, Iterable
+
+from .result_cache import hash_file_content
+from .file_index import FileIndex
+
+# Bump when the layout of cache entries changes so stale entries are ignored
+DECOMPILE_CACHE_FORMAT_VERSION = 1
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    """Hard link src to dst to avoid copying decompiled files. Falls back to copying across filesystems."""
+    try:
+        link(src, dst)
+    except OSError:
+        copy2(src, dst)
+
+
+class DecompileCache:
+    """
+    Content-addressed store of decompiler output that can be shared across runs and machines through a directory.
+    Entries are keyed by the input file content hash, binary name and content hash, and decompiler args, and hold an
+    index of the produced files so they do not need to be walked again. Only output of runs that exited cleanly
+    should be saved.
+
+    Layout: <cache_dir>/<key>/index.json and <cache_dir>/<key>/files/<relative path of each decompiled file>
+    """
+
+    def __init__(self, cache_dir: Path | str) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def make_key(
+        self, file_path: Path, binary_name: str, binary_hash: str, args: Iterable[str], deobfuscate: bool
+    ) -> str:
+        """
+        Key of decompiling file_path with the binary whose content hashes to binary_hash, so upgrading a decompiler
+        invalidates its entries but moving it does not. args should not include the binary path.
+        """
+        key_hash = sha256(
+            f"{DECOMPILE_CACHE_FORMAT_VERSION}\0{hash_file_content(file_path)}\0{binary_name}\0{binary_hash}\0".encode()
+        )
+        for arg in args:
+            key_hash.update(f"{arg}\0".encode())
+        key_hash.update(f"{deobfuscate}".encode())
+        return key_hash.hexdigest()
+
+    def lookup(self, key: str) -> Optional[list[str]]:
+        """Relative paths of the files cached for key, or None if key is not cached."""
+        entry_dir = self.cache_dir / key
+        try:
+            with (entry_dir / "index.json").open("r") as f:
+                return list(json_load(f)["files"])
+        except FileNotFoundError:
+            pass
+        except (OSError, JSONDecodeError, KeyError, TypeError) as e:
+            print(f"Error loading decompile cache entry {entry_dir}. Ignoring cache. {e}")
+        self.num_misses += 1
+        return None
+
+    def link(self, key: str, relative_paths: Iterable[str], output_dir: Path) -> Optional[FileIndex]:
+        """Link the files cached for key at relative_paths into output_dir and return their paths, or None on error."""
+        entry_dir = self.cache_dir / key
+        decompiled_files = FileIndex()
+        try:
+            for relative_path in relative_paths:
+                decompiled_file = output_dir / relative_path
+                decompiled_file.parent.mkdir(parents=True, exist_ok=True)
+                link_or_copy(entry_dir / "files" / relative_path, decompiled_file)
+                decompiled_files.add(decompiled_file)
+        except OSError as e:
+            print(f"Error loading decompile cache entry {entry_dir}. Ignoring cache. {e}")
+            self.num_misses += 1
+            return None
+
+        self.num_hits += 1
+        return decompiled_files
+
+    def load(self, key: str, output_dir: Path) -> Optional[FileIndex]:
+        """Link the cached files for key into output_dir and return their paths, or None if key is not cached."""
+        if (relative_paths := self.lookup(key)) is None:
+            return None
+        return self.link(key, relative_paths, output_dir)
+
+    def save(self, key: str, output_dir: Path, decompiled_files: Iterable[Path], metadata: dict) -> bool:
+        """Store decompiled files under output_dir. The entry is built in a temp dir then renamed into place."""
+        entry_dir = self.cache_dir / key
+        if entry_dir.exists():
+            return True
+
+        tmp_dir = self.cache_dir / f"{key}.{getpid()}.tmp"
+        try:
+            relative_paths = []
+            for decompiled_file in decompiled_files:
+                relative_path = decompiled_file.relative_to(output_dir)
+                cached_file = tmp_dir / "files" / relative_path
+                cached_file.parent.mkdir(parents=True, exist_ok=True)
+                link_or_copy(decompiled_file, cached_file)
+                relative_paths.append(str(relative_path))
+
+            with (tmp_dir / "index.json").open("w") as f:
+                json_dump({**metadata, "created": time(), "files": sorted(relative_paths)}, f, indent=4)
+            replace(tmp_dir, entry_dir)
+            return True
+        except (OSError, ValueError) as e:
+            # Another process may have saved the same entry first
+            if not entry_dir.exists():
+                print(f"Error saving decompile cache entry {entry_dir}. {e}")
+            rmtree(tmp_dir, ignore_errors=True)
+            return entry_dir.exists()
+
+    def __repr__(self) -> str:
+        return f"DecompileCache(cache_dir={self.cache_dir})"
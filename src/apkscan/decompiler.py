@@ -1,20 +1,38 @@
 # © 2024 Lucas Faudman.
 # Licensed under the MIT License (see LICENSE for details).
 # For commercial use, see LICENSE for additional terms.
-from subprocess import run, DEVNULL, SubprocessError
+from subprocess import run, Popen, DEVNULL, SubprocessError, TimeoutExpired
 from pathlib import Path
-from shutil import which, rmtree
-from os import access, X_OK
+from shutil import which, rmtree, copyfileobj
+from os import access, X_OK, killpg, cpu_count, getpid, replace
+from signal import SIGTERM, SIGKILL
 from shlex import split as shlex_split
-from zipfile import ZipFile
-from typing import Optional, Iterator, Iterable, Literal
+from fnmatch import fnmatchcase
+from zipfile import ZipFile, ZipInfo
+from zlib import crc32
+from queue import Queue
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
+from time import monotonic
+from contextlib import nullcontext
+from heapq import heappush, heappop, heappushpop
+from itertools import count
+from typing import Optional, Iterator, Iterable, Literal, Generator, Container, Callable, TypeVar
 
 # Handles Dalvik bytecode (.apk/.dex) -> Java bytecode (.jar) translation
 # to allow for decompilation with Java decompilers that don't support Dalvik.
 # See: https://github.com/LucasFaudman/enjarify-adapter for more information.
 from enjarify import enjarify  # type: ignore
 from .concurrent_executor import ConcurrentExecutor
-
+from .decompile_cache import DecompileCache, link_or_copy
+from .result_cache import hash_file_content
+from .resource_scheduler import ResourceScheduler
+from .decompiler_daemon import DaemonPool, DaemonError, DaemonTimeout, java_main_daemon_command
+from .file_index import FileIndex, OutputProgress, iter_file_entries
+from .prescan import SKIP_EXTS
+
+# cpu_cost, memory_mb, and memory_mb_per_input_mb are typical resource use used to schedule decompiler subprocesses
+# output_root_dirs are globs of top level output dirs that are not part of the class or resource path
 DEFAULT_CONFIG: dict = {
     "jadx": {
         "binary": which("jadx") or "/usr/local/bin/jadx",
@@ -34,6 +52,10 @@ DEFAULT_CONFIG: dict = {
             ".aab",
             ".jadx.kts",
         },
+        "output_root_dirs": ["sources", "resources"],
+        "cpu_cost": 4,
+        "memory_mb": 1024,
+        "memory_mb_per_input_mb": 20,
     },
     "apktool": {
         "binary": which("apktool") or "/usr/local/bin/apktool",
@@ -41,6 +63,10 @@ DEFAULT_CONFIG: dict = {
         "deobf_args": ["--force-manifest"],
         "extra_args": ["d", "--force", "--keep-broken-res"],
         "file_exts": {".apk", ".xapk"},
+        "output_root_dirs": ["smali", "smali_*"],
+        "cpu_cost": 1,
+        "memory_mb": 1024,
+        "memory_mb_per_input_mb": 10,
     },
     "procyon": {
         "binary": which("procyon-decompiler") or "/usr/local/bin/procyon-decompiler",
@@ -48,13 +74,20 @@ DEFAULT_CONFIG: dict = {
         "deobf_args": ["-renames"],
         "extra_args": [],
         "file_exts": {".jar", ".dex", ".class"},
+        "cpu_cost": 1,
+        "memory_mb": 1024,
+        "memory_mb_per_input_mb": 10,
     },
     "cfr": {
         "binary": which("cfr-decompiler") or "/usr/local/bin/cfr-decompiler",
         "output_arg": "--outputdir",
         "deobf_args": ["--antiobf", "true"],
         "extra_args": [],
+        "daemon_main_class": "org.benf.cfr.reader.Main",
         "file_exts": {".jar", ".dex", ".class"},
+        "cpu_cost": 1,
+        "memory_mb": 1024,
+        "memory_mb_per_input_mb": 10,
     },
     "krakatau": {
         "binary": which("krakatau") or "/usr/local/bin/krakatau",
@@ -62,6 +95,9 @@ DEFAULT_CONFIG: dict = {
         "deobf_args": [],
         "extra_args": ["dis"],
         "file_exts": {".jar", ".zip", ".class"},
+        "cpu_cost": 1,
+        "memory_mb": 512,
+        "memory_mb_per_input_mb": 10,
     },
     "fernflower": {
         "binary": which("fernflower") or "/usr/local/bin/fernflower",
@@ -69,9 +105,116 @@ DEFAULT_CONFIG: dict = {
         "deobf_args": [],
         "extra_args": [],
         "file_exts": {".jar", ".class"},
+        "cpu_cost": 1,
+        "memory_mb": 1024,
+        "memory_mb_per_input_mb": 10,
     },
 }
 
+# Exts of decompiled classes. Inner classes are in their own files for some decompilers e.g. Outer$Inner.smali
+CLASS_EXTS = {".java", ".kt", ".smali", ".class", ".j"}
+UNPACK_CHUNK_SIZE = 1 << 20
+TIMEOUT_POLL_INTERVAL = 1.0
+# Inputs read ahead of the one being scheduled so the largest of them can start first
+SCHEDULE_LOOKAHEAD = 16
+# Polls in a row a file must keep the same size and mtime before it is streamed as done being written
+STREAM_STABLE_POLLS = 3
+KILL_GRACE_PERIOD = 5.0
+
+
+def kill_process_group(process: Popen) -> None:
+    """Terminate the process group started by process then kill it if it does not exit within KILL_GRACE_PERIOD."""
+    for sig in (SIGTERM, SIGKILL):
+        try:
+            killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+        try:
+            process.wait(KILL_GRACE_PERIOD)
+            return
+        except TimeoutExpired:
+            continue
+
+
+def enjarify_to_jar(file_path: Path, jar_file: Path, quiet: bool) -> Optional[str]:
+    """Run enjarify in a worker process. Writes to a temp file first so other runs never see a partial jar."""
+    tmp_jar_file = jar_file.with_suffix(f".{getpid()}.tmp")
+    try:
+        jar_file.parent.mkdir(parents=True, exist_ok=True)
+        enjarify(file_path, tmp_jar_file, overwrite=True, quiet=quiet)
+        replace(tmp_jar_file, jar_file)
+        return None
+    except Exception as e:
+        tmp_jar_file.unlink(missing_ok=True)
+        return f"{file_path.name}: {e}"
+
+
+T = TypeVar("T")
+
+
+def iter_largest_first(
+    items: Iterable[T], key: Callable[[T], tuple[float, ...]], lookahead: int = SCHEDULE_LOOKAHEAD
+) -> Iterator[T]:
+    """
+    Yield items largest key first within a window of lookahead items, so only lookahead items are read ahead of the
+    one being yielded instead of the whole iterable, which may still be unpacking or converting inputs.
+    """
+    heap: list[tuple[tuple[float, ...], int, T]] = []
+    order = count()
+    for item in items:
+        entry = (tuple(-value for value in key(item)), next(order), item)
+        if len(heap) < lookahead:
+            heappush(heap, entry)
+        else:
+            yield heappushpop(heap, entry)[2]
+    while heap:
+        yield heappop(heap)[2]
+
+
+def find_finished_files(
+    output_dir: Path,
+    file_stats: dict[str, tuple[int, int, int]],
+    streamed_stats: dict[str, tuple[int, int]],
+    skip_exts: Container[str] = (),
+    stable_polls: int = STREAM_STABLE_POLLS,
+) -> FileIndex:
+    """
+    Find files in output_dir with the same size and mtime for the last stable_polls calls, so they are likely done
+    being written. file_stats holds the (size, mtime, polls unchanged) of files not finished yet. Finished files are
+    moved to streamed_stats with their (size, mtime) so they are only returned once. See find_changed_files.
+    """
+    finished_files = FileIndex()
+    for entry in iter_file_entries(output_dir, skip_exts):
+        if entry.path in streamed_stats:
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        file_stat = (stat.st_size, stat.st_mtime_ns)
+        last_size, last_mtime, polls_unchanged = file_stats.get(entry.path, (-1, -1, 0))
+        polls_unchanged = polls_unchanged + 1 if (last_size, last_mtime) == file_stat else 0
+        if polls_unchanged >= stable_polls:
+            finished_files.add(entry.path)
+            streamed_stats[entry.path] = file_stat
+            file_stats.pop(entry.path, None)
+        else:
+            file_stats[entry.path] = (*file_stat, polls_unchanged)
+    return finished_files
+
+
+def find_changed_files(streamed_stats: dict[str, tuple[int, int]]) -> FileIndex:
+    """Streamed files written to again after they were streamed, e.g. when a decompiler paused in the middle of one."""
+    changed_files = FileIndex()
+    for path, streamed_stat in streamed_stats.items():
+        try:
+            stat = Path(path).stat()
+        except FileNotFoundError:
+            continue
+        if (stat.st_size, stat.st_mtime_ns) != streamed_stat:
+            changed_files.add(path)
+    return changed_files
+
 
 class Decompiler:
     CONFIG: dict = DEFAULT_CONFIG.copy()
@@ -80,28 +223,62 @@ class Decompiler:
         self,
         binaries: Optional[dict[str, Optional[Path | str]] | Iterable[str]] = None,
         enjarify_choice: Literal["auto", "never", "always"] = "auto",
+        enjarify_max_workers: Optional[int] = None,
+        enjarify_cache_dir: Optional[Path | str] = None,
         unpack_xapks: bool = True,
         deobfuscate: bool = False,
         extra_args: Optional[list[str]] = None,
+        daemons: Optional[list[str]] = None,
         output_suffix: str = "-decompiled",
         output_stem_separator: str = "__",
         working_dir: Path = Path("/tmp/apk-secret-scanner"),
         overwrite: bool = False,
         remove_failed_output_dirs: bool = True,
         suppress_output: bool = False,
+        cache_dir: Optional[Path | str] = None,
+        stream_output: bool = False,
+        stream_poll_interval: float = 0.5,
+        binary_timeout: Optional[float] = None,
+        stall_timeout: Optional[float] = None,
+        keep_partial_output: bool = True,
+        schedule_resources: bool = True,
+        max_cpu: Optional[float] = None,
+        max_memory_mb: Optional[float] = None,
+        index_skip_exts: Optional[Iterable[str]] = None,
+        skip_media_files: bool = False,
         **concurrent_executor_kwargs,
     ):
         self.binary_paths = self.validate_binary_paths(binaries)
         self.enjarify = self.validate_enjarify_choice(enjarify_choice)
+        self.enjarify_max_workers = enjarify_max_workers
+        self.enjarify_cache_dir = Path(enjarify_cache_dir) if enjarify_cache_dir else None
         self.unpack_xapks = unpack_xapks
         self.deobfuscate = deobfuscate
         self.extra_args = self.validate_extra_args(extra_args)
+        self.daemon_commands = self.validate_daemon_commands(daemons)
+        self.daemon_pools: dict[str, DaemonPool] = {}
         self.output_suffix = output_suffix
         self.output_stem_separator = output_stem_separator
         self.working_dir = working_dir
         self.overwrite = overwrite
         self.remove_failed_output_dirs = remove_failed_output_dirs
         self.suppress_output = suppress_output
+        self.decompile_cache = DecompileCache(cache_dir) if cache_dir else None
+        self.stream_output = stream_output
+        self.stream_poll_interval = stream_poll_interval
+        self.binary_timeout = binary_timeout
+        self.stall_timeout = stall_timeout
+        self.keep_partial_output = keep_partial_output
+        self.timed_out: dict[Path, str] = {}
+        # Exit status of the last run writing to each output dir. Only output of runs that exited with 0 is cached.
+        self.exit_codes: dict[Path, int] = {}
+        self.binary_hashes: dict[str, str] = {}
+        self.scheduler = ResourceScheduler(max_cpu, max_memory_mb) if schedule_resources else None
+        # Decompiled files with these exts are left out of the index so they are never scanned. Nothing is skipped
+        # unless asked for since secrets can be hidden in any file.
+        self.index_skip_exts = set(map(str.lower, index_skip_exts or ()))
+        if skip_media_files:
+            self.index_skip_exts.update(SKIP_EXTS)
         self.concurrent_executor = ConcurrentExecutor(**{"concurrency_type": "thread", **concurrent_executor_kwargs})
         self.output_dirs: dict[str, Path] = {}
 
@@ -167,6 +344,62 @@ class Decompiler:
             extra_args_dict[binary_name] = args
         return extra_args_dict
 
+    def validate_daemon_commands(self, daemons: Optional[list[str]]) -> dict[str, list[str]]:
+        """
+        Parse '<DECOMPILER_NAME> <DAEMON_COMMAND>...' strings. See decompiler_daemon.py for the daemon protocol.
+        '<DECOMPILER_NAME> <JAR_PATH>' runs the bundled JavaMainDaemon for decompilers with a daemon_main_class.
+        """
+        daemon_commands: dict[str, list[str]] = {}
+        for daemon in daemons or ():
+            binary_name, *command = shlex_split(daemon)
+            if binary_name not in self.binary_paths:
+                print(f"Skipping daemon for {binary_name}. Binary not found.")
+                continue
+            if len(command) == 1 and command[0].endswith(".jar"):
+                if not (main_class := self.CONFIG[binary_name].get("daemon_main_class")):
+                    print(f"Skipping daemon for {binary_name}. No bundled daemon, pass a daemon command instead.")
+                    continue
+                command = java_main_daemon_command(command[0], main_class)
+            daemon_commands[binary_name] = command
+        return daemon_commands
+
+    def get_daemon_pool(self, binary_name: str) -> DaemonPool:
+        if (daemon_pool := self.daemon_pools.get(binary_name)) is None:
+            max_daemons = self.concurrent_executor.max_workers or cpu_count() or 1
+            daemon_pool = self.daemon_pools.setdefault(
+                binary_name, DaemonPool(self.daemon_commands[binary_name], max_daemons, self.suppress_output)
+            )
+        return daemon_pool
+
+    def try_run_daemon(self, binary_name: str, file_path: Path, output_path: Path) -> Optional[bool]:
+        """Run a job on a warm daemon for binary. Returns None if the daemon failed so the binary should be run instead."""
+        args = self.make_args(binary_name, file_path, output_path)[1:]
+        try:
+            print(f"Running {binary_name} daemon on {file_path.name}")
+            success, error = self.get_daemon_pool(binary_name).run(args, self.binary_timeout)
+        except DaemonTimeout as e:
+            print(f"Killed {binary_name} daemon on {file_path.name}. {e}")
+            self.timed_out[output_path] = str(e)
+            return False
+        except DaemonError as e:
+            print(f"Error running {binary_name} daemon on {file_path.name}. Running {binary_name} instead. {e}")
+            return None
+        if error:
+            print(f"Error from {binary_name} daemon on {file_path.name}: {error}")
+        self.exit_codes[output_path] = 0 if success else 1
+        return success
+
+    def close_daemons(self) -> None:
+        for daemon_pool in self.daemon_pools.values():
+            daemon_pool.close()
+        self.daemon_pools.clear()
+
+    def get_binary_hash(self, binary_name: str) -> str:
+        """Content hash of the binary (after following symlinks) so cached output is keyed on the decompiler version."""
+        if (binary_hash := self.binary_hashes.get(binary_name)) is None:
+            binary_hash = self.binary_hashes[binary_name] = hash_file_content(self.binary_paths[binary_name].resolve())
+        return binary_hash
+
     def make_args(self, binary_name: str, file_path: Path, output_path: Path) -> list[str]:
         args = [
             self.binary_paths[binary_name],
@@ -180,6 +413,18 @@ class Decompiler:
         args.append(file_path)
         return list(map(str, args))
 
+    def estimate_cost(self, binary_name: str, file_path: Path) -> tuple[float, float]:
+        """Estimated (CPU, memory MB) used by running binary on file_path."""
+        config = self.CONFIG[binary_name]
+        try:
+            input_size_mb = file_path.stat().st_size / (1 << 20)
+        except OSError:
+            input_size_mb = 0
+        return (
+            config.get("cpu_cost", 1),
+            config.get("memory_mb", 0) + config.get("memory_mb_per_input_mb", 0) * input_size_mb,
+        )
+
     def try_run_binary(self, binary_name: str, file_path: Path, output_path: Path) -> bool:
         args = self.make_args(binary_name, file_path, output_path)
         kwargs = {"stdout": DEVNULL, "stderr": DEVNULL} if self.suppress_output else {}
@@ -187,11 +432,85 @@ class Decompiler:
         try:
             print(f"Running {binary_name} on {file_path.name}")
             result = run(args, **kwargs)  # type: ignore
+            self.exit_codes[output_path] = result.returncode
             return True
         except SubprocessError as e:
             print(f"Error Running {binary_name} on {file_path.name}: {e}")
             return False
 
+    def try_run_binary_monitored(
+        self,
+        binary_name: str,
+        file_path: Path,
+        output_path: Path,
+        streamed_stats: Optional[dict[str, tuple[int, int]]] = None,
+    ) -> Generator[tuple[Path, Path, FileIndex, None], None, bool]:
+        """
+        Run binary in its own process group and kill the group after binary_timeout seconds, or after stall_timeout
+        seconds without any change to the files in output_path. Timeouts are recorded in timed_out by output_path.
+        When streamed_stats is a dict, yields files that are done being written while the binary runs and adds
+        them to streamed_stats. See find_finished_files. Returns success like try_run_binary.
+        """
+        args = self.make_args(binary_name, file_path, output_path)
+        kwargs = {"stdout": DEVNULL, "stderr": DEVNULL} if self.suppress_output else {}
+        try:
+            print(f"Running {binary_name} on {file_path.name}")
+            process = Popen(args, start_new_session=True, **kwargs)  # type: ignore
+        except SubprocessError as e:
+            print(f"Error Running {binary_name} on {file_path.name}: {e}")
+            return False
+
+        poll_interval = self.stream_poll_interval if streamed_stats is not None else TIMEOUT_POLL_INTERVAL
+        file_stats: dict[str, tuple[int, int, int]] = {}
+        start_time = last_progress_time = monotonic()
+        output_progress = OutputProgress(output_path)
+        try:
+            while True:
+                try:
+                    self.exit_codes[output_path] = process.wait(poll_interval)
+                    return True
+                except TimeoutExpired:
+                    pass
+
+                now = monotonic()
+                if streamed_stats is not None and (
+                    finished_files := find_finished_files(output_path, file_stats, streamed_stats, self.index_skip_exts)
+                ):
+                    yield file_path, output_path, finished_files, None
+
+                timeout_reason = None
+                if self.stall_timeout:
+                    if output_progress.changed():
+                        last_progress_time = now
+                    elif now - last_progress_time > self.stall_timeout:
+                        timeout_reason = f"No new output for {self.stall_timeout} seconds"
+                if self.binary_timeout and now - start_time > self.binary_timeout:
+                    timeout_reason = f"Running for more than {self.binary_timeout} seconds"
+                if timeout_reason:
+                    print(f"Killing {binary_name} on {file_path.name}. {timeout_reason}")
+                    self.timed_out[output_path] = timeout_reason
+                    return False
+        finally:
+            # Also kills the process if the generator is closed before it exits
+            if process.poll() is None:
+                kill_process_group(process)
+
+    def get_logical_path(self, file_path: Path, output_dir: Path) -> str:
+        """
+        Path of file_path in output_dir without the dirs and exts that differ between decompilers, so the same class
+        or resource has the same logical path in every output dir. e.g. jadx/sources/com/a/B.java,
+        apktool/smali/com/a/B$C.smali and cfr/com/a/B.java are all com/a/B
+        """
+        parts = file_path.relative_to(output_dir).parts
+        output_root_dirs = self.CONFIG.get(output_dir.name, {}).get("output_root_dirs", ())
+        if len(parts) > 1 and any(fnmatchcase(parts[0], output_root_dir) for output_root_dir in output_root_dirs):
+            parts = parts[1:]
+        *dir_parts, name = parts
+        stem, dot, ext = name.rpartition(".")
+        if dot and f".{ext}" in CLASS_EXTS:
+            name = stem.split("$", 1)[0]
+        return "/".join((*dir_parts, name))
+
     def get_output_dir(self, file_path: Path) -> Path:
         output_dir = self.working_dir
         split_stem = file_path.stem.split(self.output_stem_separator)
@@ -206,59 +525,152 @@ class Decompiler:
 
         return output_dir.resolve()
 
-    def unpack_xapk(self, file_path: Path) -> Iterator[Path]:
-        with ZipFile(file_path, "r") as z:
-            for name in z.namelist():
-                if not name.endswith(".apk"):
-                    continue
-                with z.open(name) as apk_file:
-                    apk_path = self.get_output_dir(file_path) / f"{file_path.stem}{self.output_stem_separator}{name}"
-                    with apk_path.open("wb") as f:
-                        f.write(apk_file.read())
-                    yield apk_path
-
-    def enjarify_file(self, file_path: Path) -> Path:
-        if file_path.suffix not in {".apk", ".dex"}:
-            print(f"Skipping {file_path.name}. Enjarify only works on .apk and .dex files.")
-            return file_path
-
-        jar_file = (self.get_output_dir(file_path) / file_path.name).with_suffix(".jar")
-        if jar_file.exists() and not self.overwrite:
-            return jar_file
-
+    def extract_xapk_entry(self, file_path: Path, name: str, apk_path: Path) -> Path:
+        # Each extraction opens its own ZipFile so entries can be copied in parallel. Entries are extracted to a
+        # temp file and renamed into place so an interrupted extraction never leaves a partial APK at apk_path.
+        tmp_path = apk_path.with_name(f"{apk_path.name}.{getpid()}.tmp")
         try:
-            print(f"\nEnjarifying {file_path.name} to {jar_file.name}")
-            enjarify(file_path, jar_file, overwrite=True, quiet=self.suppress_output)
-            print(f"Successfully enjarified {file_path.name} to {jar_file.name}")
-        except Exception as e:
-            print(f"Error enjarifying {file_path.name}: {e}")
-            jar_file.unlink(missing_ok=True)
+            with ZipFile(file_path, "r") as z, z.open(name) as apk_file:
+                apk_path.parent.mkdir(parents=True, exist_ok=True)
+                with tmp_path.open("wb") as f:
+                    copyfileobj(apk_file, f, UNPACK_CHUNK_SIZE)
+            replace(tmp_path, apk_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return apk_path
+
+    @staticmethod
+    def is_extracted_xapk_entry(info: ZipInfo, apk_path: Path) -> bool:
+        """True if apk_path has the same size and CRC-32 as the XAPK entry it would be extracted from."""
+        try:
+            if apk_path.stat().st_size != info.file_size:
+                return False
+            with apk_path.open("rb") as f:
+                crc = 0
+                while chunk := f.read(UNPACK_CHUNK_SIZE):
+                    crc = crc32(chunk, crc)
+        except OSError:
+            return False
+        return crc == info.CRC
 
-        return jar_file
+    def unpack_xapk(self, file_path: Path) -> Iterator[Path]:
+        """Extract APKs from an XAPK in fixed size chunks with one thread per APK. Yields APKs as they are extracted."""
+        output_dir = self.get_output_dir(file_path)
+        with ZipFile(file_path, "r") as z:
+            apk_infos = [info for info in z.infolist() if info.filename.endswith(".apk")]
 
-    def decompile(self, binary_name_file_path: tuple[str, Path]) -> tuple[Path, Path, Optional[set[Path]], bool]:
+        extract_args = []
+        for info in apk_infos:
+            apk_path = output_dir / f"{file_path.stem}{self.output_stem_separator}{info.filename}"
+            if not self.overwrite and self.is_extracted_xapk_entry(info, apk_path):
+                yield apk_path
+            else:
+                extract_args.append((file_path, info.filename, apk_path))
+
+        if not extract_args:
+            return
+        with ThreadPoolExecutor(
+            max_workers=min(len(extract_args), self.concurrent_executor.max_workers or 4)
+        ) as executor:
+            futures = [executor.submit(self.extract_xapk_entry, *args) for args in extract_args]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def iterdecompile(
+        self, binary_name_file_path: tuple[str, Path], stream: bool = False
+    ) -> Iterator[tuple[Path, Path, Optional[FileIndex], Optional[bool]]]:
+        """
+        Decompile yielding (file_path, output_dir, decompiled_files, success) once when done like decompile.
+        When stream is True, also yields batches of files done being written while the decompiler is running
+        with success None. The last yield only has the decompiled files that were not already yielded.
+        """
         binary_name, file_path = binary_name_file_path
         output_dir = self.get_output_dir(file_path) / binary_name
-        if output_dir.exists() and not self.overwrite:
+        decompiled_files: Optional[FileIndex] = None
+        cache_key: Optional[str] = None
+        if decompile_cache := self.decompile_cache:
+            # Input and output paths are replaced with placeholders and the binary path with its content hash so the
+            # key only depends on file content, decompiler version, and config
+            args = self.make_args(binary_name, Path("{input}"), Path("{output}"))[1:]
+            cache_key = decompile_cache.make_key(
+                file_path, binary_name, self.get_binary_hash(binary_name), args, self.deobfuscate
+            )
+            cached_files = decompile_cache.lookup(cache_key)
+            # Output dirs are named by file stem so existing output may be from a different file with the same name.
+            # It is only removed once the lookup is done, to be replaced by the cached files or a new decompile.
+            self.remove_output_dir(output_dir)
+            output_dir.mkdir(parents=True, exist_ok=True)
+            if cached_files is not None:
+                if (decompiled_files := decompile_cache.link(cache_key, cached_files, output_dir)) is not None:
+                    print(f"Loaded {len(decompiled_files)} cached {binary_name} decompiled files for {file_path.name}")
+                    yield file_path, output_dir, decompiled_files, True
+                    return
+                # Remove the files linked before the error so they are not mixed with the new decompile
+                self.remove_output_dir(output_dir)
+                output_dir.mkdir(parents=True, exist_ok=True)
+
+        # Size and mtime of each file streamed while the binary was running
+        streamed_stats: dict[str, tuple[int, int]] = {}
+        self.exit_codes.pop(output_dir, None)
+        if output_dir.exists() and not self.overwrite and cache_key is None:
             success = True
         else:
             output_dir.mkdir(parents=True, exist_ok=True)
-            success = self.try_run_binary(binary_name, file_path, output_dir)
+            # Wait until there are enough resources to run the binary
+            with (
+                self.scheduler.reserve(*self.estimate_cost(binary_name, file_path)) if self.scheduler else nullcontext()
+            ):
+                daemon_success = None
+                if binary_name in self.daemon_commands and not stream:
+                    daemon_success = self.try_run_daemon(binary_name, file_path, output_dir)
+
+                if daemon_success is not None:
+                    success = daemon_success
+                elif stream or self.binary_timeout or self.stall_timeout:
+                    success = yield from self.try_run_binary_monitored(
+                        binary_name, file_path, output_dir, streamed_stats if stream else None
+                    )
+                else:
+                    success = self.try_run_binary(binary_name, file_path, output_dir)
+
+            if not success and output_dir in self.timed_out and self.keep_partial_output:
+                print(f"Keeping partial output of {binary_name} for {file_path.name}")
+                success = True
 
         if success:
             print(f"Successfully decompiled {file_path.name} with {binary_name}")
+        elif self.remove_failed_output_dirs and streamed_stats:
+            # Streamed files may still be waiting to be scanned so the output dir is left for cleanup to remove
+            print(f"Erorr decompiling {file_path.name} with {binary_name}. Keeping output with streamed files.")
         elif self.remove_failed_output_dirs:
             print(f"Erorr decompiling {file_path.name} with {binary_name}.")
             self.remove_output_dir(output_dir)
 
         if success or not self.remove_failed_output_dirs:
             print(f"\nIndexing decompiled files in {output_dir}...")
-            decompiled_files = set((*filter(Path.is_file, output_dir.rglob("*")),))
+            decompiled_files = FileIndex.from_dir(output_dir, self.index_skip_exts)
             print(f"Found {len(decompiled_files)} decompiled files for {file_path.name}")
-        else:
-            decompiled_files = None
 
-        return file_path, output_dir, decompiled_files, success
+        # Partial output of killed or crashed runs is not cached so it is decompiled again next time
+        if decompile_cache and cache_key and success and decompiled_files:
+            if (exit_code := self.exit_codes.get(output_dir)) == 0:
+                decompile_cache.save(
+                    cache_key, output_dir, decompiled_files, {"file_name": file_path.name, "binary_name": binary_name}
+                )
+            else:
+                print(f"Not caching {binary_name} output for {file_path.name}. Exit status: {exit_code}")
+
+        if decompiled_files is not None and streamed_stats:
+            # Streamed files written to again after they were streamed are yielded again so no content is missed
+            changed_files = find_changed_files(streamed_stats)
+            if changed_files:
+                print(f"Rescanning {len(changed_files)} files changed after they were streamed for {file_path.name}")
+            decompiled_files -= (path for path in streamed_stats if path not in changed_files)
+        yield file_path, output_dir, decompiled_files, success
+
+    def decompile(self, binary_name_file_path: tuple[str, Path]) -> tuple[Path, Path, Optional[FileIndex], bool]:
+        file_path, output_dir, decompiled_files, success = next(self.iterdecompile(binary_name_file_path))
+        return file_path, output_dir, decompiled_files, bool(success)
 
     def unpack_files(self, file_paths: Iterable[Path]) -> Iterator[Path]:
         for file_path in file_paths:
@@ -268,19 +680,141 @@ class Decompiler:
                 yield file_path
 
     def enjarify_concurrently(self, file_paths: Iterable[Path]) -> Iterator[Path]:
-        yield from self.concurrent_executor.map(self.enjarify_file, file_paths)
+        """
+        Convert .apk/.dex files to jars in a process pool since enjarify is pure Python, yielding each jar when ready.
+        Inputs with the same content are converted once. Jars are kept in enjarify_cache_dir by content hash when set.
+        """
+        # Futures of the jar each content hash is converted to, and the jars waiting on each future
+        conversions: dict[str, Future[Optional[str]]] = {}
+        converted_jars: dict[Future[Optional[str]], Path] = {}
+        waiting_jars: dict[Future[Optional[str]], list[Path]] = {}
+
+        def link_converted_jars(future: Future[Optional[str]]) -> Iterator[Path]:
+            converted_jar = converted_jars[future]
+            if error := future.result():
+                print(f"Error enjarifying to {converted_jar.name}: {error}")
+            else:
+                print(f"Successfully enjarified {converted_jar.name}")
+            for jar_file in waiting_jars.pop(future):
+                if not error and jar_file != converted_jar:
+                    link_or_copy(converted_jar, jar_file)
+                yield jar_file
+
+        concurrent = self.concurrent_executor.concurrency_type not in (None, False, "main")
+        with ProcessPoolExecutor(max_workers=self.enjarify_max_workers) if concurrent else nullcontext() as executor:
+            for file_path in file_paths:
+                if file_path.suffix not in {".apk", ".dex"}:
+                    print(f"Skipping {file_path.name}. Enjarify only works on .apk and .dex files.")
+                    yield file_path
+                    continue
+
+                jar_file = (self.get_output_dir(file_path) / file_path.name).with_suffix(".jar")
+                if jar_file.exists() and not self.overwrite:
+                    yield jar_file
+                    continue
+
+                content_hash = hash_file_content(file_path)
+                cached_jar = self.enjarify_cache_dir / f"{content_hash}.jar" if self.enjarify_cache_dir else None
+                if cached_jar is not None and cached_jar.exists():
+                    print(f"Using cached enjarified jar for {file_path.name}")
+                    jar_file.unlink(missing_ok=True)
+                    link_or_copy(cached_jar, jar_file)
+                    yield jar_file
+                    continue
+
+                if (future := conversions.get(content_hash)) is None:
+                    print(f"\nEnjarifying {file_path.name} to {jar_file.name}")
+                    converted_jar = cached_jar or jar_file
+                    if executor is not None:
+                        future = executor.submit(enjarify_to_jar, file_path, converted_jar, self.suppress_output)
+                    else:
+                        future = Future()
+                        future.set_result(enjarify_to_jar(file_path, converted_jar, self.suppress_output))
+                    conversions[content_hash], converted_jars[future] = future, converted_jar
+                waiting_jars.setdefault(future, []).append(jar_file)
+
+                # Start decompiling jars that are already converted without waiting for the rest
+                for done_future in [waiting_future for waiting_future in waiting_jars if waiting_future.done()]:
+                    yield from link_converted_jars(done_future)
+
+            for done_future in as_completed(list(waiting_jars)):
+                yield from link_converted_jars(done_future)
 
     def binary_name_file_path_generator(self, file_paths: Iterable[Path]) -> Iterator[tuple[str, Path]]:
+        if self.enjarify and self.scheduler is not None:
+            # Decompiles start as soon as each jar is ready so schedule the largest inputs first here instead
+            file_paths = iter_largest_first(file_paths, key=lambda file_path: (file_path.stat().st_size,))
         decompile_ready_file_paths = self.enjarify_concurrently(file_paths) if self.enjarify else file_paths
         for file_path in decompile_ready_file_paths:
             for binary_name in self.binary_paths:
                 if file_path.suffix in self.CONFIG[binary_name]["file_exts"]:
                     yield binary_name, file_path
 
+    def scheduled_binary_name_file_paths(self, file_paths: Iterable[Path]) -> Iterable[tuple[str, Path]]:
+        binary_name_file_paths = self.binary_name_file_path_generator(file_paths)
+        if self.scheduler is None or self.enjarify:
+            return binary_name_file_paths
+        # Start the most expensive decompiles first so they do not end up running alone at the end
+        return iter_largest_first(
+            binary_name_file_paths,
+            key=lambda binary_name_file_path: self.estimate_cost(*binary_name_file_path)[::-1],
+        )
+
     def decompile_concurrently(
         self, file_paths: Iterable[Path]
-    ) -> Iterator[tuple[Path, Path, Optional[set[Path]], bool]]:
-        yield from self.concurrent_executor.map(self.decompile, self.binary_name_file_path_generator(file_paths))
+    ) -> Iterator[tuple[Path, Path, Optional[FileIndex], bool]]:
+        yield from self.concurrent_executor.map(self.decompile, self.scheduled_binary_name_file_paths(file_paths))
+
+    def decompile_streaming_concurrently(
+        self, file_paths: Iterable[Path]
+    ) -> Iterator[tuple[Path, Path, Optional[FileIndex], Optional[bool]]]:
+        """
+        Like decompile_concurrently but also yields files as soon as they are written while decompilers are running.
+        See iterdecompile. Decompilers are always run in threads since the work is done in their subprocesses.
+        """
+        binary_name_file_paths = self.scheduled_binary_name_file_paths(file_paths)
+        if self.concurrent_executor.concurrency_type in (None, False, "main"):
+            for binary_name_file_path in binary_name_file_paths:
+                yield from self.iterdecompile(binary_name_file_path, stream=True)
+            return
+
+        # Queue of decompile results, exceptions, None when a decompile finishes, or the number of decompiles submitted
+        results: Queue = Queue()
+
+        def put_results(binary_name_file_path: tuple[str, Path]) -> None:
+            try:
+                for result in self.iterdecompile(binary_name_file_path, stream=True):
+                    results.put(result)
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(None)
+
+        def submit_all(executor: ThreadPoolExecutor) -> None:
+            num_submitted = 0
+            try:
+                for binary_name_file_path in binary_name_file_paths:
+                    executor.submit(put_results, binary_name_file_path)
+                    num_submitted += 1
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(num_submitted)
+
+        with ThreadPoolExecutor(max_workers=self.concurrent_executor.max_workers) as executor:
+            Thread(target=submit_all, args=(executor,), daemon=True).start()
+            num_submitted: Optional[int] = None
+            num_finished = 0
+            while num_submitted is None or num_finished < num_submitted:
+                result = results.get()
+                if result is None:
+                    num_finished += 1
+                elif isinstance(result, int):
+                    num_submitted = result
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
 
     def remove_output_dir(self, output_dir: Path) -> Path:
         if output_dir.exists() and output_dir.is_dir():
@@ -299,4 +833,4 @@ class Decompiler:
         print(f"Done removing {len(output_dirs)} decompiled output directories.")
 
     def __repr__(self) -> str:
-        return f"Decompiler:(binary_paths={self.binary_paths}, extra_args={self.extra_args}, deobfuscate={self.deobfuscate}, output_suffix={self.output_suffix}, working_dir={self.working_dir}, remove_failed_output_dirs={self.remove_failed_output_dirs}, concurrent_executor={self.concurrent_executor})"
+        return f"Decompiler:(binary_paths={self.binary_paths}, extra_args={self.extra_args}, daemon_commands={self.daemon_commands}, deobfuscate={self.deobfuscate}, output_suffix={self.output_suffix}, working_dir={self.working_dir}, remove_failed_output_dirs={self.remove_failed_output_dirs}, decompile_cache={self.decompile_cache}, stream_output={self.stream_output}, binary_timeout={self.binary_timeout}, stall_timeout={self.stall_timeout}, scheduler={self.scheduler}, concurrent_executor={self.concurrent_executor})"
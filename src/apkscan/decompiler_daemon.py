@@ -0,0 +1,157 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+from json import dumps as json_dumps, loads as json_loads, JSONDecodeError
+from select import select
+from queue import Queue, Empty
+from threading import Lock, BoundedSemaphore
+from os import killpg, read
+from pathlib import Path
+from time import monotonic
+from signal import SIGKILL
+from typing import Optional
+
+# Long-lived decompiler processes that are sent jobs over stdin to avoid starting a new JVM for every file.
+#
+# Protocol (one JSON object per line):
+#   apkscan -> daemon stdin:  {"args": ["<decompiler args without the binary>", ...]}
+#   daemon stdout -> apkscan: APKSCAN_DAEMON_RESPONSE {"success": true|false, "error": "<optional message>"}
+# Args are the same as passed to the one-shot binary by Decompiler.make_args, so a daemon can be a thin
+# wrapper that runs the decompiler's main entry point in a warm JVM for each line it reads.
+# Stdout lines without the response prefix are decompiler output and are printed instead of parsed.
+# daemons/JavaMainDaemon.java is a daemon for decompilers with a main method that returns, like CFR.
+
+RESPONSE_PREFIX = b"APKSCAN_DAEMON_RESPONSE "
+READ_CHUNK_SIZE = 1 << 16
+JAVA_MAIN_DAEMON = Path(__file__).parent / "daemons" / "JavaMainDaemon.java"
+
+
+def java_main_daemon_command(classpath: str, main_class: str) -> list[str]:
+    """Command that runs main_class from classpath in JavaMainDaemon. Requires Java 11+ to run the source file."""
+    return ["java", "-cp", classpath, str(JAVA_MAIN_DAEMON), main_class]
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonTimeout(DaemonError):
+    pass
+
+
+class DecompilerDaemon:
+    def __init__(self, command: list[str], suppress_output: bool = False) -> None:
+        self.command = command
+        self.suppress_output = suppress_output
+        # Bytes read from stdout that are not a full line yet
+        self.buffer = bytearray()
+        self.process = Popen(
+            command, stdin=PIPE, stdout=PIPE, stderr=DEVNULL if suppress_output else None, start_new_session=True
+        )
+
+    def run(self, args: list[str], timeout: Optional[float] = None) -> tuple[bool, Optional[str]]:
+        """Send a job and wait for its response. Raises DaemonError if the daemon exits, breaks protocol, or times out."""
+        stdin, stdout = self.process.stdin, self.process.stdout
+        if stdin is None or stdout is None or self.process.poll() is not None:
+            raise DaemonError(f"Daemon {self.command[0]} is not running")
+        try:
+            stdin.write(json_dumps({"args": args}).encode() + b"\n")
+            stdin.flush()
+            response = json_loads(self.read_response(stdout.fileno(), timeout))
+            return bool(response["success"]), response.get("error")
+        except DaemonError:
+            raise
+        except (OSError, JSONDecodeError, KeyError, TypeError) as e:
+            raise DaemonError(f"Error communicating with daemon {self.command[0]}: {e}") from e
+
+    def read_response(self, fd: int, timeout: Optional[float] = None) -> bytes:
+        """
+        Read the raw stdout fd into a line buffer until a response line, so a partial line never blocks past timeout.
+        Returns the response without its prefix. Other lines are printed unless output is suppressed.
+        """
+        deadline = monotonic() + timeout if timeout is not None else None
+        while True:
+            while (newline_index := self.buffer.find(b"\n")) != -1:
+                line = bytes(self.buffer[:newline_index])
+                del self.buffer[: newline_index + 1]
+                if line.startswith(RESPONSE_PREFIX):
+                    return line[len(RESPONSE_PREFIX) :]
+                if not self.suppress_output:
+                    print(line.decode(errors="replace"))
+
+            remaining = None if deadline is None else max(0.0, deadline - monotonic())
+            if not select([fd], [], [], remaining)[0]:
+                raise DaemonTimeout(f"No response from daemon {self.command[0]} after {timeout} seconds")
+            if not (chunk := read(fd, READ_CHUNK_SIZE)):
+                raise DaemonError(f"Daemon {self.command[0]} exited with code {self.process.wait()}")
+            self.buffer += chunk
+
+    def kill(self) -> None:
+        try:
+            killpg(self.process.pid, SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+    def close(self) -> None:
+        if self.process.stdin is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+        try:
+            self.process.wait(5)
+        except TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class DaemonPool:
+    """Up to max_daemons daemons for one binary started as needed. Each daemon runs one job at a time."""
+
+    def __init__(self, command: list[str], max_daemons: int, suppress_output: bool = False) -> None:
+        self.command = command
+        self.max_daemons = max(1, max_daemons)
+        self.suppress_output = suppress_output
+        # A job holds a slot while it runs so there is always an idle daemon or room to start one
+        self.slots = BoundedSemaphore(self.max_daemons)
+        self.idle: Queue[DecompilerDaemon] = Queue()
+        self.daemons: list[DecompilerDaemon] = []
+        self.lock = Lock()
+
+    def start_daemon(self) -> DecompilerDaemon:
+        try:
+            daemon = DecompilerDaemon(self.command, self.suppress_output)
+        except OSError as e:
+            raise DaemonError(f"Error starting daemon {self.command[0]}: {e}") from e
+        with self.lock:
+            self.daemons.append(daemon)
+        return daemon
+
+    def run(self, args: list[str], timeout: Optional[float] = None) -> tuple[bool, Optional[str]]:
+        with self.slots:
+            try:
+                daemon = self.idle.get_nowait()
+            except Empty:
+                daemon = self.start_daemon()
+            try:
+                result = daemon.run(args, timeout)
+            except DaemonError:
+                # Broken daemons are replaced with new ones on the next job
+                with self.lock:
+                    self.daemons.remove(daemon)
+                daemon.kill()
+                raise
+            self.idle.put(daemon)
+            return result
+
+    def close(self) -> None:
+        with self.lock:
+            daemons, self.daemons = self.daemons, []
+        for daemon in daemons:
+            daemon.close()
+        self.idle = Queue()
+
+    def __repr__(self) -> str:
+        return f"DaemonPool(command={self.command}, max_daemons={self.max_daemons}, running={len(self.daemons)})"
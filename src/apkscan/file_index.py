@@ -0,0 +1,183 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from pathlib import Path
+from os import scandir, stat, DirEntry, sep
+from sys import intern
+from typing import Iterator, Iterable, Container
+
+
+def iter_file_entries(root: Path | str, skip_exts: Container[str] = ()) -> Iterator[DirEntry]:
+    """
+    Walk root with os.scandir yielding a DirEntry for each regular file. Uses the file type from the directory listing
+    so no stat call is made per file. Symlinked directories are not followed. Files with an ext in skip_exts are skipped.
+    """
+    dirs = [str(root)]
+    while dirs:
+        try:
+            with scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif entry.is_file() and (not skip_exts or file_ext(entry.name) not in skip_exts):
+                            yield entry
+                    except OSError:
+                        # Removed since the directory was listed
+                        continue
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+
+
+class OutputProgress:
+    """
+    Checks if anything was written under root since the last call to changed without walking the whole tree. Each
+    call stats every dir once but only lists dirs whose mtime changed, and only stats files listed or still growing
+    on the last call, so polling a large tree that is not changing costs one stat per dir.
+    """
+
+    def __init__(self, root: Path | str) -> None:
+        self.root = str(root)
+        self.dir_mtimes: dict[str, int] = {}
+        self.subdirs: dict[str, list[str]] = {}
+        # Size of each file that was new or growing on the last call
+        self.file_sizes: dict[str, int] = {}
+
+    def changed(self) -> bool:
+        changed = False
+        file_sizes = {}
+        for path, size in self.file_sizes.items():
+            try:
+                if (current_size := stat(path).st_size) != size:
+                    changed = True
+                    file_sizes[path] = current_size
+            except OSError:
+                continue
+
+        dirs = [self.root]
+        while dirs:
+            dir_path = dirs.pop()
+            try:
+                mtime = stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            if self.dir_mtimes.get(dir_path) != mtime:
+                changed = True
+                self.dir_mtimes[dir_path] = mtime
+                self.subdirs[dir_path] = subdirs = []
+                try:
+                    with scandir(dir_path) as entries:
+                        for entry in entries:
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    subdirs.append(entry.path)
+                                elif entry.is_file():
+                                    file_sizes[entry.path] = entry.stat().st_size
+                            except OSError:
+                                continue
+                except OSError:
+                    continue
+            dirs.extend(self.subdirs.get(dir_path, ()))
+
+        self.file_sizes = file_sizes
+        return changed
+
+
+def file_ext(name: str) -> str:
+    """Lowercase suffix of name like Path.suffix."""
+    dot_index = name.rfind(".")
+    return name[dot_index:].lower() if 0 < dot_index < len(name) - 1 else ""
+
+
+class FileIndex:
+    """
+    Set of file paths stored as interned directory strings mapped to file names instead of Path objects, so indexes
+    of large decompiled trees stay small. Paths are only created when iterated. Supports the set operations used on
+    decompiled files (in, len, ==, |, -=, add, discard, update, pop).
+    """
+
+    def __init__(self, paths: Iterable[Path | str] = ()) -> None:
+        self.files_by_dir: dict[str, set[str]] = {}
+        self.num_files = 0
+        self.update(paths)
+
+    @classmethod
+    def from_dir(cls, root: Path | str, skip_exts: Container[str] = ()) -> "FileIndex":
+        file_index = cls()
+        for entry in iter_file_entries(root, skip_exts):
+            file_index.add_file(entry.path[: -len(entry.name) - 1], entry.name)
+        return file_index
+
+    def add_file(self, dir_path: str, name: str) -> None:
+        if (names := self.files_by_dir.get(dir_path)) is None:
+            names = self.files_by_dir[intern(dir_path)] = set()
+        if name not in names:
+            names.add(name)
+            self.num_files += 1
+
+    def add(self, path: Path | str) -> None:
+        dir_path, _, name = str(path).rpartition(sep)
+        self.add_file(dir_path, name)
+
+    def update(self, paths: Iterable[Path | str]) -> None:
+        if isinstance(paths, FileIndex):
+            for dir_path, names in paths.files_by_dir.items():
+                for name in names:
+                    self.add_file(dir_path, name)
+            return
+        for path in paths:
+            self.add(path)
+
+    def discard(self, path: Path | str) -> None:
+        dir_path, _, name = str(path).rpartition(sep)
+        if (names := self.files_by_dir.get(dir_path)) is not None and name in names:
+            names.remove(name)
+            self.num_files -= 1
+            if not names:
+                del self.files_by_dir[dir_path]
+
+    def pop(self) -> Path:
+        for dir_path, names in self.files_by_dir.items():
+            path = Path(dir_path, next(iter(names)))
+            self.discard(path)
+            return path
+        raise KeyError("pop from an empty FileIndex")
+
+    def __contains__(self, path: object) -> bool:
+        if not isinstance(path, (Path, str)):
+            return False
+        dir_path, _, name = str(path).rpartition(sep)
+        return name in self.files_by_dir.get(dir_path, ())
+
+    def __iter__(self) -> Iterator[Path]:
+        for dir_path, names in self.files_by_dir.items():
+            for name in names:
+                yield Path(dir_path, name)
+
+    def __len__(self) -> int:
+        return self.num_files
+
+    def __bool__(self) -> bool:
+        return self.num_files > 0
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, FileIndex):
+            return self.files_by_dir == other.files_by_dir
+        if isinstance(other, (set, frozenset)):
+            return len(other) == self.num_files and all(path in self for path in other)
+        return NotImplemented
+
+    def __or__(self, other: Iterable[Path | str]) -> "FileIndex":
+        file_index = FileIndex(self)
+        file_index.update(other)
+        return file_index
+
+    __ror__ = __or__
+
+    def __isub__(self, other: Iterable[Path | str]) -> "FileIndex":
+        for path in list(other):
+            self.discard(path)
+        return self
+
+    def __repr__(self) -> str:
+        return f"FileIndex(num_files={self.num_files}, num_dirs={len(self.files_by_dir)})"
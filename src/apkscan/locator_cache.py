@@ -0,0 +1,48 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from pathlib import Path
+from hashlib import sha256
+from marshal import dumps as marshal_dumps, loads as marshal_loads, version as marshal_version
+from os import environ, replace, getpid
+from typing import Any, Optional
+
+# Bump when the layout of cached records changes so stale cache files are ignored
+LOCATOR_CACHE_FORMAT_VERSION = 1
+
+DEFAULT_LOCATOR_CACHE_DIR = Path(environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "apkscan" / "locators"
+
+
+def make_cache_key(*parts: bytes | str) -> str:
+    """Hash parts with the cache format and marshal versions so incompatible cache files are never loaded."""
+    key_hash = sha256(f"{LOCATOR_CACHE_FORMAT_VERSION}\0{marshal_version}\0".encode())
+    for part in parts:
+        key_hash.update(part.encode() if isinstance(part, str) else part)
+        key_hash.update(b"\0")
+    return key_hash.hexdigest()
+
+
+def load_cached(cache_dir: Path, cache_key: str) -> Optional[Any]:
+    cache_path = cache_dir / f"{cache_key}.marshal"
+    try:
+        return marshal_loads(cache_path.read_bytes())
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        print(f"Error loading cached locators from {cache_path}. Ignoring cache. {e}")
+        return None
+
+
+def save_cached(cache_dir: Path, cache_key: str, value: Any) -> bool:
+    """Write value (only builtin types) to the cache. Written to a temp file first so readers never see partial files."""
+    cache_path = cache_dir / f"{cache_key}.marshal"
+    tmp_path = cache_path.with_suffix(f".{getpid()}.tmp")
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_bytes(marshal_dumps(value))
+        replace(tmp_path, cache_path)
+        return True
+    except (OSError, ValueError) as e:
+        print(f"Error caching locators to {cache_path}. {e}")
+        tmp_path.unlink(missing_ok=True)
+        return False
@@ -0,0 +1,428 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from typing import Any, Iterable, Optional, Sequence
+from re import (
+    compile as re_compile,
+    escape as re_escape,
+    error as re_error,
+    Pattern,
+    IGNORECASE,
+    DOTALL,
+    LOCALE,
+    VERBOSE,
+)
+
+try:
+    # Private regex parser module was renamed in python 3.11
+    from re import _parser as sre_parse  # type: ignore
+except ImportError:
+    import sre_parse  # type: ignore
+
+# Bump when findings or rewrites change so cached lint results are not reused
+LINT_VERSION = 2
+
+ALL_CHARS = frozenset(range(256))
+DIGIT_CHARS = frozenset(range(0x30, 0x3A))
+SPACE_CHARS = frozenset(b" \t\n\r\f\v")
+WORD_CHARS = DIGIT_CHARS | frozenset(range(0x41, 0x5B)) | frozenset(range(0x61, 0x7B)) | {0x5F}
+CATEGORY_CHARS = {
+    sre_parse.CATEGORY_DIGIT: (DIGIT_CHARS, rb"\d"),
+    sre_parse.CATEGORY_NOT_DIGIT: (ALL_CHARS - DIGIT_CHARS, rb"\D"),
+    sre_parse.CATEGORY_SPACE: (SPACE_CHARS, rb"\s"),
+    sre_parse.CATEGORY_NOT_SPACE: (ALL_CHARS - SPACE_CHARS, rb"\S"),
+    sre_parse.CATEGORY_WORD: (WORD_CHARS, rb"\w"),
+    sre_parse.CATEGORY_NOT_WORD: (ALL_CHARS - WORD_CHARS, rb"\W"),
+}
+REPEAT_OPS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None))
+ZERO_WIDTH_OPS = (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT)
+
+# Linear forms are sequences of (chars, min count, max count) atoms. See linear_form.
+Atom = tuple[frozenset[int], int, int]
+# Repeats with an exact count up to this are single atoms in linear forms so they line up with literals
+MAX_EXPANDED_ATOMS = 64
+
+
+def fold_case(chars: frozenset[int]) -> frozenset[int]:
+    return chars | {char ^ 0x20 for char in chars if 0x41 <= char <= 0x5A or 0x61 <= char <= 0x7A}
+
+
+def node_chars(op, value, flags: int) -> Optional[frozenset[int]]:
+    """Bytes matched by a node that matches exactly one byte, or None if the node is not a single byte."""
+    if op is sre_parse.LITERAL:
+        chars = frozenset((value,))
+    elif op is sre_parse.NOT_LITERAL:
+        return ALL_CHARS - (fold_case(frozenset((value,))) if flags & IGNORECASE else {value})
+    elif op is sre_parse.ANY:
+        return ALL_CHARS if flags & DOTALL else ALL_CHARS - {0x0A}
+    elif op is sre_parse.IN:
+        items = list(value)
+        negate = bool(items) and items[0][0] is sre_parse.NEGATE
+        chars = frozenset()
+        for item_op, item_value in items[negate:]:
+            if item_op is sre_parse.LITERAL:
+                chars |= {item_value}
+            elif item_op is sre_parse.RANGE:
+                chars |= frozenset(range(item_value[0], item_value[1] + 1))
+            elif item_op is sre_parse.CATEGORY and item_value in CATEGORY_CHARS:
+                chars |= CATEGORY_CHARS[item_value][0]
+            else:
+                return None
+        if negate:
+            return ALL_CHARS - (fold_case(chars) if flags & IGNORECASE else chars)
+    else:
+        return None
+    return fold_case(chars) if flags & IGNORECASE else chars
+
+
+def only_node_chars(nodes: Sequence, flags: int) -> Optional[frozenset[int]]:
+    """Bytes matched by nodes when they are a single node that matches exactly one byte, otherwise None."""
+    if len(nodes) != 1:
+        return None
+    op, value = nodes[0]
+    return node_chars(op, value, flags)
+
+
+def node_source(op, value) -> Optional[bytes]:
+    """Source of a single byte node to reuse in a lookbehind."""
+    if op is sre_parse.LITERAL:
+        return re_escape(bytes((value,)))
+    if op is sre_parse.NOT_LITERAL:
+        return b"[^" + re_escape(bytes((value,))) + b"]"
+    if op is sre_parse.ANY:
+        return b"."
+    if op is not sre_parse.IN:
+        return None
+    source = b"["
+    for item_op, item_value in value:
+        if item_op is sre_parse.NEGATE:
+            source += b"^"
+        elif item_op is sre_parse.LITERAL:
+            source += re_escape(bytes((item_value,)))
+        elif item_op is sre_parse.RANGE:
+            source += re_escape(bytes((item_value[0],))) + b"-" + re_escape(bytes((item_value[1],)))
+        elif item_op is sre_parse.CATEGORY and item_value in CATEGORY_CHARS:
+            source += CATEGORY_CHARS[item_value][1]
+        else:
+            return None
+    return source + b"]"
+
+
+def scoped_flags(value, flags: int) -> int:
+    _, add_flags, del_flags, _ = value
+    return (flags | add_flags) & ~del_flags
+
+
+def first_chars(nodes: Sequence, flags: int) -> tuple[frozenset[int], bool]:
+    """Bytes a match of nodes can start with and whether nodes can match the empty string."""
+    chars: frozenset[int] = frozenset()
+    for op, value in nodes:
+        if (single_chars := node_chars(op, value, flags)) is not None:
+            return chars | single_chars, False
+        if op in ZERO_WIDTH_OPS:
+            continue
+        if op in REPEAT_OPS:
+            repeat_chars, nullable = first_chars(value[2], flags)
+            chars |= repeat_chars
+            if value[0] and not nullable:
+                return chars, False
+        elif op is sre_parse.SUBPATTERN:
+            group_chars, nullable = first_chars(value[-1], scoped_flags(value, flags))
+            chars |= group_chars
+            if not nullable:
+                return chars, False
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            group_chars, nullable = first_chars(value, flags)
+            chars |= group_chars
+            if not nullable:
+                return chars, False
+        elif op is sre_parse.BRANCH:
+            branch_nullable = False
+            for branch in value[1]:
+                branch_chars, nullable = first_chars(branch, flags)
+                chars |= branch_chars
+                branch_nullable |= nullable
+            if not branch_nullable:
+                return chars, False
+        else:
+            # Backreferences, conditionals, etc.
+            return ALL_CHARS, False
+    return chars, True
+
+
+def is_unbounded_repeat(op, value) -> bool:
+    return op in REPEAT_OPS and value[1] is sre_parse.MAXREPEAT
+
+
+def find_backtracking(nodes: Sequence, flags: int, findings: list[tuple[str, str]]) -> None:
+    """
+    Add findings for repeats that can match the same text in many ways, which Python's backtracking re tries
+    one by one when a search fails:
+    - nested-quantifier: a repeat inside a repeat whose body can start over with what the inner repeat matches,
+      like (a+)+ or (\\w+\\s?)*. Failing searches take exponential time.
+    - overlapping-repeats: adjacent unbounded repeats that can match the same bytes, like \\w+\\d+ or .*.*,
+      with only optional nodes between them. Failing searches take polynomial time.
+    """
+    nodes = list(nodes)
+    for index, (op, value) in enumerate(nodes):
+        if op in REPEAT_OPS:
+            body = value[2]
+            if value[1] > 1:
+                find_nested_repeats(body, flags, findings)
+            find_backtracking(body, flags, findings)
+            if not is_unbounded_repeat(op, value) or (chars := repeat_chars(value, flags)) is None:
+                continue
+            for next_op, next_value in nodes[index + 1 :]:
+                if is_unbounded_repeat(next_op, next_value):
+                    if (next_chars := repeat_chars(next_value, flags)) is not None and chars & next_chars:
+                        findings.append(("overlapping-repeats", "Adjacent unbounded repeats can match the same bytes."))
+                    break
+                if not (next_op in ZERO_WIDTH_OPS or (next_op in REPEAT_OPS and not next_value[0])):
+                    break
+        elif op is sre_parse.SUBPATTERN:
+            find_backtracking(value[-1], scoped_flags(value, flags), findings)
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            # Atomic groups do not backtrack into themselves
+            continue
+        elif op is sre_parse.BRANCH:
+            for branch in value[1]:
+                find_backtracking(branch, flags, findings)
+
+
+def repeat_chars(value, flags: int) -> Optional[frozenset[int]]:
+    return only_node_chars(list(value[2]), flags)
+
+
+def find_nested_repeats(body: Sequence, flags: int, findings: list[tuple[str, str]]) -> None:
+    body = list(body)
+    start_chars, _ = first_chars(body, flags)
+    for index, (op, value) in enumerate(body):
+        if op is sre_parse.SUBPATTERN:
+            find_nested_repeats(value[-1], scoped_flags(value, flags), findings)
+            continue
+        if op not in REPEAT_OPS or value[1] <= 1:
+            continue
+        inner_chars, _ = first_chars(value[2], flags)
+        # What can follow one of the inner repeat's iterations: the rest of the body, then the next outer iteration
+        follow_chars, nullable = first_chars(body[index + 1 :], flags)
+        if nullable:
+            follow_chars |= start_chars
+        if inner_chars & follow_chars:
+            findings.append(("nested-quantifier", "Nested repeats can match the same text in exponentially many ways."))
+            return
+
+
+def has_group_references(nodes: Sequence) -> bool:
+    """True if nodes contain a backreference or a conditional on whether a group matched, like \\1 or (?(1)a|b)."""
+    for op, value in nodes:
+        if op is sre_parse.GROUPREF or op is sre_parse.GROUPREF_EXISTS:
+            return True
+        for item in value if isinstance(value, (tuple, list)) else (value,):
+            if isinstance(item, sre_parse.SubPattern) and has_group_references(item):
+                return True
+            if isinstance(item, list) and any(
+                isinstance(branch, sre_parse.SubPattern) and has_group_references(branch) for branch in item
+            ):
+                return True
+    return False
+
+
+def leading_repeat(nodes: Sequence, flags: int) -> Optional[tuple[Any, Any, int]]:
+    """The first node of a pattern when it is a repeat of a single byte, entering groups without scoped flags."""
+    nodes = list(nodes)
+    if not nodes:
+        return None
+    op, value = nodes[0]
+    if op is sre_parse.SUBPATTERN and not value[1] and not value[2]:
+        return leading_repeat(value[-1], flags)
+    if op in REPEAT_OPS and only_node_chars(value[2], flags) is not None:
+        return op, value, flags
+    return None
+
+
+def rewrite_leading_repeat(pattern: Pattern, parsed) -> tuple[Optional[tuple[str, str]], Optional[bytes]]:
+    """
+    A search for a pattern starting with an unbounded repeat of a byte class, like [a-z0-9.-]+\\.s3\\.amazonaws\\.com,
+    tries every position of a long run of the class and rescans the rest of the run from each. The leftmost match
+    always starts at the start of a run, so guarding the repeat with (?<!class) finds the same first match in linear
+    time. Searches that continue from the end of a match (finditer) can start inside a run, so only use the rewritten
+    pattern for first matches. Patterns with backreferences or conditionals are not rewritten since what the repeat
+    captures changes with where the match starts, e.g. ([a-z]+)=\\1 only matches ab=ab inside xab=ab.
+    Leading bounded windows like .{0,40} are searched at every position too, but dropping them can change which of
+    several matches on a line is found, and Python lookbehinds must be fixed width, so they are only reported.
+    """
+    if (leading := leading_repeat(parsed, parsed.state.flags)) is None:
+        return None, None
+    op, value, flags = leading
+    if value[1] is not sre_parse.MAXREPEAT:
+        if not value[0]:
+            return ("leading-window", "Leading bounded window is tried at every position of a line."), None
+        return None, None
+    if flags & VERBOSE or has_group_references(parsed) or (class_source := node_source(*value[2][0])) is None:
+        return ("unanchored-leading-repeat", "Leading unbounded repeat is rescanned from every position."), None
+
+    rewritten = b"(?<!" + class_source + b")" + pattern.pattern
+    try:
+        re_compile(rewritten, pattern.flags)
+    except (re_error, RecursionError, OverflowError):
+        return ("unanchored-leading-repeat", "Leading unbounded repeat is rescanned from every position."), None
+    return (
+        "rewritten",
+        f"Leading unbounded repeat guarded with (?<!{class_source.decode(errors='replace')}).",
+    ), rewritten
+
+
+def lint_pattern(pattern: Pattern) -> tuple[list[tuple[str, str]], Optional[bytes]]:
+    """Findings (kind, message) for pattern and the source of an equivalent faster pattern or None."""
+    if not isinstance(pattern.pattern, bytes) or pattern.flags & LOCALE:
+        return [], None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return [], None
+
+    findings: list[tuple[str, str]] = []
+    find_backtracking(parsed, parsed.state.flags, findings)
+    finding, rewritten = rewrite_leading_repeat(pattern, parsed)
+    if finding is not None:
+        findings.append(finding)
+    return list(dict.fromkeys(findings)), rewritten
+
+
+def linear_form(nodes: Sequence, flags: int, skip_assertions: bool) -> Optional[tuple[Atom, ...]]:
+    """
+    Pattern as a sequence of byte class atoms with repeat counts, or None if it has branches, repeated groups, etc.
+    Assertions are skipped when skip_assertions is True, which only makes the pattern match more.
+    """
+    atoms: list[Atom] = []
+    for op, value in nodes:
+        if (chars := node_chars(op, value, flags)) is not None:
+            atoms.append((chars, 1, 1))
+        elif op in REPEAT_OPS and (chars := only_node_chars(value[2], flags)) is not None:
+            if value[0] == value[1] <= MAX_EXPANDED_ATOMS:
+                atoms.extend([(chars, 1, 1)] * value[0])
+            else:
+                atoms.append((chars, value[0], value[1]))
+        elif op is sre_parse.SUBPATTERN:
+            if (group_atoms := linear_form(value[-1], scoped_flags(value, flags), skip_assertions)) is None:
+                return None
+            atoms.extend(group_atoms)
+        elif op in ZERO_WIDTH_OPS and skip_assertions:
+            continue
+        else:
+            return None
+    return tuple(atoms)
+
+
+def atom_contains(outer: Atom, inner: Atom) -> bool:
+    return inner[0] <= outer[0] and outer[1] <= inner[1] and inner[2] <= outer[2]
+
+
+def contains_window(outer: tuple[Atom, ...], inner: tuple[Atom, ...]) -> bool:
+    """True if outer matches the text of some run of inner's atoms, so every line inner matches, outer matches."""
+    for start in range(len(inner) - len(outer) + 1):
+        end = start + len(outer)
+        if all(atom_contains(outer_atom, inner_atom) for outer_atom, inner_atom in zip(outer, inner[start:end])):
+            return True
+    return False
+
+
+class LocatorLint:
+    """
+    Load time analysis of locator patterns by their index in SecretScanner.secret_locators.
+    - findings: backtracking risks and rewrites of each pattern (see find_backtracking and rewrite_leading_repeat)
+    - rewrites: sources of faster patterns that find the same first match
+    - duplicates: (index, index of an earlier pattern with the same parsed form, flags, and secret group)
+    - subsumed: (index, index of a pattern that matches every line it matches). Only patterns that are a sequence
+      of bytes and repeated byte classes are compared. Duplicates are not also reported as subsumed.
+
+    The analysis can be saved with get_state and restored by passing state.
+    """
+
+    def __init__(
+        self,
+        patterns: Iterable[Pattern],
+        secret_groups: Optional[Iterable[int | str]] = None,
+        state: Optional[tuple] = None,
+    ) -> None:
+        self.patterns = list(patterns)
+        self.secret_groups = list(secret_groups) if secret_groups is not None else [0] * len(self.patterns)
+        self.findings: dict[int, list[tuple[str, str]]] = {}
+        self.rewrites: dict[int, bytes] = {}
+        self.duplicates: list[tuple[int, int]] = []
+        self.subsumed: list[tuple[int, int]] = []
+        if state is not None:
+            self.set_state(state)
+        else:
+            self.build()
+
+    def get_state(self) -> tuple:
+        findings = {index: [list(finding) for finding in findings] for index, findings in self.findings.items()}
+        return findings, self.rewrites, self.duplicates, self.subsumed
+
+    def set_state(self, state: tuple) -> None:
+        findings, self.rewrites, duplicates, subsumed = state
+        self.findings = {index: [tuple(finding) for finding in findings] for index, findings in findings.items()}
+        self.duplicates = [tuple(pair) for pair in duplicates]  # type: ignore
+        self.subsumed = [tuple(pair) for pair in subsumed]  # type: ignore
+
+    def build(self) -> None:
+        parsed_keys: dict[tuple, int] = {}
+        # Linear forms as the subsuming (no assertions) and subsumed (assertions skipped) side of a comparison
+        outer_forms: dict[int, tuple[Atom, ...]] = {}
+        inner_forms: dict[int, tuple[Atom, ...]] = {}
+        for index, pattern in enumerate(self.patterns):
+            findings, rewritten = lint_pattern(pattern)
+            if findings:
+                self.findings[index] = findings
+            if rewritten is not None:
+                self.rewrites[index] = rewritten
+            try:
+                parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+            except Exception:
+                continue
+
+            parsed_key = (repr(parsed.data), parsed.state.flags, self.secret_groups[index])
+            if (original_index := parsed_keys.get(parsed_key)) is not None:
+                self.duplicates.append((index, original_index))
+                continue
+            parsed_keys[parsed_key] = index
+            if (outer_form := linear_form(parsed, parsed.state.flags, skip_assertions=False)) is not None:
+                outer_forms[index] = outer_form
+            if (inner_form := linear_form(parsed, parsed.state.flags, skip_assertions=True)) is not None:
+                inner_forms[index] = inner_form
+        self.find_subsumed(outer_forms, inner_forms)
+
+    def find_subsumed(self, outer_forms: dict[int, tuple[Atom, ...]], inner_forms: dict[int, tuple[Atom, ...]]) -> None:
+        # Index inner forms by the single bytes they require so each outer form with a literal byte is only
+        # compared with the inner forms containing that byte
+        by_literal: dict[int, set[int]] = {}
+        for index, inner_form in inner_forms.items():
+            for chars, min_count, _ in inner_form:
+                if min_count and len(chars) == 1:
+                    by_literal.setdefault(next(iter(chars)), set()).add(index)
+
+        for outer_index, outer_form in outer_forms.items():
+            if not outer_form:
+                continue
+            candidates: Iterable[int] = inner_forms
+            literal_candidates: list[set[int]] = [
+                by_literal.get(next(iter(chars)), set())
+                for chars, min_count, _ in outer_form
+                if min_count and len(chars) == 1
+            ]
+            if literal_candidates:
+                fewest_candidates = min(literal_candidates, key=len)
+                candidates = fewest_candidates
+            for inner_index in candidates:
+                if inner_index == outer_index or len(inner_forms[inner_index]) < len(outer_form):
+                    continue
+                if contains_window(outer_form, inner_forms[inner_index]):
+                    self.subsumed.append((inner_index, outer_index))
+        self.subsumed.sort()
+
+    def num_findings(self, kind: str) -> int:
+        return sum(1 for findings in self.findings.values() if any(finding[0] == kind for finding in findings))
+
+    def __repr__(self) -> str:
+        return f"LocatorLint(patterns={len(self.patterns)}, rewritten={len(self.rewrites)}, nested_quantifiers={self.num_findings('nested-quantifier')}, overlapping_repeats={self.num_findings('overlapping-repeats')}, leading_windows={self.num_findings('leading-window')}, duplicates={len(self.duplicates)}, subsumed={len(self.subsumed)})"
@@ -0,0 +1,468 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, Sequence
+from time import perf_counter
+from heapq import merge as heap_merge
+from mmap import mmap
+from re import compile as re_compile, error as re_error, Pattern, IGNORECASE, MULTILINE, DOTALL
+
+try:
+    # Private regex parser module was renamed in python 3.11
+    from re import _parser as sre_parse  # type: ignore
+except ImportError:
+    import sre_parse  # type: ignore
+
+if TYPE_CHECKING:
+    # matcher_backend imports this module to build the patterns it compiles
+    from .matcher_backend import MatcherBackend, PatternDatabase
+
+# Bump when chunking, keyword extraction, or the saved state change so cached matchers and prefilters are not reused
+MATCHER_CACHE_VERSION = 1
+
+# Inline flags that can be scoped to a single alternative with (?flags:...)
+SCOPED_FLAGS = ((IGNORECASE, "i"), (MULTILINE, "m"), (DOTALL, "s"))
+SCOPABLE_FLAGS_MASK = IGNORECASE | MULTILINE | DOTALL
+
+# Numbered backreferences and conditionals would silently refer to the wrong group once combined
+NUMBERED_GROUP_REFERENCE = re_compile(rb"\\[1-9]|\\g<\d+>|\(\?\(\d+\)")
+# Gates search whole buffers in MULTILINE mode so ^ and $ still match at every line boundary. Assertions
+# that can match at a line boundary but not inside a larger buffer cannot be gated without false negatives.
+LINE_CONTEXT_ASSERTION = re_compile(rb"\\[AZB]|\(\?<!|\(\?!")
+# A leading negative lookbehind of one byte, like the guards added by locator_lint.rewrite_leading_repeat. Safe to
+# gate when the byte can never be a newline, since the start of a line is preceded by one in a larger buffer.
+LEADING_GUARD = re_compile(rb"\(\?<!(\[(?:\\.|[^\]\\])+\]|\\.|[^\\()\[])\)")
+
+# Alternations of many patterns lose the literal prefix scan re uses to skip ahead in a single pattern,
+# so with the stdlib re engine gating each pattern on its own measured fastest.
+DEFAULT_CHUNK_SIZE = 1
+
+# Keywords shorter than this match too often to be worth filtering on
+MIN_KEYWORD_LENGTH = 3
+# Limits on the sets of alternative literals expanded from classes, branches and repeats
+MAX_LITERAL_ALTERNATIVES = 16
+MAX_CLASS_SIZE = 4
+MAX_EXPANDED_REPEAT = 2
+# Keywords longer than this are rare enough that fewer alternatives matter more than more length
+MAX_USEFUL_KEYWORD_LENGTH = 6
+# Memory-mapped buffers are lowercased this many bytes at a time so the whole file is never copied into memory
+PREFILTER_CHUNK_SIZE = 1 << 20
+
+
+def make_combinable_fragment(pattern: Pattern) -> Optional[bytes]:
+    """Return pattern wrapped so it can be an alternative in a combined pattern, or None if it cannot be combined."""
+    if not isinstance(pattern.pattern, bytes) or pattern.flags & ~SCOPABLE_FLAGS_MASK:
+        return None
+    if NUMBERED_GROUP_REFERENCE.search(pattern.pattern) or LINE_CONTEXT_ASSERTION.search(strip_guard(pattern)):
+        return None
+
+    scoped_flags = "".join(flag_char for flag, flag_char in SCOPED_FLAGS if (pattern.flags | MULTILINE) & flag)
+    return b"(?" + scoped_flags.encode() + b":" + pattern.pattern + b")"
+
+
+def strip_guard(pattern: Pattern) -> bytes:
+    """Pattern source without a leading guard that cannot match a newline. See LEADING_GUARD."""
+    if not (guard := LEADING_GUARD.match(pattern.pattern)):
+        return pattern.pattern
+    try:
+        if re_compile(guard.group(1), pattern.flags).fullmatch(b"\n"):
+            return pattern.pattern
+    except re_error:
+        return pattern.pattern
+    return pattern.pattern[guard.end() :]
+
+
+def try_compile_alternation(fragments: list[bytes]) -> Optional[Pattern]:
+    try:
+        return re_compile(b"|".join(fragments))
+    except (re_error, RecursionError, OverflowError):
+        return None
+
+
+# Literal sets for a parsed regex node: (exact, prefixes, suffixes, required). exact is every string the node can
+# match when that set is small and finite, otherwise None. Every match starts with one of prefixes and ends with one
+# of suffixes ({b""} when unknown). required is a set of literals at least one of which appears in any match or None.
+NodeLiterals = tuple[Optional[set[bytes]], set[bytes], set[bytes], Optional[set[bytes]]]
+UNKNOWN_LITERALS: NodeLiterals = (None, {b""}, {b""}, None)
+EMPTY_LITERALS: NodeLiterals = ({b""}, {b""}, {b""}, None)
+
+
+def literal_set_score(literals: Optional[set[bytes]]) -> tuple[int, int]:
+    """
+    Higher scores filter better. Prefer sets whose shortest literal is longest, up to a length where
+    literals are already rare, then prefer smaller sets since each literal costs a pass over the data.
+    """
+    if not literals:
+        return (0, 0)
+    return (min(min(map(len, literals)), MAX_USEFUL_KEYWORD_LENGTH), -len(literals))
+
+
+def best_literal_set(*literal_sets: Optional[set[bytes]]) -> Optional[set[bytes]]:
+    best = max(literal_sets, key=literal_set_score, default=None)
+    return best if literal_set_score(best)[0] else None
+
+
+def concat_literal_sets(prefixes: set[bytes], suffixes: set[bytes]) -> Optional[set[bytes]]:
+    if len(prefixes) * len(suffixes) > MAX_LITERAL_ALTERNATIVES:
+        return None
+    return {prefix + suffix for prefix in prefixes for suffix in suffixes}
+
+
+def union_literal_sets(literal_sets: Iterable[Optional[set[bytes]]]) -> Optional[set[bytes]]:
+    union: set[bytes] = set()
+    for literal_set in literal_sets:
+        if literal_set is None or len(union := union | literal_set) > MAX_LITERAL_ALTERNATIVES:
+            return None
+    return union
+
+
+def analyze_class(items: list) -> NodeLiterals:
+    chars: set[bytes] = set()
+    for op, value in items:
+        if op is sre_parse.LITERAL:
+            chars.add(bytes((value,)).lower())
+        elif op is sre_parse.RANGE and value[1] - value[0] < MAX_CLASS_SIZE * 2:
+            chars.update(bytes((char,)).lower() for char in range(value[0], value[1] + 1))
+        else:
+            # NEGATE, CATEGORY or large ranges
+            return UNKNOWN_LITERALS
+        if len(chars) > MAX_CLASS_SIZE:
+            return UNKNOWN_LITERALS
+    return chars, chars, chars, None
+
+
+def analyze_branch(branches: list) -> NodeLiterals:
+    branch_literals = [analyze_sequence(branch) for branch in branches]
+    exact = union_literal_sets(literals[0] for literals in branch_literals)
+    prefixes = union_literal_sets(literals[1] for literals in branch_literals) or {b""}
+    suffixes = union_literal_sets(literals[2] for literals in branch_literals) or {b""}
+    required = union_literal_sets(best_literal_set(*literals) for literals in branch_literals)
+    if exact is not None:
+        return exact, exact, exact, best_literal_set(required, exact)
+    return None, prefixes, suffixes, required
+
+
+def analyze_repeat(min_count: int, max_count: int, subpattern: Sequence) -> NodeLiterals:
+    exact, prefixes, suffixes, required = analyze_sequence(subpattern)
+    if not min_count:
+        prefixes, suffixes, required = {b""}, {b""}, None
+    if exact is None or max_count > MAX_EXPANDED_REPEAT:
+        return None, prefixes, suffixes, required
+
+    repeated: Optional[set[bytes]] = {b""}
+    expanded: Optional[set[bytes]] = set()
+    for count in range(max_count + 1):
+        if repeated is None or expanded is None:
+            return None, prefixes, suffixes, required
+        if count >= min_count:
+            expanded = union_literal_sets((expanded, repeated))
+        repeated = concat_literal_sets(repeated, exact)
+    if expanded is None:
+        return None, prefixes, suffixes, required
+    return expanded, expanded, expanded, best_literal_set(required, expanded)
+
+
+def analyze_node(op, value) -> NodeLiterals:
+    if op is sre_parse.LITERAL:
+        literal = {bytes((value,)).lower()}
+        return literal, literal, literal, None
+    if op is sre_parse.IN:
+        return analyze_class(value)
+    if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        # Zero-width so matches nothing the surrounding literals need to account for
+        return EMPTY_LITERALS
+    if op is sre_parse.SUBPATTERN:
+        return analyze_sequence(value[-1])
+    if op is getattr(sre_parse, "ATOMIC_GROUP", None):
+        return analyze_sequence(value)
+    if op is sre_parse.BRANCH:
+        return analyze_branch(value[1])
+    if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)):
+        return analyze_repeat(*value)
+    # ANY, NOT_LITERAL, CATEGORY, GROUPREF, etc.
+    return UNKNOWN_LITERALS
+
+
+def analyze_sequence(nodes: Sequence) -> NodeLiterals:
+    # run is every string the nodes since the last unknown node can match. single_run is the same for the nodes since
+    # the last node with alternatives, which keeps literals like "key" in "api[_-]?key" as a candidate on their own.
+    run, single_run = {b""}, b""
+    prefixes: Optional[set[bytes]] = None
+    candidates: list[Optional[set[bytes]]] = []
+    for op, value in nodes:
+        exact, node_prefixes, node_suffixes, required = analyze_node(op, value)
+        candidates.append(required)
+        if exact is not None and len(exact) == 1:
+            single_run += next(iter(exact))
+        else:
+            candidates.append({single_run + next(iter(node_prefixes))} if len(node_prefixes) == 1 else {single_run})
+            single_run = next(iter(node_suffixes)) if exact is None and len(node_suffixes) == 1 else b""
+
+        if exact is not None and (extended_run := concat_literal_sets(run, exact)) is not None:
+            run = extended_run
+            continue
+
+        # Literal run ends here. It is joined with the start of the node when possible.
+        ended_run = concat_literal_sets(run, node_prefixes) if exact is None else None
+        candidates.append(ended_run or run)
+        if prefixes is None:
+            prefixes = ended_run or run
+        run = node_suffixes if exact is None else exact
+
+    candidates.extend((run, {single_run}))
+    if prefixes is None:
+        return run, run, run, best_literal_set(*candidates)
+    return None, prefixes, run, best_literal_set(*candidates)
+
+
+def extract_required_literals(pattern: Pattern, min_length: int = MIN_KEYWORD_LENGTH) -> Optional[set[bytes]]:
+    """
+    Return lowercase literals at least one of which appears in any match of pattern (ignoring case),
+    or None if no literals of at least min_length are required.
+    """
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    literals = best_literal_set(*analyze_sequence(list(parsed)))
+    if not literals or min(map(len, literals)) < min_length:
+        return None
+    return literals
+
+
+class KeywordPrefilter:
+    """
+    Index of keywords (literal substrings any match requires) to the patterns requiring them, extracted from the
+    patterns themselves or given explicitly such as gitleaks keywords. One substring check per distinct keyword
+    over a lowercased buffer decides which patterns are worth running at all.
+
+    The index can be saved with get_state and restored by passing state to skip extracting keywords again.
+    """
+
+    def __init__(
+        self,
+        patterns: Iterable[Pattern],
+        keywords: Optional[Iterable[Optional[Iterable[str]]]] = None,
+        min_keyword_length: int = MIN_KEYWORD_LENGTH,
+        state: Optional[tuple] = None,
+    ) -> None:
+        self.patterns = list(patterns)
+        self.min_keyword_length = min_keyword_length
+        self.keyword_index: dict[bytes, list[int]] = {}
+        self.unfiltered: list[int] = []
+        if state is not None:
+            self.keyword_index, self.unfiltered = state
+        else:
+            self.build(keywords)
+
+    def build(self, keywords: Optional[Iterable[Optional[Iterable[str]]]] = None) -> None:
+        min_keyword_length = self.min_keyword_length
+        explicit_keywords = list(keywords) if keywords is not None else [None] * len(self.patterns)
+        for index, (pattern, pattern_keywords) in enumerate(zip(self.patterns, explicit_keywords)):
+            literals = extract_required_literals(pattern, min_keyword_length)
+            if pattern_keywords:
+                given = {keyword.lower().encode() for keyword in pattern_keywords}
+                if all(len(keyword) >= min_keyword_length for keyword in given):
+                    literals = best_literal_set(literals, given)
+            if not literals:
+                self.unfiltered.append(index)
+                continue
+            for literal in literals:
+                self.keyword_index.setdefault(literal, []).append(index)
+
+    def get_state(self) -> tuple:
+        return self.keyword_index, self.unfiltered
+
+    def candidate_set(self, data: bytes | mmap) -> set[int]:
+        """Return indices of patterns which may match data."""
+        candidates = set(self.unfiltered)
+        if isinstance(data, bytes):
+            lowered_data = data.lower()
+            for keyword, indices in self.keyword_index.items():
+                if keyword in lowered_data:
+                    candidates.update(indices)
+            return candidates
+
+        pending_keywords = dict(self.keyword_index)
+        for lowered_chunk in self.iter_lowered_chunks(data):
+            for keyword in [keyword for keyword in pending_keywords if keyword in lowered_chunk]:
+                candidates.update(pending_keywords.pop(keyword))
+            if not pending_keywords:
+                break
+        return candidates
+
+    def iter_lowered_chunks(self, data: mmap, chunk_size: int = PREFILTER_CHUNK_SIZE) -> Iterator[bytes]:
+        """Lowercased chunks of data overlapping by one byte less than the longest keyword so none are split."""
+        overlap = max(map(len, self.keyword_index), default=1) - 1
+        for start in range(0, len(data), chunk_size):
+            yield data[start : start + chunk_size + overlap].lower()
+
+    def __repr__(self) -> str:
+        return f"KeywordPrefilter(patterns={len(self.patterns)}, keywords={len(self.keyword_index)}, unfiltered={len(self.unfiltered)})"
+
+
+class CombinedLocatorMatcher:
+    """
+    Gates locator patterns with combined alternations of chunk_size patterns so a single search over
+    a whole buffer decides whether any locator in a chunk can match. Only the locators in chunks that
+    hit are returned as candidates to re-run their own pattern line by line, which keeps results
+    identical to searching every line with every locator pattern. A chunk_size of 0 disables gating.
+
+    When a KeywordPrefilter is given, locators whose keywords are not in the buffer are never
+    candidates and chunks without any remaining locators are not searched at all.
+
+    When a MatcherBackend is given, the patterns it can compile into a database are gated by one search of the
+    database instead, and only the rest are chunked.
+
+    The chunks can be saved with get_state and restored by passing state to skip finding which patterns
+    can be combined again. The combined patterns and database still need to be compiled.
+    """
+
+    def __init__(
+        self,
+        patterns: Iterable[Pattern],
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        prefilter: Optional[KeywordPrefilter] = None,
+        state: Optional[tuple] = None,
+        backend: Optional["MatcherBackend"] = None,
+    ) -> None:
+        self.patterns = list(patterns)
+        self.chunk_size = max(0, chunk_size)
+        self.prefilter = prefilter
+        self.backend = backend
+        # Each chunk is (combined gate pattern or None, indices of patterns gated by it)
+        self.chunks: list[tuple[Optional[Pattern], list[int]]] = []
+        self.num_combined = 0
+        self.num_standalone = 0
+        # Indices of patterns gated by database. Any the database no longer covers when it is compiled again from
+        # state are always candidates.
+        self.database: Optional["PatternDatabase"] = None
+        self.database_indices: list[int] = []
+        self.ungated_indices: list[int] = []
+        if state is not None:
+            self.set_state(state)
+        else:
+            self.build()
+
+    def get_state(self) -> tuple:
+        chunk_sources = [(gate.pattern if gate is not None else None, indices) for gate, indices in self.chunks]
+        return chunk_sources, self.num_combined, self.num_standalone, self.database_indices
+
+    def set_state(self, state: tuple) -> None:
+        chunk_sources, self.num_combined, self.num_standalone, database_indices = state
+        self.chunks = [
+            (re_compile(gate_source) if gate_source is not None else None, indices)
+            for gate_source, indices in chunk_sources
+        ]
+        self.compile_database(database_indices)
+
+    def compile_database(self, database_indices: Optional[list[int]] = None) -> None:
+        """Compile the database of the patterns at database_indices, or of every pattern the backend can compile."""
+        self.database = None
+        if self.backend is not None and (database_indices is None or database_indices):
+            self.database = self.backend.compile_database(self.patterns, database_indices)
+        covered = self.database.indices if self.database is not None else []
+        self.database_indices = database_indices if database_indices is not None else list(covered)
+        covered_set = set(covered)
+        self.ungated_indices = [index for index in self.database_indices if index not in covered_set]
+
+    def build(self) -> None:
+        self.chunks.clear()
+        self.num_combined = self.num_standalone = 0
+        if not self.chunk_size:
+            self.compile_database([])
+            self.chunks.append((None, list(range(len(self.patterns)))))
+            self.num_standalone = len(self.patterns)
+            return
+
+        self.compile_database()
+        database_indices = set(self.database_indices)
+        pending_indices: list[int] = []
+        pending_fragments: list[bytes] = []
+
+        for index, pattern in enumerate(self.patterns):
+            if index in database_indices:
+                continue
+            if (fragment := make_combinable_fragment(pattern)) is None:
+                # Flush pending so candidates are still yielded in the original locator order
+                self.add_chunk(pending_indices, pending_fragments)
+                pending_indices, pending_fragments = [], []
+                self.chunks.append((None, [index]))
+                self.num_standalone += 1
+                continue
+
+            pending_indices.append(index)
+            pending_fragments.append(fragment)
+            if len(pending_indices) >= self.chunk_size:
+                self.add_chunk(pending_indices, pending_fragments)
+                pending_indices, pending_fragments = [], []
+
+        self.add_chunk(pending_indices, pending_fragments)
+
+    def add_chunk(self, indices: list[int], fragments: list[bytes]) -> None:
+        if not indices:
+            return
+        if (gate := try_compile_alternation(fragments)) is not None:
+            self.chunks.append((gate, indices))
+            self.num_combined += len(indices)
+            return
+        if len(indices) == 1:
+            self.chunks.append((None, indices))
+            self.num_standalone += 1
+            return
+
+        # Bisect until the fragments that break the combined pattern (e.g. duplicate group names) are isolated
+        middle = len(indices) // 2
+        self.add_chunk(indices[:middle], fragments[:middle])
+        self.add_chunk(indices[middle:], fragments[middle:])
+
+    def iter_candidates(
+        self, data: bytes | mmap, gate_timer: Optional[Callable[[list[int], float], None]] = None
+    ) -> Iterator[int]:
+        """
+        Yield indices of patterns that may match data in their original order.
+        gate_timer is called with the indices of each chunk, or of the database, and the seconds its gate took to
+        search data.
+        """
+        prefiltered = self.prefilter.candidate_set(data) if self.prefilter is not None else None
+        chunk_candidates = self.iter_chunk_candidates(data, prefiltered, gate_timer)
+        if not self.database_indices:
+            yield from chunk_candidates
+            return
+
+        database_candidates = list(self.ungated_indices)
+        if self.database is not None:
+            start = perf_counter()
+            database_candidates.extend(self.database.search(data))
+            if gate_timer is not None:
+                gate_timer(self.database.indices, perf_counter() - start)
+        if prefiltered is not None:
+            database_candidates = [index for index in database_candidates if index in prefiltered]
+        # Chunks yield indices in ascending order, so merging keeps the original order
+        yield from heap_merge(chunk_candidates, sorted(database_candidates))
+
+    def iter_chunk_candidates(
+        self,
+        data: bytes | mmap,
+        prefiltered: Optional[set[int]],
+        gate_timer: Optional[Callable[[list[int], float], None]],
+    ) -> Iterator[int]:
+        for gate, indices in self.chunks:
+            if prefiltered is not None and not (indices := [index for index in indices if index in prefiltered]):
+                continue
+            if gate is None:
+                yield from indices
+            elif gate_timer is not None:
+                start = perf_counter()
+                hit = gate.search(data)
+                gate_timer(indices, perf_counter() - start)
+                if hit:
+                    yield from indices
+            elif gate.search(data):
+                yield from indices
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def __repr__(self) -> str:
+        return f"CombinedLocatorMatcher(patterns={len(self.patterns)}, chunks={len(self.chunks)}, combined={self.num_combined}, standalone={self.num_standalone}, database={len(self.database_indices) - len(self.ungated_indices)}, backend={self.backend}, prefilter={self.prefilter})"
@@ -0,0 +1,175 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from pathlib import Path
+from csv import DictWriter
+from dataclasses import dataclass
+from json import dump as json_dump
+from threading import Lock
+from time import perf_counter
+from typing import Optional, Iterator, Sequence, Protocol, Callable
+
+# Fields of each row of the profile report in order
+PROFILE_FIELDS = [
+    "rank",
+    "locator_id",
+    "locator",
+    "calls",
+    "matches",
+    "total_seconds",
+    "gate_seconds",
+    "mean_microseconds",
+    "max_milliseconds",
+    "worst_location",
+    "quarantined",
+]
+
+
+class NamedLocator(Protocol):
+    id: str
+    name: str
+
+
+@dataclass(slots=True)
+class LocatorStats:
+    """Time spent by one locator. A call is one search of its pattern, a line in line mode or a buffer in mmap mode."""
+
+    calls: int = 0
+    matches: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    # Time spent searching whole files with the combined gate patterns (see CombinedLocatorMatcher)
+    gate_time: float = 0.0
+    worst_file: str = ""
+    worst_line: int = 0
+
+    def add(self, elapsed: float, matched: bool, line_number: int) -> None:
+        self.calls += 1
+        self.matches += matched
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+            self.worst_line = line_number
+
+    def merge(self, other: "LocatorStats") -> None:
+        self.calls += other.calls
+        self.matches += other.matches
+        self.total_time += other.total_time
+        self.gate_time += other.gate_time
+        if other.max_time > self.max_time:
+            self.max_time, self.worst_file, self.worst_line = other.max_time, other.worst_file, other.worst_line
+
+
+class LocatorProfiler:
+    """
+    Total time, calls, matches, and worst case time of each locator by its index in SecretScanner.secret_locators.
+    Scans add the stats of each file with add_file_stats. Worker processes send their stats to the main process with
+    drain and merge. When time_budget is set, locators with a single call slower than time_budget seconds are
+    quarantined and no longer used. Each worker process quarantines locators on its own. Searches are timed with clock.
+    """
+
+    def __init__(self, time_budget: Optional[float] = None, clock: Callable[[], float] = perf_counter) -> None:
+        self.time_budget = time_budget
+        self.clock = clock
+        self.stats: dict[int, LocatorStats] = {}
+        self.quarantined: set[int] = set()
+        self.lock = Lock()
+
+    def is_over_budget(self, elapsed: float) -> bool:
+        return self.time_budget is not None and elapsed > self.time_budget
+
+    def quarantine(self, locator_index: int) -> None:
+        self.quarantined.add(locator_index)
+
+    def gate_timer(self, file_stats: dict[int, LocatorStats]):
+        """Callback for CombinedLocatorMatcher.iter_candidates splitting each gate search between its locators."""
+
+        def add_gate_time(indices: list[int], elapsed: float) -> None:
+            for index in indices:
+                if (stats := file_stats.get(index)) is None:
+                    stats = file_stats[index] = LocatorStats()
+                stats.gate_time += elapsed / len(indices)
+
+        return add_gate_time
+
+    def add_file_stats(self, file_path: Path, file_stats: dict[int, LocatorStats]) -> None:
+        worst_file = str(file_path)
+        with self.lock:
+            for index, stats in file_stats.items():
+                stats.worst_file = worst_file
+                if (total_stats := self.stats.get(index)) is None:
+                    self.stats[index] = stats
+                else:
+                    total_stats.merge(stats)
+
+    def drain(self) -> tuple[dict[int, LocatorStats], set[int]]:
+        """Stats since the last drain and all quarantined locators, for sending from a worker process."""
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats, set(self.quarantined)
+
+    def merge(self, drained: tuple[dict[int, LocatorStats], set[int]]) -> None:
+        stats, quarantined = drained
+        with self.lock:
+            for index, locator_stats in stats.items():
+                if (total_stats := self.stats.get(index)) is None:
+                    self.stats[index] = locator_stats
+                else:
+                    total_stats.merge(locator_stats)
+        self.quarantined.update(quarantined)
+
+    def iter_report(self, locators: Sequence[NamedLocator]) -> Iterator[dict[str, str | int | float | bool]]:
+        """Rows of PROFILE_FIELDS for each profiled locator, slowest first."""
+        ranked = sorted(self.stats.items(), key=lambda item: item[1].total_time + item[1].gate_time, reverse=True)
+        for rank, (index, stats) in enumerate(ranked, start=1):
+            locator = locators[index]
+            yield {
+                "rank": rank,
+                "locator_id": locator.id,
+                "locator": locator.name,
+                "calls": stats.calls,
+                "matches": stats.matches,
+                "total_seconds": round(stats.total_time, 6),
+                "gate_seconds": round(stats.gate_time, 6),
+                "mean_microseconds": round(stats.total_time / stats.calls * 1e6, 3) if stats.calls else 0.0,
+                "max_milliseconds": round(stats.max_time * 1e3, 3),
+                "worst_location": f"{stats.worst_file}:{stats.worst_line}" if stats.worst_file else "",
+                "quarantined": index in self.quarantined,
+            }
+
+    def format_report(self, locators: Sequence[NamedLocator], limit: int = 20) -> str:
+        lines = [f"Slowest {min(limit, len(self.stats))} of {len(self.stats)} profiled locators:"]
+        for row in self.iter_report(locators):
+            if row["rank"] > limit:  # type: ignore
+                break
+            quarantined = " \033[91mQUARANTINED\033[0m" if row["quarantined"] else ""
+            lines.append(
+                f"{row['rank']:>3}. {row['locator_id']}: total {row['total_seconds']}s gate {row['gate_seconds']}s "
+                f"calls {row['calls']} matches {row['matches']} mean {row['mean_microseconds']}us "
+                f"max {row['max_milliseconds']}ms at {row['worst_location']}{quarantined}"
+            )
+        if self.quarantined:
+            lines.append(f"Quarantined {len(self.quarantined)} locators over the {self.time_budget}s time budget.")
+        return "\n".join(lines)
+
+    def write_report(self, report_path: Path, locators: Sequence[NamedLocator]) -> None:
+        """Write the report as CSV when report_path ends with .csv otherwise as a JSON list."""
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        with report_path.open("w", newline="") as f:
+            if report_path.suffix.lower() == ".csv":
+                csv_writer = DictWriter(f, fieldnames=PROFILE_FIELDS)
+                csv_writer.writeheader()
+                csv_writer.writerows(self.iter_report(locators))
+            else:
+                json_dump(list(self.iter_report(locators)), f, indent=4)
+
+    def __getstate__(self) -> dict:
+        # Locks cannot be pickled
+        return {key: value for key, value in self.__dict__.items() if key != "lock"}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def __repr__(self) -> str:
+        return f"LocatorProfiler(profiled={len(self.stats)}, quarantined={len(self.quarantined)}, time_budget={self.time_budget})"
@@ -7,6 +7,8 @@ from pathlib import Path
 from .apkscan import APKScanner
 from .secret_scanner import INCLUDED_SECRET_LOCATOR_FILES
 from .decompiler import DEFAULT_CONFIG
+from .locator_cache import DEFAULT_LOCATOR_CACHE_DIR
+from .result_cache import DEFAULT_RESULT_CACHE_PATH
 
 DEFAULT_RULES = [
     INCLUDED_SECRET_LOCATOR_FILES['default']
@@ -46,8 +48,9 @@ def main():
 
     output_options = parser.add_argument_group("Output Options")
     output_options.add_argument("-o", "--output", type=Path, metavar="SECRETS_OUTPUT_FILE", default="secrets_output.json", help="Output file for secrets found.")
-    output_options.add_argument("-f", "--format", type=str, choices=["text", "json", "yaml"], default="json", help="Output format for secrets found.")
+    output_options.add_argument("-f", "--format", type=str, choices=["text", "json", "yaml", "jsonl", "sarif", "csv"], default="json", help="Output format for secrets found. jsonl, sarif, and csv are written as secrets are found. Other formats are grouped when done from a partial .jsonl file written as secrets are found.")
     output_options.add_argument("-g", "--groupby", type=str, choices=["file", "locator", "both"], default="both", help="Group secrets by input file or locator. Default is 'both'.")
+    output_options.add_argument("--dedupe-results", action=BooleanOptionalAction, default=True, help="Report a secret found by the same locator in the same class or resource of an input file once, with the other files and lines it was found in listed as other_locations. Default is True.")
     output_options.add_argument("-c", "--cleanup", action=BooleanOptionalAction, default=False, help="Remove decompiled output directories after scanning.")
     output_options.add_argument("-q", "--quiet", action="store_true", help="Suppress output from subprocesses.")
 
@@ -60,6 +63,9 @@ def main():
     decompiler_choices.add_argument('--krakatau', "-K", nargs='?', const=None, default=False, help="Use Krakatau Java decompiler. Requires Enjarify.")
     decompiler_choices.add_argument('--fernflower', "-F", nargs='?', const=None, default=False, help="Use Fernflower Java decompiler. Requires Enjarify.")
     decompiler_choices.add_argument('--enjarify-choice', "-EC", type=str, choices=["auto", "never", "always"], default="auto", help="When to use Enjarify. Default is 'auto' which means use only when needed.")
+    decompiler_choices.add_argument('--prescan', type=str, choices=["never", "before", "only"], default="never", help="Scan strings, resources, and assets read directly from APK/DEX files 'before' decompiling or 'only' instead of decompiling. Default is 'never'.")
+    decompiler_choices.add_argument('--enjarify-max-workers', type=int, default=None, help="Maximum number of processes to use for Enjarify. Default is the number of CPUs.")
+    decompiler_choices.add_argument('--enjarify-cache-dir', type=Path, default=None, help="Directory to keep jars converted by Enjarify in by input content hash so they are reused across runs. Default is no cache.")
     decompiler_choices.add_argument('--unpack-xapks', action=BooleanOptionalAction, default=True, help="Unpack XAPK files into APKs before decompiling. Default is True.")
 
 
@@ -68,11 +74,23 @@ def main():
     decompiler_options.add_argument("-w", "--decompiler-working-dir", type=Path, default=Path.cwd(), help="Working directory where files will be decompiled.")
     decompiler_options.add_argument("--decompiler-output-suffix", type=str, default="-decompiled", help="Suffix for decompiled output directory names. Default is '-decompiled'.")
     decompiler_options.add_argument("--decompiler-extra-args", type=str, nargs="+", help="Additional arguments to pass to decompilers in form quoted whitespace separated '<DECOMPILER_NAME> <EXTRA_ARGS>...'. For example: --decompiler-extra-args 'jadx --no-debug-info,--no-inline'.")
+    decompiler_options.add_argument("--decompiler-cache-dir", type=Path, default=None, help="Directory to cache decompiled output in by input file content hash and decompiler args. Can be shared across runs and machines. Default is no cache.")
+    decompiler_options.add_argument("--decompiler-stream-output", action=BooleanOptionalAction, default=False, help="Scan decompiled files as soon as they are written instead of waiting for each decompiler to finish. Default is False.")
+    decompiler_options.add_argument("--decompiler-stream-poll-interval", type=float, default=0.5, help="Seconds between checks for new decompiled files when streaming output. Default is 0.5.")
+    decompiler_options.add_argument("--decompiler-schedule-resources", action=BooleanOptionalAction, default=True, help="Only start decompilers when their typical CPU and memory use fits in the budget and the system has enough free memory, largest inputs first. Default is True.")
+    decompiler_options.add_argument("--decompiler-max-cpu", type=float, default=None, help="CPU budget for concurrently running decompilers. Default is the number of CPUs.")
+    decompiler_options.add_argument("--decompiler-max-memory-mb", type=float, default=None, help="Memory budget in MB for concurrently running decompilers. Default is 80%% of total memory.")
+    decompiler_options.add_argument("--decompiler-index-skip-exts", type=str, nargs="+", default=None, help="File extensions to leave out when indexing decompiled files so they are never scanned. Default is to index every file.")
+    decompiler_options.add_argument("--decompiler-skip-media-files", action=BooleanOptionalAction, default=False, help="Also leave out images, audio, video, and fonts (.png, .jpg, .jpeg, .gif, .webp, .ogg, .mp3, .mp4, .wav, .ttf, .otf, .woff) when indexing decompiled files so they are never scanned. Default is False.")
+    decompiler_options.add_argument("--decompiler-daemons", type=str, nargs="+", help="Keep warm decompiler processes running and send them jobs over stdin instead of starting a new process per file, in form quoted whitespace separated '<DECOMPILER_NAME> <DAEMON_COMMAND>...'. See decompiler_daemon.py for the protocol. Use '<DECOMPILER_NAME> <JAR_PATH>' to run the bundled daemon, currently for cfr only, e.g. 'cfr /opt/cfr.jar' (requires Java 11+). Decompilers without a daemon, or whose daemon fails, are run once per file.")
     decompiler_options.add_argument("-dct", "--decompiler-concurrency-type", type=str, choices=["thread", "process", "main"], default="thread", help="Type of concurrency to use for decompilation. Default is 'thread'.")
     decompiler_options.add_argument("-dro", "--decompiler-results-order", type=str, choices=["completed", "submitted"], default="completed", help="Order to process results from decompiler. Default is 'completed'.")
     decompiler_options.add_argument("-dmw", "--decompiler-max-workers", type=int, default=None, help="Maximum number of workers to use for decompilation.")
     decompiler_options.add_argument("-dcs", "--decompiler-chunksize", type=int, default=1, help="Number of files to decompile per thread/process.")
-    decompiler_options.add_argument("-dto", "--decompiler-timeout", type=int, help="Timeout for decompilation in seconds.")
+    decompiler_options.add_argument("-dto", "--decompiler-timeout", type=int, help="Timeout for waiting for decompilation results in seconds. Does not stop decompilers, see --decompiler-binary-timeout.")
+    decompiler_options.add_argument("--decompiler-binary-timeout", type=float, default=None, help="Kill a decompiler and its subprocesses after running this many seconds. Default is no timeout.")
+    decompiler_options.add_argument("--decompiler-stall-timeout", type=float, default=None, help="Kill a decompiler and its subprocesses after this many seconds without writing output. Default is no timeout.")
+    decompiler_options.add_argument("--decompiler-keep-partial-output", action=BooleanOptionalAction, default=True, help="Scan the files a decompiler wrote before it was killed for timing out. Default is True.")
 
     scanner_options = parser.add_argument_group("Secret Scanner Advanced Options", description="Options for secret scanner.")
     scanner_options.add_argument("-sct", "--scanner-concurrency-type", type=str, choices=["thread", "process", "main"], default="process", help="Type of concurrency to use for scanning. Default is 'process'.")
@@ -80,6 +98,30 @@ def main():
     scanner_options.add_argument("-smw", "--scanner-max-workers", type=int, default=None, help="Maximum number of workers to use for scanning.")
     scanner_options.add_argument("-scs", "--scanner-chunksize", type=int, default=1, help="Number of files to scan per thread/process.")
     scanner_options.add_argument("-sto", "--scanner-timeout", type=int, help="Timeout for scanning in seconds.")
+    scanner_options.add_argument("--scanner-batch-size-bytes", type=int, default=1 << 20, help="Total size in bytes of the files scanned per thread/process task. 0 to scan one file per task. Default is 1 MiB.")
+    scanner_options.add_argument("--scanner-max-batch-files", type=int, default=512, help="Maximum number of files scanned per thread/process task. Default is 512.")
+    scanner_options.add_argument("--scanner-worker-resident-locators", action=BooleanOptionalAction, default=True, help="Send locators to each scanner process once when it starts instead of with every task. Default is True.")
+    scanner_options.add_argument("--scanner-locator-cache-dir", type=str, default=str(DEFAULT_LOCATOR_CACHE_DIR), help="Directory to cache parsed secret locators in so unchanged rules files are not parsed again. Pass '' to disable. Default is $XDG_CACHE_HOME/apkscan/locators (~/.cache/apkscan/locators).")
+    scanner_options.add_argument("--scanner-result-cache-path", type=str, nargs="?", const=str(DEFAULT_RESULT_CACHE_PATH), default=None, help="SQLite file to cache scan results in by file content hash so unchanged files are not scanned again. Default is no cache, or $XDG_CACHE_HOME/apkscan/scan_results.sqlite3 (~/.cache/apkscan/scan_results.sqlite3) if passed without a path.")
+    scanner_options.add_argument("--scanner-result-cache-max-age-days", type=float, default=30, help="Remove cached scan results not used in this many days. Default is 30.")
+    scanner_options.add_argument("--scanner-result-cache-max-size-bytes", type=int, default=256 << 20, help="Remove least recently used cached scan results over this total size. Default is 256 MiB.")
+    scanner_options.add_argument("--scanner-filter-files", action=BooleanOptionalAction, default=True, help="Check each file's size and type before scanning it and apply the options below. Default is True.")
+    scanner_options.add_argument("--scanner-max-file-size", type=int, default=16 << 20, help="Size in bytes over which files are handled by --scanner-oversized-action. 0 for no limit. Default is 16 MiB.")
+    scanner_options.add_argument("--scanner-oversized-action", type=str, choices=["scan", "sample", "skip"], default="scan", help="Scan files over --scanner-max-file-size whole, only their first --scanner-max-file-size bytes ('sample'), or skip them. Sampled files are logged. Default is 'scan'.")
+    scanner_options.add_argument("--scanner-binary-action", type=str, choices=["scan", "strings", "skip"], default="scan", help="Scan binary files (.so libraries, compiled resources, etc) raw, only their printable strings, or skip them. Default is 'scan'.")
+    scanner_options.add_argument("--scanner-dedupe-files", action=BooleanOptionalAction, default=True, help="Scan files with the same content, like the same resource from different decompilers, once and copy the results. Default is True.")
+    scanner_options.add_argument("--scanner-routes", type=str, nargs="+", help="Only scan files with some exts with some locators in form quoted whitespace separated '<EXT>[,<EXT>...] <LOCATOR_ID_GLOB>...'. For example: --scanner-routes '.smali,.java aws-* gcp-*' '.xml *-api-key'.")
+    scanner_options.add_argument("--scanner-scan-mode", type=str, choices=["line", "mmap"], default="line", help="Scan files line by line reporting the first match per locator per line, or memory-map whole files reporting every match. Default is 'line'.")
+    scanner_options.add_argument("--scanner-combine-locators", action=BooleanOptionalAction, default=True, help="Search each file once with combined locator patterns and only search lines with locators that matched. Default is True.")
+    scanner_options.add_argument("--scanner-prefilter-keywords", action=BooleanOptionalAction, default=True, help="Only search files with locators whose required keywords are in the file. Default is True.")
+    scanner_options.add_argument("--scanner-profile-locators", action=BooleanOptionalAction, default=False, help="Time every search of each locator across all workers and print the slowest locators when done. Slows scanning. Default is False.")
+    scanner_options.add_argument("--scanner-locator-time-budget", type=float, default=None, help="Quarantine (stop using) locators that take longer than this many seconds to search a single line, or a whole file in mmap mode. Enables profiling. Default is no budget.")
+    scanner_options.add_argument("--scanner-profile-output", type=Path, default=None, help="File to write the full locator profile to, as CSV if it ends with .csv otherwise JSON. Default is not written.")
+    scanner_options.add_argument("--scanner-lint-locators", action=BooleanOptionalAction, default=True, help="Check locator patterns for catastrophic backtracking, duplicates, and patterns subsumed by others when loaded, and rewrite patterns that have an equivalent faster form. Default is True.")
+    scanner_options.add_argument("--scanner-drop-duplicate-locators", action=BooleanOptionalAction, default=False, help="Do not scan with locators whose pattern, flags, and secret group are the same as an earlier locator's. Default is False.")
+    scanner_options.add_argument("--scanner-lint-report", type=Path, default=None, help="JSON file to write the locator lint findings, rewrites, duplicates, and subsumed locators to. Default is not written.")
+    scanner_options.add_argument("--scanner-matcher-backend", type=str, choices=["re", "re2", "hyperscan"], default="re", help="Engine to match locators with. re2 (requires google-re2) matches in linear time so patterns prone to backtracking stay fast. hyperscan (requires hyperscan) gates all locators with one database and matches them with re2 when installed. Patterns an engine cannot compile are matched with re. Default is 're'.")
+    scanner_options.add_argument("--scanner-combined-chunk-size", type=int, default=1, help="Number of locator patterns to combine into each combined pattern. Default is 1.")
 
     args = parser.parse_args()
     if not args.quiet:
@@ -92,6 +134,8 @@ def main():
     decompiler_kwargs = {
         "binaries": {},
         "enjarify_choice": args.enjarify_choice,
+        "enjarify_max_workers": args.enjarify_max_workers,
+        "enjarify_cache_dir": args.enjarify_cache_dir,
         "unpack_xapks": args.unpack_xapks,
         "deobfuscate": args.deobfuscate,
         "remove_failed_output_dirs": args.cleanup,
@@ -115,7 +159,10 @@ def main():
         output_file=args.output,
         output_format=args.format,
         groupby=args.groupby,
-        cleanup=args.cleanup
+        cleanup=args.cleanup,
+        prescan=args.prescan,
+        dedupe_results=args.dedupe_results,
+        keep_results=False,
     )
 
     try:
@@ -125,8 +172,9 @@ def main():
     finally:
         apk_scanner.write_output()
         apk_scanner.do_cleanup()
+        apk_scanner.secret_scanner.close_result_cache()
 
-    if apk_scanner.secrets_results:
+    if apk_scanner.num_secrets:
         print(f"\033[1;32m\nAPKscan done. Secrets saved to {apk_scanner.output_file}\033[0m")
         exit(0)
     else:
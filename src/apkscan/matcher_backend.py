@@ -0,0 +1,319 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from abc import ABC, abstractmethod
+from typing import Any, Iterable, Iterator, Optional, Sequence
+from threading import local
+from mmap import mmap
+from re import compile as re_compile, Pattern
+
+from .locator_matcher import make_combinable_fragment, strip_guard
+
+try:
+    # Optional linear-time engines. See get_matcher_backend.
+    import re2  # type: ignore
+except ImportError:
+    re2 = None  # type: ignore[assignment]
+try:
+    import hyperscan  # type: ignore
+except ImportError:
+    hyperscan = None  # type: ignore[assignment]
+
+# re.Pattern or a pattern compiled by another engine with the same search, finditer, and Match API
+SearchPattern = Any
+
+# re reads {,n} as {0,n} while RE2 and Hyperscan read it as literal text
+UNPORTABLE_SYNTAX = re_compile(rb"(?<!\\)\{,")
+# RE2 sets of many patterns can run out of memory compiling. Sets that fail to compile are split in half.
+RE2_SET_SIZE = 128
+RE2_MAX_MEM = 64 << 20
+# re's \s matches bytes.isspace() bytes, which includes the vertical tab RE2's \s leaves out
+WHITESPACE_CLASS_ITEMS = rb"\t\n\x0b\f\r\x20"
+
+
+def make_portable_whitespace(expression: bytes) -> Optional[bytes]:
+    """
+    Expression with \\s and \\S spelled out as the bytes re matches, or None if \\S is in a class and cannot be
+    spelled out as class items.
+    """
+    if rb"\s" not in expression and rb"\S" not in expression:
+        return expression
+    parts = []
+    in_class = False
+    i = 0
+    while i < len(expression):
+        char = expression[i : i + 1]
+        if char == b"\\":
+            escape = expression[i : i + 2]
+            if escape == rb"\s":
+                escape = WHITESPACE_CLASS_ITEMS if in_class else b"[" + WHITESPACE_CLASS_ITEMS + b"]"
+            elif escape == rb"\S":
+                if in_class:
+                    return None
+                escape = b"[^" + WHITESPACE_CLASS_ITEMS + b"]"
+            parts.append(escape)
+            i += 2
+            continue
+        if char == b"[" and not in_class:
+            in_class = True
+            # ] right after the opening [ or [^ is a literal
+            start = i + 1 + (expression[i + 1 : i + 2] == b"^")
+            end = start + (expression[start : start + 1] == b"]")
+            parts.append(expression[i:end])
+            i = end
+            continue
+        if char == b"]":
+            in_class = False
+        parts.append(char)
+        i += 1
+    return b"".join(parts)
+
+
+def make_backend_expression(pattern: Pattern) -> Optional[bytes]:
+    """
+    Source of pattern for other engines with its flags inlined and MULTILINE set, like the alternatives of combined
+    gates, or None if it relies on re behaviour other engines may not match the same way. Leading guards added by
+    locator_lint are dropped since the guarded pattern matches the same lines and the engines are linear-time anyway.
+    Whitespace classes are spelled out so every engine matches the same bytes as re.
+    """
+    if UNPORTABLE_SYNTAX.search(pattern.pattern):
+        return None
+    if (source := strip_guard(pattern)) is not pattern.pattern:
+        pattern = re_compile(source, pattern.flags)
+    if (expression := make_combinable_fragment(pattern)) is None:
+        return None
+    return make_portable_whitespace(expression)
+
+
+def make_backend_expressions(
+    patterns: Sequence[Pattern], indices: Optional[Iterable[int]] = None
+) -> list[tuple[int, bytes]]:
+    """(index, expression) of the patterns at indices (all patterns by default) with a backend expression."""
+    expressions = []
+    for index in indices if indices is not None else range(len(patterns)):
+        if (expression := make_backend_expression(patterns[index])) is not None:
+            expressions.append((index, expression))
+    return expressions
+
+
+def re2_options() -> Any:
+    options = re2.Options()
+    # Match bytes like re does instead of decoding the data as UTF-8
+    options.encoding = re2.Options.Encoding.LATIN1
+    options.max_mem = RE2_MAX_MEM
+    options.log_errors = False
+    return options
+
+
+class PatternDatabase(ABC):
+    """Patterns compiled together by a MatcherBackend. search yields the indices of the patterns that match data."""
+
+    def __init__(self, indices: list[int]) -> None:
+        self.indices = indices
+
+    @abstractmethod
+    def search(self, data: bytes | mmap) -> Iterable[int]:
+        pass
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+
+class RE2SetDatabase(PatternDatabase):
+    def __init__(self, expressions: list[tuple[int, bytes]]) -> None:
+        # Sets are (RE2 set, index of each pattern added to it)
+        self.re2_sets: list[tuple[Any, list[int]]] = []
+        for start in range(0, len(expressions), RE2_SET_SIZE):
+            self.add_sets(expressions[start : start + RE2_SET_SIZE])
+        super().__init__(sorted(index for _, indices in self.re2_sets for index in indices))
+        added = set(self.indices)
+        self.expressions = [(index, expression) for index, expression in expressions if index in added]
+
+    def add_sets(self, expressions: list[tuple[int, bytes]]) -> None:
+        if not expressions:
+            return
+        re2_set = re2.Set.SearchSet(re2_options())
+        indices = []
+        for index, expression in expressions:
+            try:
+                re2_set.Add(expression)
+                indices.append(index)
+            except re2.error:
+                continue
+        try:
+            re2_set.Compile()
+            if indices:
+                self.re2_sets.append((re2_set, indices))
+            return
+        except re2.error:
+            if len(expressions) == 1:
+                return
+
+        # Bisect until the patterns that make the set too large to compile are isolated
+        middle = len(expressions) // 2
+        self.add_sets(expressions[:middle])
+        self.add_sets(expressions[middle:])
+
+    def search(self, data: bytes | mmap) -> Iterator[int]:
+        for re2_set, indices in self.re2_sets:
+            for set_index in re2_set.Match(data) or ():
+                yield indices[set_index]
+
+    def __getstate__(self) -> list[tuple[int, bytes]]:
+        # RE2 sets cannot be pickled so are compiled again from their expressions
+        return self.expressions
+
+    def __setstate__(self, expressions: list[tuple[int, bytes]]) -> None:
+        self.__init__(expressions)  # type: ignore
+
+
+class HyperscanDatabase(PatternDatabase):
+    def __init__(self, database: Any, indices: list[int]) -> None:
+        super().__init__(indices)
+        self.database = database
+        # Scratch space cannot be shared by threads scanning at the same time
+        self.thread_local = local()
+
+    def search(self, data: bytes | mmap) -> list[int]:
+        if (scratch := getattr(self.thread_local, "scratch", None)) is None:
+            scratch = self.thread_local.scratch = hyperscan.Scratch(self.database)
+        hits: list[int] = []
+        self.database.scan(data, match_event_handler=lambda index, *_: hits.append(index), scratch=scratch)
+        return hits
+
+    def __getstate__(self) -> tuple[bytes, list[int]]:
+        # Serialized so worker processes do not compile the database again
+        return hyperscan.dumpb(self.database), self.indices
+
+    def __setstate__(self, state: tuple[bytes, list[int]]) -> None:
+        serialized, indices = state
+        self.__init__(hyperscan.loadb(serialized, hyperscan.HS_MODE_BLOCK), indices)  # type: ignore
+
+
+class MatcherBackend:
+    """
+    Engine locator patterns are matched with. Locators always keep their re Pattern, which results, caches, and
+    fingerprints are keyed by. A backend can compile a locator's pattern to replace its searches, and compile a
+    database of all the locators to gate them with one search of a whole buffer. Any pattern the engine cannot
+    compile, or could match differently than re, falls back to re on its own.
+
+    This base backend compiles nothing, so every pattern is matched and gated with re.
+    """
+
+    name = "re"
+    # Module and package the backend needs
+    module: Any = True
+    package = ""
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return cls.module is not None
+
+    def compile_pattern(self, pattern: Pattern) -> Optional[SearchPattern]:
+        """Pattern to search lines or whole buffers with in place of pattern, or None to search with pattern."""
+        return None
+
+    def compile_database(
+        self, patterns: Sequence[Pattern], indices: Optional[Iterable[int]] = None
+    ) -> Optional[PatternDatabase]:
+        """
+        Database of the patterns at indices (all patterns by default) the engine can compile, or None if it cannot
+        compile any. Indices not in the database must still be gated some other way.
+        """
+        return None
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(name={self.name})"
+
+
+class RE2Backend(MatcherBackend):
+    """
+    Searches and gates locators with google-re2. RE2 has no backreferences or lookarounds, but matches in linear time.
+    Each search has more overhead than re, so this is slower than re on ordinary lines but never backtracks.
+    """
+
+    name = "re2"
+    module = re2
+    package = "google-re2"
+
+    def compile_pattern(self, pattern: Pattern) -> Optional[SearchPattern]:
+        if (expression := make_backend_expression(pattern)) is None:
+            return None
+        try:
+            return re2.compile(expression, re2_options())
+        except re2.error:
+            return None
+
+    def compile_database(
+        self, patterns: Sequence[Pattern], indices: Optional[Iterable[int]] = None
+    ) -> Optional[PatternDatabase]:
+        database = RE2SetDatabase(make_backend_expressions(patterns, indices))
+        return database if database.indices else None
+
+
+class HyperscanBackend(MatcherBackend):
+    """
+    Gates locators with a Hyperscan database. Hyperscan does not report groups, so each locator's own searches use
+    RE2 when it is installed and re otherwise.
+    """
+
+    name = "hyperscan"
+    module = hyperscan
+    package = "hyperscan"
+
+    def compile_pattern(self, pattern: Pattern) -> Optional[SearchPattern]:
+        return RE2Backend().compile_pattern(pattern) if RE2Backend.is_available() else None
+
+    def compile_database(
+        self, patterns: Sequence[Pattern], indices: Optional[Iterable[int]] = None
+    ) -> Optional[PatternDatabase]:
+        expressions = make_backend_expressions(patterns, indices)
+        if not expressions:
+            return None
+        if (database := self.try_compile(expressions)) is None and len(expressions) > 1:
+            # Compiling fails as a whole without saying which pattern failed, so bisect to find the patterns that
+            # compile then compile them together
+            middle = len(expressions) // 2
+            expressions = self.find_supported(expressions[:middle]) + self.find_supported(expressions[middle:])
+            database = self.try_compile(expressions) if expressions else None
+        if database is None:
+            return None
+        return HyperscanDatabase(database, [index for index, _ in expressions])
+
+    def find_supported(self, expressions: list[tuple[int, bytes]]) -> list[tuple[int, bytes]]:
+        if not expressions or self.try_compile(expressions) is not None:
+            return expressions
+        if len(expressions) == 1:
+            return []
+        middle = len(expressions) // 2
+        return self.find_supported(expressions[:middle]) + self.find_supported(expressions[middle:])
+
+    @staticmethod
+    def try_compile(expressions: list[tuple[int, bytes]]) -> Optional[Any]:
+        database = hyperscan.Database()
+        try:
+            database.compile(
+                expressions=[expression for _, expression in expressions],
+                ids=[index for index, _ in expressions],
+                elements=len(expressions),
+                flags=hyperscan.HS_FLAG_SINGLEMATCH,
+            )
+        except hyperscan.error:
+            return None
+        return database
+
+
+MATCHER_BACKENDS: dict[str, type[MatcherBackend]] = {
+    backend.name: backend for backend in (MatcherBackend, RE2Backend, HyperscanBackend)
+}
+
+
+def get_matcher_backend(name: str) -> MatcherBackend:
+    """Backend called name, or the re backend if the module it needs is not installed."""
+    backend_class = MATCHER_BACKENDS[name]
+    if backend_class.is_available():
+        return backend_class()
+    print(
+        f"{backend_class.package} not found. Matching locators with re. Install {backend_class.package} to use {name}."
+    )
+    return MatcherBackend()
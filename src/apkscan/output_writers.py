@@ -0,0 +1,147 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from pathlib import Path
+from abc import ABC, abstractmethod
+from csv import DictWriter
+from hashlib import sha256
+from json import dumps as json_dumps, loads as json_loads, JSONDecodeError
+from typing import Iterable, Iterator, Optional, TextIO
+
+# Result records are dicts with these keys. Unique results have an id, and repeats of a result found in the same
+# class or resource (see APKScanner.dedupe_results) only have duplicate_of, file_path, line_number, and locator_id.
+RESULT_FIELDS = ["id", "duplicate_of", "secret", "file_path", "line_number", "locator", "locator_id", "input_file"]
+SARIF_SCHEMA = "https://json.schemastore.org/sarif-2.1.0.json"
+APKSCAN_URI = "https://github.com/LucasFaudman/apkscan"
+
+
+def path_to_uri(file_path: str) -> str:
+    path = Path(file_path)
+    return path.as_uri() if path.is_absolute() else path.as_posix()
+
+
+class ResultWriter(ABC):
+    """Writes each result record to output_file as soon as it is found so a crash does not lose earlier results."""
+
+    def __init__(self, output_file: Path) -> None:
+        self.output_file = output_file
+        self.output_file.parent.mkdir(parents=True, exist_ok=True)
+        self.file: TextIO = output_file.open("w", newline="")
+        self.num_records = 0
+
+    def write(self, record: dict) -> None:
+        self.write_record(record)
+        self.num_records += 1
+        self.file.flush()
+
+    @abstractmethod
+    def write_record(self, record: dict) -> None:
+        pass
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(output_file={self.output_file}, num_records={self.num_records})"
+
+
+class JSONLinesWriter(ResultWriter):
+    def write_record(self, record: dict) -> None:
+        self.file.write(json_dumps(record) + "\n")
+
+
+class CSVWriter(ResultWriter):
+    def __init__(self, output_file: Path) -> None:
+        super().__init__(output_file)
+        self.csv_writer = DictWriter(self.file, fieldnames=RESULT_FIELDS)
+        self.csv_writer.writeheader()
+
+    def write_record(self, record: dict) -> None:
+        self.csv_writer.writerow(record)
+
+
+class SARIFWriter(ResultWriter):
+    """
+    SARIF 2.1.0 log with one run. Results are written as they are found and the rules for the locators that were
+    found are written after them when closed. Repeats of a result are separate results with the same fingerprint.
+    """
+
+    def __init__(self, output_file: Path) -> None:
+        super().__init__(output_file)
+        self.rules: dict[str, str] = {}
+        self.secret_hashes: dict[int, str] = {}
+        self.file.write(f'{{"$schema": "{SARIF_SCHEMA}", "version": "2.1.0", "runs": [{{"results": [\n')
+
+    def write_record(self, record: dict) -> None:
+        if (duplicate_of := record.get("duplicate_of")) is not None:
+            result_id, secret_hash = duplicate_of, self.secret_hashes.get(duplicate_of, "")
+            rule_id = record.get("locator_id") or ""
+        else:
+            result_id, rule_id = record["id"], record["locator_id"]
+            secret_hash = self.secret_hashes[result_id] = sha256(record["secret"].encode()).hexdigest()
+            self.rules.setdefault(rule_id, record["locator"])
+
+        sarif_result = {
+            "ruleId": rule_id,
+            "level": "warning",
+            "message": {"text": f"{self.rules.get(rule_id, rule_id)} found"},
+            "locations": [
+                {
+                    "physicalLocation": {
+                        "artifactLocation": {"uri": path_to_uri(record["file_path"])},
+                        "region": {"startLine": record["line_number"]},
+                    }
+                }
+            ],
+            "partialFingerprints": {"secretHash/v1": secret_hash},
+            "properties": {key: record[key] for key in ("id", "duplicate_of", "secret", "input_file") if key in record},
+        }
+        self.file.write((",\n" if self.num_records else "") + json_dumps(sarif_result))
+
+    def close(self) -> None:
+        rules = [{"id": rule_id, "name": name} for rule_id, name in self.rules.items()]
+        tool = {"driver": {"name": "apkscan", "informationUri": APKSCAN_URI, "rules": rules}}
+        self.file.write(f'\n], "tool": {json_dumps(tool)}}}]}}\n')
+        super().close()
+
+
+RESULT_WRITERS: dict[str, type[ResultWriter]] = {"jsonl": JSONLinesWriter, "csv": CSVWriter, "sarif": SARIFWriter}
+
+
+def iter_jsonl_records(jsonl_file: Path) -> Iterator[dict]:
+    """Read records written by JSONLinesWriter. A partly written last line from a crash is ignored."""
+    with jsonl_file.open("r") as f:
+        for line in f:
+            try:
+                yield json_loads(line)
+            except JSONDecodeError:
+                print(f"Skipping incomplete record in {jsonl_file}: {line[:100]!r}")
+
+
+def group_records(
+    records: Iterable[dict],
+) -> tuple[dict[str, list[dict[str, str | int | list[str]]]], dict[str, list[dict[str, str | int | list[str]]]]]:
+    """
+    Compact result records into results grouped by input file and by locator id, with repeats of each result
+    listed in its other_locations. Records without an input file are only grouped by locator.
+    """
+    results_by_input_file: dict[str, list[dict[str, str | int | list[str]]]] = {}
+    results_by_locator: dict[str, list[dict[str, str | int | list[str]]]] = {}
+    # Each grouping gets its own copy of a result so YAML output does not use anchors
+    grouped_results: dict[int, list[dict[str, str | int | list[str]]]] = {}
+    for record in records:
+        if (duplicate_of := record.get("duplicate_of")) is not None:
+            for grouped_result in grouped_results.get(duplicate_of, ()):
+                other_locations = grouped_result.setdefault("other_locations", [])
+                other_locations.append(f"{record['file_path']}:{record['line_number']}")  # type: ignore
+            continue
+
+        grouped_results[record["id"]] = []
+        input_file: Optional[str] = record.get("input_file")
+        for results, group in ((results_by_input_file, input_file), (results_by_locator, record["locator_id"])):
+            if group is None:
+                continue
+            grouped_result = {key: record[key] for key in ("secret", "file_path", "line_number", "locator")}
+            results.setdefault(group, []).append(grouped_result)
+            grouped_results[record["id"]].append(grouped_result)
+    return results_by_input_file, results_by_locator
@@ -0,0 +1,135 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from pathlib import Path
+from struct import unpack_from, error as StructError
+from zipfile import ZipFile, ZipInfo, BadZipFile, is_zipfile
+from tempfile import SpooledTemporaryFile
+from shutil import copyfileobj
+from typing import Iterator
+
+# Extracts strings that can be scanned without decompiling from APK/DEX files.
+# DEX string tables and binary XML/ARSC string pools are joined one string per line.
+# Everything else (assets, raw resources, configs) is scanned as is.
+
+ZIP_EXTS = {".apk", ".xapk", ".apks", ".jar", ".aar", ".aab", ".zip"}
+SKIP_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".ogg", ".mp3", ".mp4", ".wav", ".ttf", ".otf", ".woff"}
+MAX_ENTRY_SIZE = 64 << 20
+MAX_SPOOLED_SIZE = 16 << 20
+COPY_CHUNK_SIZE = 1 << 20
+MAX_ZIP_DEPTH = 2
+
+DEX_MAGIC = b"dex\n"
+RES_STRING_POOL_TYPE = 0x0001
+RES_TABLE_TYPE = 0x0002
+RES_XML_TYPE = 0x0003
+UTF8_FLAG = 0x100
+
+
+def parse_dex_strings(data: bytes) -> list[bytes]:
+    """Read the string_ids section of a DEX file. Strings are MUTF-8 after a ULEB128 UTF-16 length."""
+    string_ids_size, string_ids_off = unpack_from("<II", data, 0x38)
+    strings = []
+    for offset in unpack_from(f"<{string_ids_size}I", data, string_ids_off):
+        while data[offset] & 0x80:
+            offset += 1
+        offset += 1
+        strings.append(data[offset : data.index(b"\0", offset)])
+    return strings
+
+
+def parse_string_pool(data: bytes, offset: int) -> list[bytes]:
+    """Read a ResStringPool chunk used by resources.arsc and binary XML files."""
+    chunk_type, header_size, _, string_count, _, flags, strings_start = unpack_from("<HHIIIII", data, offset)
+    if chunk_type != RES_STRING_POOL_TYPE:
+        raise ValueError(f"Expected string pool chunk at {offset} got type {chunk_type}")
+
+    strings_offset = offset + strings_start
+    strings = []
+    for string_offset in unpack_from(f"<{string_count}I", data, offset + header_size):
+        pos = strings_offset + string_offset
+        if flags & UTF8_FLAG:
+            # UTF-16 length then UTF-8 length, each 1 byte or 2 bytes when the high bit is set
+            pos += 2 if data[pos] & 0x80 else 1
+            length = data[pos]
+            if length & 0x80:
+                length = ((length & 0x7F) << 8) | data[pos + 1]
+                pos += 1
+            pos += 1
+            strings.append(data[pos : pos + length])
+        else:
+            (length,) = unpack_from("<H", data, pos)
+            if length & 0x8000:
+                length = ((length & 0x7FFF) << 16) | unpack_from("<H", data, pos + 2)[0]
+                pos += 2
+            pos += 2
+            strings.append(data[pos : pos + length * 2].decode("utf-16-le", "replace").encode())
+    return strings
+
+
+def extract_strings(name: str, data: bytes) -> bytes:
+    """Strings from DEX, ARSC, and binary XML data one per line, or data as is for any other type of file."""
+    try:
+        if data[:4] == DEX_MAGIC:
+            return b"\n".join(parse_dex_strings(data))
+        chunk_type, header_size = unpack_from("<HH", data, 0) if len(data) >= 4 else (None, 0)
+        if chunk_type in (RES_TABLE_TYPE, RES_XML_TYPE):
+            return b"\n".join(parse_string_pool(data, header_size))
+    except (StructError, IndexError, ValueError) as e:
+        print(f"Error extracting strings from {name}. Scanning raw bytes. {e}")
+    return data
+
+
+def iter_nested_zip_buffers(
+    zip_file: ZipFile, info: ZipInfo, entry_path: Path, depth: int
+) -> Iterator[tuple[Path, bytes]]:
+    """
+    Nested APKs in XAPKs or JARs in AARs are copied in chunks to a temp file that is only kept in memory when small,
+    so memory use does not grow with the size of the bundle.
+    """
+    with SpooledTemporaryFile(max_size=MAX_SPOOLED_SIZE) as spool:
+        with zip_file.open(info) as entry_file:
+            copyfileobj(entry_file, spool, COPY_CHUNK_SIZE)
+        with ZipFile(spool) as inner_zip_file:
+            yield from iter_zip_buffers(inner_zip_file, entry_path, depth + 1)
+
+
+def iter_zip_buffers(zip_file: ZipFile, zip_path: Path, depth: int = 0) -> Iterator[tuple[Path, bytes]]:
+    for info in zip_file.infolist():
+        entry_path = zip_path / info.filename
+        ext = entry_path.suffix.lower()
+        if info.is_dir() or ext in SKIP_EXTS:
+            continue
+        try:
+            if ext in ZIP_EXTS and depth < MAX_ZIP_DEPTH:
+                yield from iter_nested_zip_buffers(zip_file, info, entry_path, depth)
+                continue
+        except BadZipFile:
+            # Not a zip after all so scan it like any other entry
+            pass
+        except (OSError, RuntimeError) as e:
+            print(f"Error reading {entry_path}: {e}")
+            continue
+
+        if info.file_size > MAX_ENTRY_SIZE:
+            continue
+        try:
+            with zip_file.open(info) as entry_file:
+                data = entry_file.read()
+        except (BadZipFile, OSError, RuntimeError) as e:
+            print(f"Error reading {entry_path}: {e}")
+            continue
+        yield entry_path, extract_strings(str(entry_path), data)
+
+
+def iter_prescan_buffers(file_path: Path) -> Iterator[tuple[Path, bytes]]:
+    """
+    Yield (path, buffer) for everything in file_path that can be scanned without decompiling.
+    Paths of zip entries are the zip path joined with the entry name e.g. app.apk/assets/config.json.
+    """
+    if is_zipfile(file_path):
+        with ZipFile(file_path) as zip_file:
+            yield from iter_zip_buffers(zip_file, file_path)
+    else:
+        with file_path.open("rb") as f:
+            yield file_path, extract_strings(str(file_path), f.read())
@@ -0,0 +1,92 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from contextlib import contextmanager
+from os import cpu_count, getloadavg
+from threading import Condition
+from typing import Iterator, Optional
+
+MEMINFO_PATH = "/proc/meminfo"
+
+
+def read_meminfo_mb(field: str) -> Optional[float]:
+    """Read a field from /proc/meminfo in MB. None when not available (e.g. not Linux)."""
+    try:
+        with open(MEMINFO_PATH, "r") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_load_average() -> Optional[float]:
+    try:
+        return getloadavg()[0]
+    except OSError:
+        return None
+
+
+class ResourceScheduler:
+    """
+    Admits jobs with estimated CPU and memory costs only when they fit in the budget and the system has enough
+    available memory and idle CPU. A job is always admitted when nothing else is running so large jobs cannot wait forever.
+    Available memory and load are checked again every poll_interval seconds while jobs wait.
+    """
+
+    def __init__(
+        self,
+        max_cpu: Optional[float] = None,
+        max_memory_mb: Optional[float] = None,
+        min_available_memory_mb: float = 512,
+        poll_interval: float = 1.0,
+    ) -> None:
+        self.max_cpu = max_cpu or cpu_count() or 1
+        if max_memory_mb is None and (total_memory_mb := read_meminfo_mb("MemTotal")) is not None:
+            max_memory_mb = total_memory_mb * 0.8
+        self.max_memory_mb = max_memory_mb or float("inf")
+        self.min_available_memory_mb = min_available_memory_mb
+        self.poll_interval = poll_interval
+        self.running_cpu = 0.0
+        self.running_memory_mb = 0.0
+        self.num_running = 0
+        self.condition = Condition()
+
+    def fits(self, cpu: float, memory_mb: float) -> bool:
+        if not self.num_running:
+            return True
+        if self.running_cpu + cpu > self.max_cpu or self.running_memory_mb + memory_mb > self.max_memory_mb:
+            return False
+        if (available_memory_mb := read_meminfo_mb("MemAvailable")) is not None:
+            if available_memory_mb - memory_mb < self.min_available_memory_mb:
+                return False
+        if (load_average := get_load_average()) is not None and load_average >= self.max_cpu:
+            return False
+        return True
+
+    def acquire(self, cpu: float, memory_mb: float) -> None:
+        with self.condition:
+            while not self.fits(cpu, memory_mb):
+                self.condition.wait(self.poll_interval)
+            self.running_cpu += cpu
+            self.running_memory_mb += memory_mb
+            self.num_running += 1
+
+    def release(self, cpu: float, memory_mb: float) -> None:
+        with self.condition:
+            self.running_cpu -= cpu
+            self.running_memory_mb -= memory_mb
+            self.num_running -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, cpu: float, memory_mb: float) -> Iterator[None]:
+        self.acquire(cpu, memory_mb)
+        try:
+            yield
+        finally:
+            self.release(cpu, memory_mb)
+
+    def __repr__(self) -> str:
+        return f"ResourceScheduler(max_cpu={self.max_cpu}, max_memory_mb={self.max_memory_mb:.0f}, min_available_memory_mb={self.min_available_memory_mb})"
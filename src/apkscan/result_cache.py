@@ -0,0 +1,119 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from pathlib import Path
+from hashlib import sha256
+from marshal import dumps as marshal_dumps, loads as marshal_loads
+from sqlite3 import connect, Error as SQLiteError
+from time import time
+from typing import Optional
+
+from .locator_cache import DEFAULT_LOCATOR_CACHE_DIR
+
+DEFAULT_RESULT_CACHE_PATH = DEFAULT_LOCATOR_CACHE_DIR.parent / "scan_results.sqlite3"
+HASH_READ_SIZE = 1 << 20
+# Results are committed every this many puts so a killed scan keeps most of what it scanned
+COMMIT_INTERVAL = 64
+
+# (secret, line_number, locator index in loaded locators)
+ResultRecord = tuple[bytes, int, int]
+
+
+def hash_file_content(file_path: Path) -> str:
+    content_hash = sha256()
+    with file_path.open("rb") as f:
+        while chunk := f.read(HASH_READ_SIZE):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+class ScanResultCache:
+    """
+    SQLite store of scan results keyed by (file content hash, rules key) so unchanged files are not scanned again.
+    Entries not used for max_age_days or beyond max_size_bytes (least recently used first) are removed by evict.
+    Puts are committed every commit_interval puts and by evict and close.
+    """
+
+    def __init__(
+        self,
+        db_path: Path | str = DEFAULT_RESULT_CACHE_PATH,
+        max_age_days: Optional[float] = 30,
+        max_size_bytes: Optional[int] = 256 << 20,
+        commit_interval: int = COMMIT_INTERVAL,
+    ) -> None:
+        self.db_path = Path(db_path)
+        self.max_age_days = max_age_days
+        self.max_size_bytes = max_size_bytes
+        self.commit_interval = commit_interval
+        self.num_uncommitted = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = connect(self.db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS scan_results ("
+            "content_hash TEXT NOT NULL, rules_key TEXT NOT NULL, results BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (content_hash, rules_key))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS scan_results_last_used ON scan_results (last_used)")
+        self.connection.commit()
+
+    def get(self, content_hash: str, rules_key: str) -> Optional[list[ResultRecord]]:
+        row = self.connection.execute(
+            "SELECT results FROM scan_results WHERE content_hash = ? AND rules_key = ?", (content_hash, rules_key)
+        ).fetchone()
+        if row is None:
+            self.num_misses += 1
+            return None
+
+        self.num_hits += 1
+        self.connection.execute(
+            "UPDATE scan_results SET last_used = ? WHERE content_hash = ? AND rules_key = ?",
+            (time(), content_hash, rules_key),
+        )
+        return marshal_loads(row[0])
+
+    def put(self, content_hash: str, rules_key: str, records: list[ResultRecord]) -> None:
+        results = marshal_dumps(records)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO scan_results VALUES (?, ?, ?, ?, ?)",
+            (content_hash, rules_key, results, len(results) + len(content_hash) + len(rules_key), time()),
+        )
+        self.num_uncommitted += 1
+        if self.num_uncommitted >= self.commit_interval:
+            self.commit()
+
+    def evict(self) -> int:
+        num_rows_before = self.connection.total_changes
+        if self.max_age_days is not None:
+            self.connection.execute(
+                "DELETE FROM scan_results WHERE last_used < ?", (time() - self.max_age_days * 86400,)
+            )
+        if self.max_size_bytes is not None:
+            # Keep the most recently used entries that fit in max_size_bytes
+            self.connection.execute(
+                "DELETE FROM scan_results WHERE rowid IN (SELECT rowid FROM ("
+                "SELECT rowid, SUM(size) OVER (ORDER BY last_used DESC, rowid DESC) AS total_size FROM scan_results"
+                ") WHERE total_size > ?)",
+                (self.max_size_bytes,),
+            )
+        self.commit()
+        return self.connection.total_changes - num_rows_before
+
+    def commit(self) -> None:
+        self.num_uncommitted = 0
+        try:
+            self.connection.commit()
+        except SQLiteError as e:
+            print(f"Error saving scan results to {self.db_path}. {e}")
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM scan_results").fetchone()[0]
+
+    def __repr__(self) -> str:
+        return f"ScanResultCache(db_path={self.db_path}, max_age_days={self.max_age_days}, max_size_bytes={self.max_size_bytes})"
@@ -0,0 +1,82 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from array import array
+from pathlib import Path
+from typing import Iterable, Iterator, overload
+
+from .secret_scanner import SecretLocator, SecretResult
+
+
+class SecretResultStore:
+    """
+    List of SecretResults stored as arrays of ids into tables of interned file paths, secrets, and locators,
+    so keeping millions of results does not keep millions of Path, bytes, and SecretResult objects.
+    SecretResults are created again when accessed.
+    """
+
+    def __init__(self, secret_results: Iterable[SecretResult] = ()) -> None:
+        self.file_paths: list[Path] = []
+        self.file_path_ids: dict[Path, int] = {}
+        # Locators are compared by pattern so they are looked up by object id
+        self.locators: list[SecretLocator] = []
+        self.locator_ids: dict[int, int] = {}
+        self.secret_pool: dict[bytes, bytes] = {}
+        self.secrets: list[bytes] = []
+        self.file_ids = array("I")
+        self.line_numbers = array("I")
+        self.locator_indices = array("I")
+        self.origins = array("i")
+        for secret_result in secret_results:
+            self.append(secret_result)
+
+    def append(self, secret_result: SecretResult) -> None:
+        if (file_id := self.file_path_ids.get(secret_result.file_path)) is None:
+            file_id = self.file_path_ids[secret_result.file_path] = len(self.file_paths)
+            self.file_paths.append(secret_result.file_path)
+        if (locator_index := self.locator_ids.get(id(secret_result.locator))) is None:
+            locator_index = self.locator_ids[id(secret_result.locator)] = len(self.locators)
+            self.locators.append(secret_result.locator)
+
+        self.secrets.append(self.secret_pool.setdefault(secret_result.secret, secret_result.secret))
+        self.file_ids.append(file_id)
+        self.line_numbers.append(secret_result.line_number)
+        self.locator_indices.append(locator_index)
+        self.origins.append(secret_result.origin)
+
+    def get(self, index: int) -> SecretResult:
+        return SecretResult(
+            secret=self.secrets[index],
+            file_path=self.file_paths[self.file_ids[index]],
+            line_number=self.line_numbers[index],
+            locator=self.locators[self.locator_indices[index]],
+            origin=self.origins[index],
+        )
+
+    @overload
+    def __getitem__(self, index: int) -> SecretResult: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[SecretResult]: ...
+
+    def __getitem__(self, index: int | slice) -> SecretResult | list[SecretResult]:
+        if isinstance(index, slice):
+            return [self.get(i) for i in range(*index.indices(len(self.secrets)))]
+        if index < 0:
+            index += len(self.secrets)
+        if not 0 <= index < len(self.secrets):
+            raise IndexError("SecretResultStore index out of range")
+        return self.get(index)
+
+    def __iter__(self) -> Iterator[SecretResult]:
+        for index in range(len(self.secrets)):
+            yield self.get(index)
+
+    def __len__(self) -> int:
+        return len(self.secrets)
+
+    def __bool__(self) -> bool:
+        return bool(self.secrets)
+
+    def __repr__(self) -> str:
+        return f"SecretResultStore(results={len(self.secrets)}, files={len(self.file_paths)}, unique_secrets={len(self.secret_pool)}, locators={len(self.locators)})"
@@ -0,0 +1,114 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from pathlib import Path
+from fnmatch import fnmatchcase
+from os import fstat
+from re import compile as re_compile
+from shlex import split as shlex_split
+from typing import Optional, Literal, Iterable
+
+BINARY_CHECK_SIZE = 8192
+MIN_STRING_LENGTH = 6
+PRINTABLE_STRINGS_PATTERN = re_compile(rb"[\t\x20-\x7e]{%d,}" % MIN_STRING_LENGTH)
+
+
+def is_binary(head: bytes) -> bool:
+    """Files with a NUL byte in the first BINARY_CHECK_SIZE bytes are binary, like git and grep."""
+    return b"\0" in head[:BINARY_CHECK_SIZE]
+
+
+def extract_printable_strings(data: bytes) -> bytes:
+    """Runs of at least MIN_STRING_LENGTH printable ASCII characters one per line, like the strings command."""
+    return b"\n".join(PRINTABLE_STRINGS_PATTERN.findall(data))
+
+
+def parse_routes(routes: Optional[Iterable[str]]) -> dict[str, tuple[str, ...]]:
+    """Parse '<EXT>[,<EXT>...] <LOCATOR_ID_GLOB>...' strings into globs of the locator ids to use for each ext."""
+    routes_by_ext: dict[str, tuple[str, ...]] = {}
+    for route in routes or ():
+        exts, *locator_id_globs = shlex_split(route)
+        for ext in exts.split(","):
+            ext = ext.lower() if ext.startswith(".") else f".{ext.lower()}"
+            routes_by_ext[ext] = (*routes_by_ext.get(ext, ()), *locator_id_globs)
+    return routes_by_ext
+
+
+class ScanFilter:
+    """
+    Decides what to scan of each decompiled file from its size and first bytes before it is scanned.
+    - Files over max_file_size bytes are scanned whole ("scan"), only the first max_file_size bytes ("sample"),
+      or not at all ("skip"). Sampled files are reported by SecretScanner since the rest is never scanned.
+    - Binary files (.so libraries, compiled resources, etc) are scanned raw ("scan"), only their printable strings
+      one per line ("strings"), or not at all ("skip"). Line numbers of strings are the index of the string.
+    - Files with an ext in routes are only scanned with the locators whose id matches one of the route's globs.
+    - When dedupe is True, files with the same content as a file already scanned get its results without scanning.
+    """
+
+    def __init__(
+        self,
+        max_file_size: int = 16 << 20,
+        oversized_action: Literal["scan", "sample", "skip"] = "scan",
+        binary_action: Literal["scan", "strings", "skip"] = "scan",
+        dedupe: bool = True,
+        routes: Optional[Iterable[str]] = None,
+    ) -> None:
+        self.max_file_size = max_file_size
+        self.oversized_action = oversized_action
+        self.binary_action = binary_action
+        self.dedupe = dedupe
+        self.routes = list(routes or ())
+        self.routes_by_ext = parse_routes(self.routes)
+
+    def check_file(self, file_path: Path) -> Optional[Literal["scan", "sample", "strings"]]:
+        """
+        How to read file_path decided from its size and first BINARY_CHECK_SIZE bytes, or None to not scan it.
+        Files to "scan" are read the same way as when there is no filter. See read_file for the others.
+        """
+        with file_path.open("rb") as f:
+            oversized = bool(self.max_file_size) and fstat(f.fileno()).st_size > self.max_file_size
+            if oversized and self.oversized_action == "skip":
+                return None
+            if self.binary_action != "scan" and is_binary(f.read(BINARY_CHECK_SIZE)):
+                return None if self.binary_action == "skip" else "strings"
+        return "sample" if oversized and self.oversized_action == "sample" else "scan"
+
+    def read_file(self, file_path: Path, read_action: Literal["sample", "strings"]) -> bytes:
+        """The bytes of file_path to scan for a read_action from check_file other than "scan"."""
+        with file_path.open("rb") as f:
+            read_size = -1
+            if self.is_sampled(fstat(f.fileno()).st_size):
+                read_size = self.max_file_size
+            data = f.read(read_size)
+        return extract_printable_strings(data) if read_action == "strings" else data
+
+    def is_sampled(self, file_size: int) -> bool:
+        """Whether only the first max_file_size bytes of a file of file_size are scanned."""
+        return self.oversized_action == "sample" and bool(self.max_file_size) and file_size > self.max_file_size
+
+    def route_locator_indices(self, file_ext: str, locator_ids: list[str]) -> Optional[frozenset[int]]:
+        """Indices of the locators to use on files with file_ext, or None to use all locators."""
+        if (locator_id_globs := self.routes_by_ext.get(file_ext.lower())) is None:
+            return None
+        return frozenset(
+            index
+            for index, locator_id in enumerate(locator_ids)
+            if any(fnmatchcase(locator_id, locator_id_glob) for locator_id_glob in locator_id_globs)
+        )
+
+    def options(self) -> dict:
+        """SecretScanner kwargs to rebuild this filter in a worker process."""
+        return {
+            "max_file_size": self.max_file_size,
+            "oversized_action": self.oversized_action,
+            "binary_action": self.binary_action,
+            "dedupe_files": self.dedupe,
+            "routes": self.routes,
+        }
+
+    def cache_key(self) -> str:
+        """Everything about the filter that affects scan results."""
+        return f"{self.max_file_size}:{self.oversized_action}:{self.binary_action}:{sorted(self.routes_by_ext.items())}"
+
+    def __repr__(self) -> str:
+        return f"ScanFilter(max_file_size={self.max_file_size}, oversized_action={self.oversized_action}, binary_action={self.binary_action}, dedupe={self.dedupe}, routes={self.routes})"
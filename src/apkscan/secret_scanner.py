@@ -1,12 +1,18 @@
 # © 2024 Lucas Faudman.
 # Licensed under the MIT License (see LICENSE for details).
 # For commercial use, see LICENSE for additional terms.
-from dataclasses import dataclass, field
-from typing import Optional, Iterator, Tuple
+from dataclasses import dataclass, field, replace
+from typing import Any, Optional, Iterable, Iterator, Literal, Tuple, Callable, TypeVar, Container
 from pathlib import Path
+from mmap import mmap, ACCESS_READ
+from bisect import bisect_left
+from os import fstat, cpu_count
+from hashlib import sha256
+from itertools import chain, repeat
 from re import (
     compile as re_compile,
     Pattern,
+    Match,
     IGNORECASE,
     MULTILINE,
     DOTALL,
@@ -18,7 +24,7 @@ from re import (
 )
 
 from yaml import safe_load as yaml_safe_load, YAMLError  # type: ignore
-from json import loads as json_loads, JSONDecodeError
+from json import loads as json_loads, JSONDecodeError, dump as json_dump
 
 try:
     # Use built-in tomllib if python 3.11+ otherwise ignore TOML files
@@ -30,10 +36,24 @@ except ImportError:
     TOML_SUPPORTED = False
 
 from .concurrent_executor import ConcurrentExecutor
+from .locator_matcher import CombinedLocatorMatcher, KeywordPrefilter, DEFAULT_CHUNK_SIZE, MATCHER_CACHE_VERSION
+from .locator_cache import make_cache_key, load_cached, save_cached
+from .result_cache import ScanResultCache, ResultRecord, hash_file_content
+from .prescan import iter_prescan_buffers
+from .scan_filter import ScanFilter
+from .locator_profiler import LocatorProfiler, LocatorStats
+from .locator_lint import LocatorLint, LINT_VERSION
+from .matcher_backend import get_matcher_backend
 from .included_secret_locators import INCLUDED_SECRET_LOCATOR_FILES  # type: ignore
 
+T = TypeVar("T")
+R = TypeVar("R")
+W = TypeVar("W")
+# Results of scanning a file as sent from worker processes. See SecretScanner.secret_results_to_records
+FileRecords = tuple[Path, list[ResultRecord]]
 
-@dataclass
+
+@dataclass(slots=True)
 class SecretLocator:
     id: str
     name: str
@@ -43,6 +63,7 @@ class SecretLocator:
     confidence: Optional[str] = "Unknown"
     severity: Optional[str] = "Unknown"
     tags: list[str] = field(default_factory=list)
+    keywords: list[str] = field(default_factory=list)
 
     def __hash__(self) -> int:
         return hash(self.pattern)
@@ -53,12 +74,14 @@ class SecretLocator:
         return self.pattern == other.pattern
 
 
-@dataclass
+@dataclass(slots=True)
 class SecretResult:
     secret: bytes
     file_path: Path
     line_number: int
     locator: SecretLocator
+    # Id of the input file and decompiler output dir the result was found in. See APKScanner.origins
+    origin: int = -1
 
     def __hash__(self) -> int:
         return hash(self.secret)
@@ -141,7 +164,8 @@ def load_gitleaks_format(locator_dicts: list[dict]) -> dict[str, SecretLocator]:
         locator_dict["pattern"] = compile_str_to_bytes_pattern(pattern_str)
         locator_dict["name"] = locator_dict["id"].replace("-", " ").title()
         locator_dict["secret_group"] = locator_dict.pop("secretGroup", 0)
-        locator_dict["tags"] = locator_dict.pop("keywords", [])
+        locator_dict["keywords"] = locator_dict.pop("keywords", [])
+        locator_dict["tags"] = list(locator_dict["keywords"])
         locator_dict.pop("entropy", None)
         locator_dict.pop("allowlist", None)
         secret_locators[pattern_str] = SecretLocator(**locator_dict)
@@ -178,25 +202,148 @@ def load_simple_key_value_format(simple_locator_dict: dict) -> dict[str, SecretL
     return secret_locators
 
 
-def load_secret_locators(secret_locator_files: list[Path]) -> dict[str, SecretLocator]:
+def parse_secret_locator_file(secret_locator_file: Path) -> dict[str, SecretLocator]:
+    if not (secret_locator_file_data := try_load_json_yaml_toml(secret_locator_file)):
+        return {}
+    if isinstance(secret_locator_file_data, list):
+        return load_secret_locators_format(secret_locator_file_data)
+    elif locator_dicts := secret_locator_file_data.get("patterns"):
+        return load_secrets_patterns_db_format(locator_dicts)
+    elif locator_dicts := secret_locator_file_data.get("rules"):
+        return load_gitleaks_format(locator_dicts)
+    else:
+        return load_simple_key_value_format(secret_locator_file_data)
+
+
+def secret_locator_to_record(pattern_str: str, locator: SecretLocator) -> tuple:
+    return (
+        pattern_str,
+        locator.id,
+        locator.name,
+        locator.pattern.pattern,
+        locator.pattern.flags,
+        locator.secret_group,
+        locator.description,
+        locator.confidence,
+        locator.severity,
+        list(locator.tags),
+        list(locator.keywords),
+    )
+
+
+def secret_locator_from_record(record: tuple) -> tuple[str, SecretLocator]:
+    pattern_str, id, name, pattern, flags, secret_group, description, confidence, severity, tags, keywords = record
+    return pattern_str, SecretLocator(
+        id=id,
+        name=name,
+        pattern=re_compile(pattern, flags),
+        secret_group=secret_group,
+        description=description,
+        confidence=confidence,
+        severity=severity,
+        tags=tags,
+        keywords=keywords,
+    )
+
+
+def load_secret_locator_file(secret_locator_file: Path, cache_dir: Optional[Path] = None) -> dict[str, SecretLocator]:
+    """Parse secret_locator_file or load its locators from cache_dir when it was already parsed with the same contents."""
+    if cache_dir is None or not secret_locator_file.exists():
+        return parse_secret_locator_file(secret_locator_file)
+
+    cache_key = make_cache_key("locators", secret_locator_file.read_bytes())
+    if (records := load_cached(cache_dir, cache_key)) is not None:
+        print(f"Loaded {len(records)} secret locators from cache for {secret_locator_file}")
+        return dict(map(secret_locator_from_record, records))
+
+    secret_locators = parse_secret_locator_file(secret_locator_file)
+    save_cached(cache_dir, cache_key, [secret_locator_to_record(*item) for item in secret_locators.items()])
+    return secret_locators
+
+
+def load_secret_locators(
+    secret_locator_files: list[Path], cache_dir: Optional[Path] = None
+) -> dict[str, SecretLocator]:
     print(f"\nLoading secret locators from {len(secret_locator_files)} files.")
     secret_locators: dict[str, SecretLocator] = {}
     for secret_locator_file in secret_locator_files:
-        if not (secret_locator_file_data := try_load_json_yaml_toml(secret_locator_file)):
-            continue
-        if isinstance(secret_locator_file_data, list):
-            secret_locators.update(load_secret_locators_format(secret_locator_file_data))
-        elif locator_dicts := secret_locator_file_data.get("patterns"):
-            secret_locators.update(load_secrets_patterns_db_format(locator_dicts))
-        elif locator_dicts := secret_locator_file_data.get("rules"):
-            secret_locators.update(load_gitleaks_format(locator_dicts))
-        else:
-            secret_locators.update(load_simple_key_value_format(secret_locator_file_data))
+        secret_locators.update(load_secret_locator_file(secret_locator_file, cache_dir))
 
     print(f"\nLoaded {len(secret_locators)} secret locators.")
     return secret_locators
 
 
+def iter_lines(data: bytes) -> Iterator[bytes]:
+    """Split data into lines the same way iterating over a binary file does."""
+    start = 0
+    while end := data.find(b"\n", start) + 1:
+        yield data[start:end]
+        start = end
+    if start < len(data):
+        yield data[start:]
+
+
+def find_newline_offsets(data: bytes | mmap) -> list[int]:
+    offsets = []
+    offset = data.find(b"\n")
+    while offset != -1:
+        offsets.append(offset)
+        offset = data.find(b"\n", offset + 1)
+    return offsets
+
+
+def compile_multiline_pattern(pattern: Pattern) -> Pattern:
+    """Return pattern with ^ and $ matching at line boundaries for searching whole buffers."""
+    if pattern.flags & MULTILINE or not any(anchor in pattern.pattern for anchor in (b"^", b"$")):
+        return pattern
+    return re_compile(pattern.pattern, pattern.flags | MULTILINE)
+
+
+def iter_file_sizes(file_paths: Iterable[Path]) -> Iterator[tuple[Path, int]]:
+    for file_path in file_paths:
+        try:
+            yield file_path, file_path.stat().st_size
+        except OSError:
+            yield file_path, 0
+
+
+def batch_file_paths_by_size(
+    file_paths: Iterable[Path], batch_size_bytes: int, max_batch_files: int, min_batches: int = 1
+) -> Iterator[list[Path]]:
+    """
+    Group file paths into batches of up to batch_size_bytes so each task scans many small files at once. A file
+    that would overflow a batch starts the next one, so a large file never holds up the small files batched with it.
+    When fewer than min_batches full batches of files are given, batches are made smaller so there are at least
+    min_batches of them and no worker sits idle. Only that many batches of files are read ahead.
+    """
+    sized_file_paths = iter_file_sizes(file_paths)
+    lookahead: list[tuple[Path, int]] = []
+    lookahead_bytes = 0
+    for file_path, file_size in sized_file_paths:
+        lookahead.append((file_path, file_size))
+        lookahead_bytes += file_size
+        if lookahead_bytes >= batch_size_bytes * min_batches and len(lookahead) >= min_batches:
+            break
+    else:
+        # Every file was read ahead, so split them evenly between min_batches batches
+        batch_size_bytes = min(batch_size_bytes, -(-lookahead_bytes // min_batches))
+        max_batch_files = min(max_batch_files, -(-len(lookahead) // min_batches))
+
+    batch: list[Path] = []
+    batch_bytes = 0
+    for file_path, file_size in chain(lookahead, sized_file_paths):
+        if batch and batch_bytes + file_size > batch_size_bytes:
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(file_path)
+        batch_bytes += file_size
+        if batch_bytes >= batch_size_bytes or len(batch) >= max_batch_files:
+            yield batch
+            batch, batch_bytes = [], 0
+    if batch:
+        yield batch
+
+
 def find_secret_locator_files_by_name(secret_locator_files: list[Path]):
     existing = []
     for secret_locator_file in secret_locator_files:
@@ -210,36 +357,776 @@ def find_secret_locator_files_by_name(secret_locator_files: list[Path]):
 class SecretScanner:
     def __init__(
         self,
+        combine_locators: bool = True,
+        combined_chunk_size: int = DEFAULT_CHUNK_SIZE,
+        prefilter_keywords: bool = True,
+        scan_mode: Literal["line", "mmap"] = "line",
+        batch_size_bytes: int = 1 << 20,
+        max_batch_files: int = 512,
+        worker_resident_locators: bool = True,
+        locator_cache_dir: Optional[Path | str] = None,
+        result_cache_path: Optional[Path | str] = None,
+        result_cache_max_age_days: Optional[float] = 30,
+        result_cache_max_size_bytes: Optional[int] = 256 << 20,
+        filter_files: bool = True,
+        max_file_size: int = 16 << 20,
+        oversized_action: Literal["scan", "sample", "skip"] = "scan",
+        binary_action: Literal["scan", "strings", "skip"] = "scan",
+        dedupe_files: bool = True,
+        routes: Optional[list[str]] = None,
+        profile_locators: bool = False,
+        locator_time_budget: Optional[float] = None,
+        profile_output: Optional[Path | str] = None,
+        lint_locators: bool = True,
+        drop_duplicate_locators: bool = False,
+        lint_report: Optional[Path | str] = None,
+        matcher_backend: Literal["re", "re2", "hyperscan"] = "re",
         **concurrent_executor_kwargs,
     ) -> None:
         self.secret_locator_files: list[Path] = []
         self.secret_locators: dict[str, SecretLocator] = {}
+        self.combine_locators = combine_locators
+        self.combined_chunk_size = combined_chunk_size
+        self.prefilter_keywords = prefilter_keywords
+        self.locator_matcher: Optional[CombinedLocatorMatcher] = None
+        self.lint_locators = lint_locators
+        self.drop_duplicate_locators = drop_duplicate_locators
+        self.lint_report = Path(lint_report) if lint_report else None
+        self.locator_lint: Optional[LocatorLint] = None
+        # Faster patterns lint rewrote locator patterns to. Rewrites find the same first match so are only used in
+        # line mode, and locators keep their own patterns.
+        self.rewritten_patterns: dict[Pattern, Pattern] = {}
+        self.matcher_backend = get_matcher_backend(matcher_backend)
+        # Patterns compiled by the matcher backend to search with in place of each locator's own pattern
+        self.backend_patterns: dict[Pattern, Any] = {}
+        # Patterns to search lines with in place of each locator's own pattern, from the backend or else lint
+        self.line_patterns: dict[Pattern, Any] = {}
+        self.scan_mode = scan_mode
+        self.multiline_patterns: dict[Pattern, Any] = {}
+        self.batch_size_bytes = batch_size_bytes
+        self.max_batch_files = max_batch_files
+        self.worker_resident_locators = worker_resident_locators
+        self.locator_cache_dir = Path(locator_cache_dir) if locator_cache_dir else None
+        self.result_cache = (
+            ScanResultCache(result_cache_path, result_cache_max_age_days, result_cache_max_size_bytes)
+            if result_cache_path
+            else None
+        )
+        self.scan_filter = (
+            ScanFilter(max_file_size, oversized_action, binary_action, dedupe_files, routes) if filter_files else None
+        )
+        self.routed_locator_indices: dict[str, Optional[frozenset[int]]] = {}
+        # Timing each locator search is only done when profiling or quarantining slow locators
+        self.locator_profiler = (
+            LocatorProfiler(locator_time_budget) if profile_locators or locator_time_budget is not None else None
+        )
+        self.profile_output = Path(profile_output) if profile_output else None
+        # Index of each locator by id() since locators are equal when their patterns are, even with different ids
+        self.locator_indices: dict[int, int] = {}
+        self.num_duplicates = 0
+        # Oversized files only the first max_file_size bytes of were scanned. Found before scanning so workers
+        # do not log them over the progress line.
+        self.sampled_file_paths: list[Path] = []
         self.results: dict[SecretLocator, list[SecretResult]] = {}
         self.concurrent_executor = ConcurrentExecutor(**{"concurrency_type": "process", **concurrent_executor_kwargs})
 
     def load_secret_locators(self, secret_locator_files: list[Path]) -> Tuple[dict[str, SecretLocator], list[Path]]:
         secret_locator_files = find_secret_locator_files_by_name(secret_locator_files)
         self.secret_locator_files.extend(secret_locator_files)
-        self.secret_locators.update(load_secret_locators(secret_locator_files))
+        self.secret_locators.update(load_secret_locators(secret_locator_files, self.locator_cache_dir))
+        if self.lint_locators and self.lint_secret_locators():
+            print(f"\n{self.locator_lint}")
+        self.routed_locator_indices.clear()
+        self.locator_indices.clear()
+        if self.build_backend_patterns():
+            num_compiled, num_locators = len(self.backend_patterns), len(self.secret_locators)
+            print(f"\nCompiled {num_compiled} of {num_locators} secret locators with {self.matcher_backend.name}.")
+        if self.build_locator_matcher():
+            print(f"\nBuilt {self.locator_matcher}")
         return self.secret_locators, self.secret_locator_files
 
+    def build_backend_patterns(self) -> dict[Pattern, Any]:
+        """Compile each locator pattern with the matcher backend. Locators it cannot compile keep searching with re."""
+        self.backend_patterns.clear()
+        self.multiline_patterns.clear()
+        for locator in self.secret_locators.values() if self.matcher_backend.name != "re" else ():
+            # Groups of other engines' matches are named by bytes, so locators with a named secret group keep using re
+            if isinstance(locator.secret_group, str):
+                continue
+            if (backend_pattern := self.matcher_backend.compile_pattern(locator.pattern)) is not None:
+                self.backend_patterns[locator.pattern] = backend_pattern
+        self.line_patterns = {**self.rewritten_patterns, **self.backend_patterns}
+        return self.backend_patterns
+
+    def lint_secret_locators(self) -> Optional[LocatorLint]:
+        """
+        Rewrite locator patterns prone to backtracking when an equivalent faster pattern is known, optionally drop
+        locators duplicating an earlier one, and write what was found to lint_report. See LocatorLint.
+        """
+        locators = list(self.secret_locators.values())
+        patterns = [locator.pattern for locator in locators]
+        secret_groups = [locator.secret_group for locator in locators]
+        cache_key = make_cache_key(
+            "lint",
+            str(LINT_VERSION),
+            *(
+                f"{pattern.flags}\0{secret_group}\0".encode() + pattern.pattern
+                for pattern, secret_group in zip(patterns, secret_groups)
+            ),
+        )
+        lint_state = None
+        if self.locator_cache_dir is not None:
+            lint_state = load_cached(self.locator_cache_dir, cache_key)
+        self.locator_lint = LocatorLint(patterns, secret_groups, state=lint_state)
+        if self.locator_cache_dir is not None and lint_state is None:
+            save_cached(self.locator_cache_dir, cache_key, self.locator_lint.get_state())
+
+        if self.lint_report is not None:
+            self.write_lint_report(self.lint_report, locators, self.locator_lint)
+        self.rewritten_patterns = {
+            locators[index].pattern: re_compile(rewritten, locators[index].pattern.flags)
+            for index, rewritten in self.locator_lint.rewrites.items()
+        }
+        if self.drop_duplicate_locators and self.locator_lint.duplicates:
+            duplicate_indices = {index for index, _ in self.locator_lint.duplicates}
+            self.secret_locators = {
+                pattern_str: locator
+                for index, (pattern_str, locator) in enumerate(self.secret_locators.items())
+                if index not in duplicate_indices
+            }
+            print(f"Dropped {len(duplicate_indices)} duplicate secret locators.")
+        return self.locator_lint
+
+    @staticmethod
+    def write_lint_report(report_path: Path, locators: list[SecretLocator], locator_lint: LocatorLint) -> None:
+        def describe(index: int) -> dict[str, str]:
+            return {
+                "locator_id": locators[index].id,
+                "pattern": locators[index].pattern.pattern.decode(errors="replace"),
+            }
+
+        report = {
+            "findings": [
+                {
+                    **describe(index),
+                    "findings": [{"kind": kind, "message": message} for kind, message in findings],
+                    "rewritten": (
+                        locator_lint.rewrites[index].decode(errors="replace")
+                        if index in locator_lint.rewrites
+                        else None
+                    ),
+                }
+                for index, findings in sorted(locator_lint.findings.items())
+            ],
+            "duplicates": [
+                {**describe(index), "duplicate_of": describe(original_index)}
+                for index, original_index in locator_lint.duplicates
+            ],
+            "subsumed": [
+                {**describe(index), "subsumed_by": describe(outer_index)}
+                for index, outer_index in locator_lint.subsumed
+            ],
+        }
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        with report_path.open("w") as f:
+            json_dump(report, f, indent=4)
+        print(f"Locator lint report written to {report_path}")
+
+    def build_locator_matcher(self) -> Optional[CombinedLocatorMatcher]:
+        if not (self.combine_locators or self.prefilter_keywords):
+            self.locator_matcher = None
+            return None
+
+        # Rewrites only change where a search starts trying, not whether it matches, so they gate whole buffers too
+        patterns = [
+            self.rewritten_patterns.get(locator.pattern, locator.pattern) for locator in self.secret_locators.values()
+        ]
+        chunk_size = self.combined_chunk_size if self.combine_locators else 0
+        cache_key = make_cache_key(
+            "matcher",
+            str(MATCHER_CACHE_VERSION),
+            self.rules_fingerprint(),
+            str(chunk_size),
+            str(self.prefilter_keywords),
+            f"lint{LINT_VERSION}" if self.lint_locators else "nolint",
+            self.matcher_backend.name,
+        )
+        prefilter_state, matcher_state = None, None
+        if self.locator_cache_dir is not None and (cached := load_cached(self.locator_cache_dir, cache_key)):
+            prefilter_state, matcher_state = cached
+
+        prefilter = (
+            KeywordPrefilter(
+                patterns,
+                keywords=(locator.keywords for locator in self.secret_locators.values()),
+                state=prefilter_state,
+            )
+            if self.prefilter_keywords
+            else None
+        )
+        self.locator_matcher = CombinedLocatorMatcher(
+            patterns, chunk_size=chunk_size, prefilter=prefilter, state=matcher_state, backend=self.matcher_backend
+        )
+
+        if self.locator_cache_dir is not None and matcher_state is None:
+            prefilter_state = prefilter.get_state() if prefilter is not None else None
+            save_cached(self.locator_cache_dir, cache_key, (prefilter_state, self.locator_matcher.get_state()))
+        return self.locator_matcher
+
+    def get_locators_and_matcher(self) -> tuple[list[SecretLocator], Optional[CombinedLocatorMatcher]]:
+        locators = list(self.secret_locators.values())
+        locator_matcher = self.locator_matcher
+        if locator_matcher is not None and len(locator_matcher) != len(locators):
+            # Locators were changed after the matcher was built
+            locator_matcher = self.build_locator_matcher()
+        return locators, locator_matcher
+
+    def get_routed_locator_indices(self, file_path: Path) -> Optional[frozenset[int]]:
+        """Indices of the locators the scan filter routes files like file_path to, or None for all locators."""
+        if self.scan_filter is None or not self.scan_filter.routes_by_ext:
+            return None
+        file_ext = file_path.suffix.lower()
+        if file_ext not in self.routed_locator_indices:
+            locator_ids = [locator.id for locator in self.secret_locators.values()]
+            self.routed_locator_indices[file_ext] = self.scan_filter.route_locator_indices(file_ext, locator_ids)
+        return self.routed_locator_indices[file_ext]
+
     def iterscan_file(self, file_path: Path) -> Iterator[SecretResult]:
+        locator_indices = None
+        if self.scan_filter is not None:
+            # The filter only looks at the size and first bytes so files it passes are read like unfiltered files
+            if (read_action := self.scan_filter.check_file(file_path)) is None:
+                return
+            locator_indices = self.get_routed_locator_indices(file_path)
+            if read_action != "scan":
+                yield from self.iterscan_file_filtered(file_path, self.scan_filter, read_action, locator_indices)
+                return
+        if self.scan_mode == "mmap":
+            yield from self.iterscan_file_mmap(file_path, locator_indices)
+            return
+
+        locators, locator_matcher = self.get_locators_and_matcher()
         with file_path.open("rb") as f:
-            for line_number, line in enumerate(f, start=1):
-                for locator in self.secret_locators.values():
-                    if match := locator.pattern.search(line):
+            if locator_matcher is not None or self.locator_profiler is not None:
+                yield from self.iterscan_data(f.read(), file_path, locator_indices)
+            elif locator_indices is not None:
+                routed_locators = [locator for index, locator in enumerate(locators) if index in locator_indices]
+                yield from self.iterscan_lines(f, file_path, routed_locators)
+            else:
+                yield from self.iterscan_lines(f, file_path, locators)
+
+    def iterscan_file_filtered(
+        self,
+        file_path: Path,
+        scan_filter: ScanFilter,
+        read_action: Literal["sample", "strings"],
+        locator_indices: Optional[Container[int]] = None,
+    ) -> Iterator[SecretResult]:
+        """Scan only the sample or strings scan_filter reads from file_path."""
+        data = scan_filter.read_file(file_path, read_action)
+        if self.scan_mode == "mmap":
+            yield from self.iterscan_buffer(data, file_path, locator_indices)
+        else:
+            yield from self.iterscan_data(data, file_path, locator_indices)
+
+    def iterscan_data(
+        self, data: bytes, file_path: Path, locator_indices: Optional[Container[int]] = None
+    ) -> Iterator[SecretResult]:
+        """Line mode scan of data already read from file_path, optionally only with the locators at locator_indices."""
+        if self.locator_profiler is not None:
+            yield from self.iterscan_data_profiled(data, file_path, locator_indices, self.locator_profiler)
+            return
+        locators, locator_matcher = self.get_locators_and_matcher()
+        # Gate the whole file once then only search the candidate locators on each line
+        candidate_indices: Iterable[int] = (
+            locator_matcher.iter_candidates(data) if locator_matcher is not None else range(len(locators))
+        )
+        if locator_indices is not None:
+            candidate_indices = filter(locator_indices.__contains__, candidate_indices)
+        if candidate_locators := [locators[index] for index in candidate_indices]:
+            yield from self.iterscan_lines(iter_lines(data), file_path, candidate_locators)
+
+    def iterscan_data_profiled(
+        self,
+        data: bytes,
+        file_path: Path,
+        locator_indices: Optional[Container[int]],
+        profiler: LocatorProfiler,
+    ) -> Iterator[SecretResult]:
+        """iterscan_data timing every search of each locator and skipping locators quarantined by profiler."""
+        locators, locator_matcher = self.get_locators_and_matcher()
+        file_stats: dict[int, LocatorStats] = {}
+        candidate_indices: Iterable[int] = (
+            locator_matcher.iter_candidates(data, profiler.gate_timer(file_stats))
+            if locator_matcher is not None
+            else range(len(locators))
+        )
+        if locator_indices is not None:
+            candidate_indices = filter(locator_indices.__contains__, candidate_indices)
+        line_patterns = self.line_patterns
+        clock = profiler.clock
+        candidates = [
+            (
+                index,
+                locators[index],
+                line_patterns.get(locators[index].pattern, locators[index].pattern),
+                file_stats.setdefault(index, LocatorStats()),
+            )
+            for index in candidate_indices
+            if index not in profiler.quarantined
+        ]
+
+        try:
+            for line_number, line in enumerate(iter_lines(data) if candidates else (), start=1):
+                for index, locator, pattern, stats in candidates:
+                    if index in profiler.quarantined:
+                        continue
+                    start = clock()
+                    match = pattern.search(line)
+                    elapsed = clock() - start
+                    stats.add(elapsed, match is not None, line_number)
+                    if profiler.is_over_budget(elapsed):
+                        profiler.quarantine(index)
+                        print(
+                            f"Quarantined locator {locator.id} after {elapsed:.3f}s searching {file_path}:{line_number}"
+                        )
+                    if match:
                         yield SecretResult(
                             secret=match.group(locator.secret_group),
                             file_path=file_path,
                             line_number=line_number,
                             locator=locator,
                         )
+        finally:
+            profiler.add_file_stats(file_path, file_stats)
+
+    def iterscan_lines(
+        self, lines: Iterable[bytes], file_path: Path, locators: list[SecretLocator]
+    ) -> Iterator[SecretResult]:
+        line_patterns = self.line_patterns
+        patterns = [(line_patterns.get(locator.pattern, locator.pattern), locator) for locator in locators]
+        for line_number, line in enumerate(lines, start=1):
+            for pattern, locator in patterns:
+                if match := pattern.search(line):
+                    yield SecretResult(
+                        secret=match.group(locator.secret_group),
+                        file_path=file_path,
+                        line_number=line_number,
+                        locator=locator,
+                    )
+
+    def iterscan_file_mmap(
+        self, file_path: Path, locator_indices: Optional[Container[int]] = None
+    ) -> Iterator[SecretResult]:
+        with file_path.open("rb") as f:
+            if not fstat(f.fileno()).st_size:
+                # Empty files cannot be memory-mapped
+                return
+            with mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+                yield from self.iterscan_buffer(data, file_path, locator_indices)
+
+    def iterscan_buffer(
+        self, data: bytes | mmap, file_path: Path, locator_indices: Optional[Container[int]] = None
+    ) -> Iterator[SecretResult]:
+        """
+        Scan a whole buffer with finditer so every match on a line is found, not only the first per locator.
+        Line numbers are found by bisecting newline offsets. ^ and $ match at line boundaries like in line mode,
+        but matches of patterns that can match newlines (e.g. \\s) may span lines and are reported on their first line.
+        Only the locators at locator_indices are used when it is not None. When profiling, each search of the
+        whole buffer by a locator is one call.
+        """
+        locators, locator_matcher = self.get_locators_and_matcher()
+        profiler = self.locator_profiler
+        file_stats: dict[int, LocatorStats] = {}
+        candidate_indices: Iterable[int] = (
+            locator_matcher.iter_candidates(data, profiler.gate_timer(file_stats) if profiler is not None else None)
+            if locator_matcher is not None
+            else range(len(locators))
+        )
+        if locator_indices is not None:
+            candidate_indices = filter(locator_indices.__contains__, candidate_indices)
+
+        newline_offsets: Optional[list[int]] = None
+        line_results: list[tuple[int, int, SecretResult]] = []
+        for locator_index in candidate_indices:
+            locator = locators[locator_index]
+            if (pattern := self.multiline_patterns.get(locator.pattern)) is None:
+                # Backend patterns are always compiled with MULTILINE set
+                if (pattern := self.backend_patterns.get(locator.pattern)) is None:
+                    pattern = compile_multiline_pattern(locator.pattern)
+                self.multiline_patterns[locator.pattern] = pattern
+
+            matches: Iterable[Match]
+            if profiler is not None:
+                if locator_index in profiler.quarantined:
+                    continue
+                start = profiler.clock()
+                matches = list(pattern.finditer(data))
+                elapsed = profiler.clock() - start
+                file_stats.setdefault(locator_index, LocatorStats()).add(elapsed, bool(matches), 0)
+                if profiler.is_over_budget(elapsed):
+                    profiler.quarantine(locator_index)
+                    print(f"Quarantined locator {locator.id} after {elapsed:.3f}s searching {file_path}")
+            else:
+                matches = pattern.finditer(data)
+
+            for match in matches:
+                if newline_offsets is None:
+                    newline_offsets = find_newline_offsets(data)
+                line_number = bisect_left(newline_offsets, match.start()) + 1
+                secret_result = SecretResult(
+                    secret=match.group(locator.secret_group),
+                    file_path=file_path,
+                    line_number=line_number,
+                    locator=locator,
+                )
+                line_results.append((line_number, locator_index, secret_result))
+
+        if profiler is not None:
+            profiler.add_file_stats(file_path, file_stats)
+        # Same order as line mode. Sort is stable so multiple matches on a line stay in order.
+        line_results.sort(key=lambda line_result: line_result[:2])
+        for _, _, secret_result in line_results:
+            yield secret_result
 
     def scan_file(self, file_path: Path) -> tuple[Path, list[SecretResult]]:
         return file_path, list(self.iterscan_file(file_path))
 
-    def scan_concurrently(self, file_paths: Iterator[Path]) -> Iterator[tuple[Path, list[SecretResult]]]:
-        yield from self.concurrent_executor.map(self.scan_file, file_paths)
+    def scan_batch(self, file_paths: list[Path]) -> list[tuple[Path, list[SecretResult]]]:
+        return [self.scan_file(file_path) for file_path in file_paths]
+
+    def prescan_file(self, file_path: Path) -> list[tuple[Path, list[SecretResult]]]:
+        """Scan strings, resources, and assets read directly from an APK/DEX file without decompiling it."""
+        return [
+            (buffer_path, list(self.iterscan_buffer(buffer, buffer_path)))
+            for buffer_path, buffer in iter_prescan_buffers(file_path)
+        ]
+
+    def rules_fingerprint(self) -> str:
+        """Hash of everything about the loaded locators that affects scan results."""
+        rules_hash = sha256()
+        for pattern_str, locator in self.secret_locators.items():
+            # Keywords decide which locators the prefilter skips
+            keywords = "\1".join(locator.keywords)
+            rules_hash.update(
+                f"{pattern_str}\0{locator.pattern.flags}\0{locator.secret_group}\0{locator.id}\0{keywords}\0".encode()
+            )
+        return rules_hash.hexdigest()
+
+    def worker_options(self) -> dict:
+        """Options needed to rebuild this scanner in a worker process."""
+        return {
+            "combine_locators": self.combine_locators,
+            "combined_chunk_size": self.combined_chunk_size,
+            "prefilter_keywords": self.prefilter_keywords,
+            "scan_mode": self.scan_mode,
+            "locator_cache_dir": self.locator_cache_dir,
+            "lint_locators": self.lint_locators,
+            "matcher_backend": self.matcher_backend.name,
+            "filter_files": self.scan_filter is not None,
+            "profile_locators": self.locator_profiler is not None,
+            "locator_time_budget": self.locator_profiler.time_budget if self.locator_profiler is not None else None,
+            **(self.scan_filter.options() if self.scan_filter is not None else {}),
+        }
+
+    def num_workers(self) -> int:
+        """Number of workers tasks are spread across, like the default max_workers of the executor."""
+        concurrency_type = self.concurrent_executor.concurrency_type
+        if not concurrency_type or concurrency_type == "main":
+            return 1
+        if self.concurrent_executor.max_workers:
+            return self.concurrent_executor.max_workers
+        num_cpus = cpu_count() or 1
+        return num_cpus if "proc" in concurrency_type else min(32, num_cpus + 4)
+
+    def uses_new_process_pool(self) -> bool:
+        concurrency_type = self.concurrent_executor.concurrency_type
+        return bool(concurrency_type) and "proc" in str(concurrency_type) and self.concurrent_executor.executor is None
+
+    def result_cache_key(self) -> str:
+        filter_key = self.scan_filter.cache_key() if self.scan_filter is not None else "unfiltered"
+        return f"{self.rules_fingerprint()}:{self.scan_mode}:{self.matcher_backend.name}:{filter_key}"
+
+    def get_locator_indices(self) -> dict[int, int]:
+        """Index of each loaded locator by its id(). Only rebuilt when locators are added or removed."""
+        if len(self.locator_indices) != len(self.secret_locators):
+            self.locator_indices = {id(locator): index for index, locator in enumerate(self.secret_locators.values())}
+        return self.locator_indices
+
+    def secret_results_to_records(self, secret_results: list[SecretResult]) -> list[ResultRecord]:
+        """Compact (secret, line_number, locator index) records that are much cheaper to pickle than SecretResults."""
+        locator_indices = self.get_locator_indices()
+        return [
+            (secret_result.secret, secret_result.line_number, locator_indices[id(secret_result.locator)])
+            for secret_result in secret_results
+        ]
+
+    def secret_results_from_records(self, file_path: Path, records: list[ResultRecord]) -> list[SecretResult]:
+        if not records:
+            return []
+        locators = list(self.secret_locators.values())
+        return [
+            SecretResult(secret=secret, file_path=file_path, line_number=line_number, locator=locators[locator_index])
+            for secret, line_number, locator_index in records
+        ]
+
+    def track_sampled_files(self, file_paths: Iterable[Path], scan_filter: ScanFilter) -> Iterator[Path]:
+        for file_path in file_paths:
+            try:
+                if scan_filter.is_sampled(file_path.stat().st_size):
+                    self.sampled_file_paths.append(file_path)
+            except OSError:
+                pass
+            yield file_path
+
+    def scan_concurrently(self, file_paths: Iterable[Path]) -> Iterator[tuple[Path, list[SecretResult]]]:
+        if self.scan_filter is not None and self.scan_filter.oversized_action == "sample":
+            file_paths = self.track_sampled_files(file_paths, self.scan_filter)
+        dedupe = self.scan_filter is not None and self.scan_filter.dedupe
+        if self.result_cache is None and not dedupe:
+            yield from self.scan_concurrently_uncached(file_paths)
+            return
+
+        # Only scan files whose content has not been scanned with the same rules before
+        result_cache = self.result_cache
+        rules_key = self.result_cache_key()
+        profiler = self.locator_profiler
+        content_hashes: dict[Path, str] = {}
+        # Files waiting on the scan of a file with the same content, and results of each content hash scanned
+        duplicate_file_paths: dict[str, list[Path]] = {}
+        scanned_results: dict[str, list[SecretResult]] = {}
+        ready_results: list[tuple[Path, list[SecretResult]]] = []
+        # Without a result cache files are only hashed once another file has the same size since only then can
+        # they be duplicates. The first file of each size is scanned without hashing and its results are kept
+        # until another file of its size is hashed.
+        unhashed_file_paths_by_size: dict[int, Path] = {}
+        unhashed_file_paths: set[Path] = set()
+        unhashed_results: dict[Path, list[SecretResult]] = {}
+        hashed_sizes: set[int] = set()
+
+        def hash_unhashed_file(file_path: Path) -> None:
+            try:
+                content_hash = hash_file_content(file_path)
+            except OSError:
+                unhashed_results.pop(file_path, None)
+                return
+            if (secret_results := unhashed_results.pop(file_path, None)) is not None:
+                scanned_results.setdefault(content_hash, secret_results)
+            else:
+                # Still being scanned so files with the same content wait for its results
+                content_hashes[file_path] = content_hash
+                duplicate_file_paths.setdefault(content_hash, [])
+
+        def copy_results(file_path: Path, secret_results: list[SecretResult]) -> tuple[Path, list[SecretResult]]:
+            self.num_duplicates += 1
+            return file_path, [
+                replace(secret_result, file_path=file_path, origin=-1) for secret_result in secret_results
+            ]
+
+        def files_to_scan() -> Iterator[Path]:
+            for file_path in file_paths:
+                if result_cache is None:
+                    try:
+                        file_size = file_path.stat().st_size
+                    except OSError:
+                        yield file_path
+                        continue
+                    if file_size not in hashed_sizes:
+                        if (unhashed_file_path := unhashed_file_paths_by_size.pop(file_size, None)) is None:
+                            unhashed_file_paths_by_size[file_size] = file_path
+                            unhashed_file_paths.add(file_path)
+                            yield file_path
+                            continue
+                        hashed_sizes.add(file_size)
+                        unhashed_file_paths.discard(unhashed_file_path)
+                        hash_unhashed_file(unhashed_file_path)
+                try:
+                    content_hash = hash_file_content(file_path)
+                except OSError:
+                    # Let the scan report the error
+                    yield file_path
+                    continue
+                if dedupe:
+                    if (secret_results := scanned_results.get(content_hash)) is not None:
+                        ready_results.append(copy_results(file_path, secret_results))
+                        continue
+                    if (waiting_file_paths := duplicate_file_paths.get(content_hash)) is not None:
+                        waiting_file_paths.append(file_path)
+                        continue
+                if result_cache is not None and (records := result_cache.get(content_hash, rules_key)) is not None:
+                    ready_results.append((file_path, self.secret_results_from_records(file_path, records)))
+                    continue
+                content_hashes[file_path] = content_hash
+                if dedupe:
+                    duplicate_file_paths[content_hash] = []
+                yield file_path
+
+        try:
+            for file_path, secret_results in self.scan_concurrently_uncached(files_to_scan()):
+                yield from ready_results
+                ready_results.clear()
+                yield file_path, secret_results
+                if file_path in unhashed_file_paths:
+                    unhashed_results[file_path] = secret_results
+                    continue
+                if (content_hash := content_hashes.pop(file_path, None)) is None:
+                    continue
+                # Results scanned after a locator was quarantined are missing its secrets so are not cached
+                if result_cache is not None and not (profiler is not None and profiler.quarantined):
+                    result_cache.put(content_hash, rules_key, self.secret_results_to_records(secret_results))
+                if dedupe:
+                    scanned_results[content_hash] = secret_results
+                    for duplicate_file_path in duplicate_file_paths.pop(content_hash, ()):
+                        yield copy_results(duplicate_file_path, secret_results)
+            yield from ready_results
+            ready_results.clear()
+        finally:
+            if result_cache is not None:
+                result_cache.evict()
+
+    def map_tasks(
+        self,
+        func: Callable[[T], R],
+        worker_func: Callable[[str, T], W],
+        tasks: Iterable[T],
+        from_worker: Callable[[W], R],
+    ) -> Iterator[R]:
+        profiler = self.locator_profiler
+        # Profiles are only sent back from worker processes started with resident locators, and backend databases
+        # would be compiled again for every task if the scanner was pickled with each one
+        resident = self.worker_resident_locators or profiler is not None or self.matcher_backend.name != "re"
+        if resident and self.uses_new_process_pool():
+            # Send locators to each worker process once when it starts so tasks only send file paths
+            # and results only send locator indices
+            fingerprint = self.rules_fingerprint()
+            _, locator_matcher = self.get_locators_and_matcher()
+            initializer_kwargs = {
+                "initializer": init_worker_scanner,
+                "initargs": (
+                    fingerprint,
+                    self.secret_locators,
+                    self.worker_options(),
+                    self.rewritten_patterns,
+                    locator_matcher,
+                ),
+            }
+            if profiler is None:
+                worker_results = self.concurrent_executor.map(
+                    worker_func, repeat(fingerprint), tasks, **initializer_kwargs
+                )
+                return map(from_worker, worker_results)
+
+            profiled_results = self.concurrent_executor.map(
+                profile_in_worker, repeat(worker_func), repeat(fingerprint), tasks, **initializer_kwargs
+            )
+            return (from_worker(self.merge_worker_profile(profiled_result)) for profiled_result in profiled_results)
+        return self.concurrent_executor.map(func, tasks)
+
+    def merge_worker_profile(self, profiled_result: tuple[W, tuple[dict[int, LocatorStats], set[int]]]) -> W:
+        worker_result, drained_profile = profiled_result
+        if self.locator_profiler is not None:
+            self.locator_profiler.merge(drained_profile)
+        return worker_result
+
+    def report_locator_profile(self, limit: int = 20) -> None:
+        """Print the slowest locators and write the full profile to profile_output when set."""
+        if self.locator_profiler is None:
+            return
+        locators = list(self.secret_locators.values())
+        print(self.locator_profiler.format_report(locators, limit))
+        if self.profile_output is not None:
+            self.locator_profiler.write_report(self.profile_output, locators)
+            print(f"Locator profile written to {self.profile_output}")
+
+    def file_result_from_records(self, file_records: FileRecords) -> tuple[Path, list[SecretResult]]:
+        file_path, records = file_records
+        return file_path, self.secret_results_from_records(file_path, records)
+
+    def file_results_from_records(self, file_records: list[FileRecords]) -> list[tuple[Path, list[SecretResult]]]:
+        return list(map(self.file_result_from_records, file_records))
+
+    def prescan_concurrently(self, file_paths: Iterable[Path]) -> Iterator[tuple[Path, list[SecretResult]]]:
+        for prescan_results in self.map_tasks(
+            self.prescan_file, prescan_file_in_worker, file_paths, self.file_results_from_records
+        ):
+            yield from prescan_results
+
+    def scan_concurrently_uncached(self, file_paths: Iterable[Path]) -> Iterator[tuple[Path, list[SecretResult]]]:
+        if self.batch_size_bytes <= 0 or self.max_batch_files <= 1:
+            yield from self.map_tasks(self.scan_file, scan_file_in_worker, file_paths, self.file_result_from_records)
+            return
+
+        # Each task scans a batch of files to amortize the pickling and IPC cost of submitting a task
+        batches = batch_file_paths_by_size(file_paths, self.batch_size_bytes, self.max_batch_files, self.num_workers())
+        for batch_results in self.map_tasks(
+            self.scan_batch, scan_batch_in_worker, batches, self.file_results_from_records
+        ):
+            yield from batch_results
+
+    def close_result_cache(self) -> None:
+        """Commit and close the result cache. Scans after this are not cached."""
+        if self.result_cache is not None:
+            self.result_cache.close()
+            self.result_cache = None
+
+    def __getstate__(self) -> dict:
+        # The result cache is only used in the main process and its connection cannot be pickled
+        return {**self.__dict__, "result_cache": None}
 
     def __repr__(self) -> str:
-        return f"SecretScanner(secret_locators={len(self.secret_locators)}, concurrent_executor={self.concurrent_executor}))"
+        return f"SecretScanner(secret_locators={len(self.secret_locators)}, combine_locators={self.combine_locators}, prefilter_keywords={self.prefilter_keywords}, lint_locators={self.lint_locators}, matcher_backend={self.matcher_backend.name}, scan_mode={self.scan_mode}, batch_size_bytes={self.batch_size_bytes}, max_batch_files={self.max_batch_files}, worker_resident_locators={self.worker_resident_locators}, scan_filter={self.scan_filter}, locator_profiler={self.locator_profiler}, locator_cache_dir={self.locator_cache_dir}, result_cache={self.result_cache}, concurrent_executor={self.concurrent_executor}))"
+
+
+# Scanners built once per worker process by init_worker_scanner keyed by rules fingerprint
+WORKER_SCANNERS: dict[str, SecretScanner] = {}
+
+
+def init_worker_scanner(
+    fingerprint: str,
+    secret_locators: dict[str, SecretLocator],
+    scanner_options: dict,
+    rewritten_patterns: Optional[dict[Pattern, Pattern]] = None,
+    locator_matcher: Optional[CombinedLocatorMatcher] = None,
+) -> None:
+    scanner = SecretScanner(concurrency_type="main", **scanner_options)
+    scanner.secret_locators = secret_locators
+    scanner.rewritten_patterns = rewritten_patterns or {}
+    scanner.build_backend_patterns()
+    # Reuse the matcher built by the main process so each worker does not build it and compile its database again
+    if locator_matcher is not None:
+        scanner.locator_matcher = locator_matcher
+    else:
+        scanner.build_locator_matcher()
+    WORKER_SCANNERS[fingerprint] = scanner
+
+
+def file_results_to_records(
+    scanner: SecretScanner, file_results: list[tuple[Path, list[SecretResult]]]
+) -> list[FileRecords]:
+    return [
+        (file_path, scanner.secret_results_to_records(secret_results)) for file_path, secret_results in file_results
+    ]
+
+
+def scan_file_in_worker(fingerprint: str, file_path: Path) -> FileRecords:
+    scanner = WORKER_SCANNERS[fingerprint]
+    return file_results_to_records(scanner, [scanner.scan_file(file_path)])[0]
+
+
+def scan_batch_in_worker(fingerprint: str, file_paths: list[Path]) -> list[FileRecords]:
+    scanner = WORKER_SCANNERS[fingerprint]
+    return file_results_to_records(scanner, scanner.scan_batch(file_paths))
+
+
+def profile_in_worker(
+    worker_func: Callable[[str, T], W], fingerprint: str, task: T
+) -> tuple[W, tuple[dict[int, LocatorStats], set[int]]]:
+    """Run worker_func and send the locator profile of the task back with its result."""
+    worker_result = worker_func(fingerprint, task)
+    profiler = WORKER_SCANNERS[fingerprint].locator_profiler
+    return worker_result, profiler.drain() if profiler is not None else ({}, set())
+
+
+def prescan_file_in_worker(fingerprint: str, file_path: Path) -> list[FileRecords]:
+    scanner = WORKER_SCANNERS[fingerprint]
+    return file_results_to_records(scanner, scanner.prescan_file(file_path))
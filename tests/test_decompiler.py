@@ -2,8 +2,18 @@
 # Licensed under the MIT License (see LICENSE for details).
 # For commercial use, see LICENSE for additional terms.
 import pytest
+import sys
 from pathlib import Path
+from zipfile import ZipFile
+from threading import Thread
+from time import monotonic, sleep
+from os import kill
+from multiprocessing import get_start_method
 from apkscan import Decompiler
+from apkscan import decompiler as decompiler_module
+from apkscan.decompiler import iter_largest_first
+from apkscan.decompiler_daemon import DecompilerDaemon, DaemonTimeout, JAVA_MAIN_DAEMON
+from apkscan.resource_scheduler import ResourceScheduler
 
 
 @pytest.mark.parametrize(
@@ -31,3 +41,397 @@ def test_decompile(tmpdir, test_apk):
     assert success
     decompiler.cleanup()
     assert not output_dir.exists()
+
+
+def test_decompile_cache(tmpdir):
+    tmpdir_path = Path(tmpdir)
+    # Fake jadx that writes the input file into the output dir and counts its runs
+    fake_jadx = tmpdir_path / "jadx"
+    fake_jadx.write_text(
+        "#!/bin/sh\n"
+        'for arg; do input="$arg"; done\n'
+        'while [ "$1" != "--output-dir" ]; do shift; done\n'
+        'mkdir -p "$2/sources" && cp "$input" "$2/sources/Main.java"\n'
+        f'echo run >> "{tmpdir_path / "runs"}"\n'
+    )
+    fake_jadx.chmod(0o755)
+    test_apk_path = tmpdir_path / "app.apk"
+    test_apk_path.write_text("version 1")
+
+    def decompile(working_dir: Path, binary: Path = fake_jadx) -> set[Path]:
+        decompiler = Decompiler(
+            binaries={"jadx": binary}, working_dir=working_dir, cache_dir=tmpdir_path / "decompile_cache"
+        )
+        file_path, output_dir, decompiled_files, success = decompiler.decompile(("jadx", test_apk_path))
+        assert success and decompiled_files == {output_dir / "sources" / "Main.java"}
+        return decompiled_files
+
+    def num_runs() -> int:
+        return (tmpdir_path / "runs").read_text().count("run")
+
+    assert decompile(tmpdir_path / "run1").pop().read_text() == "version 1"
+    assert decompile(tmpdir_path / "run2").pop().read_text() == "version 1"
+    assert num_runs() == 1
+
+    # Same file name with new content is decompiled again instead of reusing the stale output
+    test_apk_path.write_text("version 2")
+    assert decompile(tmpdir_path / "run1").pop().read_text() == "version 2"
+    assert num_runs() == 2
+
+    # Moving the binary keeps using the cache but a different binary does not
+    moved_jadx = tmpdir_path / "bin" / "jadx"
+    moved_jadx.parent.mkdir()
+    fake_jadx.rename(moved_jadx)
+    decompile(tmpdir_path / "run3", moved_jadx)
+    assert num_runs() == 2
+    moved_jadx.write_text(moved_jadx.read_text() + "# version 2\n")
+    decompile(tmpdir_path / "run4", moved_jadx)
+    assert num_runs() == 3
+
+    # Output of runs that fail is not cached
+    moved_jadx.write_text(moved_jadx.read_text() + "exit 1\n")
+    for run_number in range(2):
+        decompile(tmpdir_path / f"failed{run_number}", moved_jadx)
+    assert num_runs() == 5
+
+
+@pytest.mark.parametrize("concurrency_type", ["main", "thread"])
+def test_decompile_streaming(tmpdir, concurrency_type):
+    tmpdir_path = Path(tmpdir)
+    # Fake jadx that writes one file then another after the first should have been streamed
+    fake_jadx = tmpdir_path / "jadx"
+    fake_jadx.write_text(
+        "#!/bin/sh\n"
+        'while [ "$1" != "--output-dir" ]; do shift; done\n'
+        'mkdir -p "$2/sources" && echo first > "$2/sources/First.java"\n'
+        'sleep 1 && echo second > "$2/sources/Second.java"\n'
+    )
+    fake_jadx.chmod(0o755)
+    test_apk_paths = [tmpdir_path / "app1.apk", tmpdir_path / "app2.apk"]
+    for test_apk_path in test_apk_paths:
+        test_apk_path.touch()
+
+    decompiler = Decompiler(
+        binaries={"jadx": fake_jadx},
+        working_dir=tmpdir_path,
+        stream_output=True,
+        stream_poll_interval=0.1,
+        concurrency_type=concurrency_type,
+    )
+    results = list(decompiler.decompile_streaming_concurrently(test_apk_paths))
+    assert len(results) == 4
+    for test_apk_path in test_apk_paths:
+        apk_results = [result for result in results if result[0] == test_apk_path]
+        (_, output_dir, streamed_files, streamed_success), (_, _, final_files, success) = apk_results
+        assert streamed_success is None and success
+        assert streamed_files == {output_dir / "sources" / "First.java"}
+        assert final_files == {output_dir / "sources" / "Second.java"}
+
+
+def test_decompile_streaming_rescans_changed_files(tmpdir):
+    tmpdir_path = Path(tmpdir)
+    # Fake jadx that pauses partway through writing a file long enough for it to be streamed
+    fake_jadx = tmpdir_path / "jadx"
+    fake_jadx.write_text(
+        "#!/bin/sh\n"
+        'while [ "$1" != "--output-dir" ]; do shift; done\n'
+        'mkdir -p "$2/sources" && echo partial > "$2/sources/First.java"\n'
+        'sleep 1 && echo rest >> "$2/sources/First.java"\n'
+    )
+    fake_jadx.chmod(0o755)
+    test_apk_path = tmpdir_path / "app.apk"
+    test_apk_path.touch()
+
+    decompiler = Decompiler(
+        binaries={"jadx": fake_jadx}, working_dir=tmpdir_path, stream_output=True, stream_poll_interval=0.1
+    )
+    (_, output_dir, streamed_files, _), (_, _, final_files, success) = decompiler.decompile_streaming_concurrently(
+        [test_apk_path]
+    )
+    assert success
+    assert streamed_files == {output_dir / "sources" / "First.java"}
+    assert final_files == {output_dir / "sources" / "First.java"}
+
+
+@pytest.mark.parametrize("skip_media_files", [False, True])
+def test_decompile_index_skip_exts(tmpdir, skip_media_files):
+    tmpdir_path = Path(tmpdir)
+    fake_jadx = tmpdir_path / "jadx"
+    fake_jadx.write_text(
+        "#!/bin/sh\n"
+        'while [ "$1" != "--output-dir" ]; do shift; done\n'
+        'mkdir -p "$2/resources" && echo key > "$2/resources/icon.PNG" && echo key > "$2/resources/notes.log"\n'
+    )
+    fake_jadx.chmod(0o755)
+    test_apk_path = tmpdir_path / "app.apk"
+    test_apk_path.touch()
+
+    decompiler = Decompiler(
+        binaries={"jadx": fake_jadx},
+        working_dir=tmpdir_path,
+        index_skip_exts=[".LOG"],
+        skip_media_files=skip_media_files,
+    )
+    _, output_dir, decompiled_files, success = decompiler.decompile(("jadx", test_apk_path))
+    # Media files are only left out when asked for
+    assert success
+    assert decompiled_files == (set() if skip_media_files else {output_dir / "resources" / "icon.PNG"})
+
+
+def test_unpack_xapk(tmpdir):
+    tmpdir_path = Path(tmpdir)
+    xapk_path = tmpdir_path / "bundle.xapk"
+    apk_contents = {"base.apk": b"base" * 1000, "splits/config.arm64.apk": b"split" * 1000}
+    with ZipFile(xapk_path, "w") as xapk_zip:
+        for name, content in apk_contents.items():
+            xapk_zip.writestr(name, content)
+        xapk_zip.writestr("icon.png", b"not an apk")
+
+    decompiler = Decompiler(binaries={"jadx": "/bin/true"}, working_dir=tmpdir_path)
+    for _ in range(2):
+        # Second unpack reuses the extracted APKs
+        apk_paths = sorted(decompiler.unpack_files([xapk_path]))
+        assert [apk_path.read_bytes() for apk_path in apk_paths] == list(apk_contents.values())
+        assert apk_paths[0].name == "bundle__base.apk"
+
+    # An APK with the right size but different content, e.g. from an interrupted run, is extracted again
+    apk_paths[0].write_bytes(b"BASE" * 1000)
+    apk_paths = sorted(decompiler.unpack_files([xapk_path]))
+    assert [apk_path.read_bytes() for apk_path in apk_paths] == list(apk_contents.values())
+    assert not list(apk_paths[0].parent.glob("*.tmp"))
+
+
+def test_resource_scheduler():
+    scheduler = ResourceScheduler(max_cpu=4, max_memory_mb=1000, min_available_memory_mb=0)
+    # Always admits a job when nothing is running even if it is over budget
+    scheduler.acquire(8, 2000)
+    assert not scheduler.fits(1, 1)
+    scheduler.release(8, 2000)
+
+    scheduler.acquire(2, 500)
+    assert not scheduler.fits(3, 100) and not scheduler.fits(1, 600)
+    admitted = []
+    waiter = Thread(target=lambda: admitted.append(scheduler.acquire(3, 100)))
+    waiter.start()
+    waiter.join(0.2)
+    assert not admitted
+    scheduler.release(2, 500)
+    waiter.join(5)
+    assert admitted and scheduler.num_running == 1
+
+
+def test_schedule_largest_first(tmpdir):
+    tmpdir_path = Path(tmpdir)
+    file_paths = []
+    for size in (1, 3, 2):
+        file_path = tmpdir_path / f"app{size}.apk"
+        file_path.write_bytes(b"\0" * (size << 20))
+        file_paths.append(file_path)
+    decompiler = Decompiler(binaries={"jadx": "/bin/true"}, working_dir=tmpdir_path)
+    assert [file_path.name for _, file_path in decompiler.scheduled_binary_name_file_paths(file_paths)] == [
+        "app3.apk",
+        "app2.apk",
+        "app1.apk",
+    ]
+
+
+def test_iter_largest_first_reads_ahead_lazily():
+    consumed = []
+
+    def items():
+        for item in (1, 5, 2, 4, 3, 9):
+            consumed.append(item)
+            yield item
+
+    largest_first = iter_largest_first(items(), key=lambda item: (item,), lookahead=3)
+    assert next(largest_first) == 5 and consumed == [1, 5, 2, 4]
+    assert list(largest_first) == [4, 9, 3, 2, 1]
+
+
+def process_is_running(pid: int, wait: float = 2) -> bool:
+    deadline = monotonic() + wait
+    while monotonic() < deadline:
+        try:
+            kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        # Killed processes reparented to an init that does not reap them stay zombies
+        stat_path = Path(f"/proc/{pid}/stat")
+        if stat_path.exists() and stat_path.read_text().split()[2] == "Z":
+            return False
+        sleep(0.1)
+    return True
+
+
+@pytest.mark.parametrize(
+    "timeouts,keep_partial_output",
+    [({"stall_timeout": 0.5}, True), ({"binary_timeout": 1}, True), ({"binary_timeout": 1}, False)],
+)
+def test_decompile_timeouts(tmpdir, monkeypatch, timeouts, keep_partial_output):
+    tmpdir_path = Path(tmpdir)
+    # Fake jadx that keeps writing output from a child process that never exits
+    fake_jadx = tmpdir_path / "jadx"
+    fake_jadx.write_text(
+        "#!/bin/sh\n"
+        'while [ "$1" != "--output-dir" ]; do shift; done\n'
+        'mkdir -p "$2/sources" && echo partial > "$2/sources/Partial.java"\n'
+        f'sh -c \'echo $$ > "{tmpdir_path / "child_pid"}"; '
+        'while true; do [ -n "$WRITE" ] && date >> "$0/progress.log"; sleep 0.1; done\' "$2"\n'
+    )
+    fake_jadx.chmod(0o755)
+    test_apk_path = tmpdir_path / "app.apk"
+    test_apk_path.touch()
+
+    # Only keep writing when testing binary_timeout so stall_timeout is not hit first
+    monkeypatch.setenv("WRITE", "1" if "binary_timeout" in timeouts else "")
+    decompiler = Decompiler(
+        binaries={"jadx": fake_jadx},
+        working_dir=tmpdir_path,
+        keep_partial_output=keep_partial_output,
+        **timeouts,
+    )
+    start_time = monotonic()
+    file_path, output_dir, decompiled_files, success = decompiler.decompile(("jadx", test_apk_path))
+    assert monotonic() - start_time < 10
+    assert output_dir in decompiler.timed_out
+    child_pid = int((tmpdir_path / "child_pid").read_text())
+    assert not process_is_running(child_pid)
+
+    if keep_partial_output:
+        assert success and output_dir / "sources" / "Partial.java" in decompiled_files
+    else:
+        assert not success and decompiled_files is None and not output_dir.exists()
+
+
+FAKE_DAEMON = """
+import json, os, sys
+for line in sys.stdin:
+    args = json.loads(line)["args"]
+    output_dir = args[args.index("--output-dir") + 1]
+    os.makedirs(os.path.join(output_dir, "sources"), exist_ok=True)
+    # Decompiler logs on stdout, including a partial line, are ignored
+    print("INFO  - loading ...", flush=True)
+    with open(os.path.join(output_dir, "sources", "Main.java"), "w") as f:
+        f.write(str(os.getpid()))
+    print("INFO  - done", end="", flush=True)
+    print("\\nAPKSCAN_DAEMON_RESPONSE " + json.dumps({"success": True}), flush=True)
+"""
+
+
+def test_decompile_daemon(tmpdir):
+    tmpdir_path = Path(tmpdir)
+    fake_daemon = tmpdir_path / "fake_daemon.py"
+    fake_daemon.write_text(FAKE_DAEMON)
+    fake_jadx = tmpdir_path / "jadx"
+    fake_jadx.write_text(
+        "#!/bin/sh\n"
+        'while [ "$1" != "--output-dir" ]; do shift; done\n'
+        'mkdir -p "$2/sources" && echo one-shot > "$2/sources/Main.java"\n'
+    )
+    fake_jadx.chmod(0o755)
+    test_apk_paths = [tmpdir_path / f"app{i}.apk" for i in range(3)]
+    for test_apk_path in test_apk_paths:
+        test_apk_path.touch()
+
+    decompiler = Decompiler(
+        binaries={"jadx": fake_jadx},
+        working_dir=tmpdir_path,
+        daemons=[f"jadx {sys.executable} {fake_daemon}"],
+        concurrency_type="main",
+    )
+    daemon_pids = set()
+    for file_path, output_dir, decompiled_files, success in decompiler.decompile_concurrently(test_apk_paths):
+        assert success and decompiled_files == {output_dir / "sources" / "Main.java"}
+        daemon_pids.add(decompiled_files.pop().read_text())
+    # One warm daemon ran every job
+    assert len(daemon_pids) == 1 and daemon_pids.pop().isdigit()
+    decompiler.close_daemons()
+
+    # Falls back to running the binary when the daemon fails
+    broken_decompiler = Decompiler(
+        binaries={"jadx": fake_jadx},
+        working_dir=tmpdir_path / "broken",
+        daemons=[f"jadx {sys.executable} -c 'pass'"],
+    )
+    file_path, output_dir, decompiled_files, success = broken_decompiler.decompile(("jadx", test_apk_paths[0]))
+    assert success and decompiled_files.pop().read_text() == "one-shot\n"
+
+    # Passing a jar runs the bundled daemon for decompilers that have one
+    bundled_decompiler = Decompiler(
+        binaries={"jadx": fake_jadx, "cfr": fake_jadx},
+        working_dir=tmpdir_path,
+        daemons=["cfr /opt/cfr.jar", "jadx /opt/jadx.jar"],
+    )
+    assert bundled_decompiler.daemon_commands == {
+        "cfr": ["java", "-cp", "/opt/cfr.jar", str(JAVA_MAIN_DAEMON), "org.benf.cfr.reader.Main"]
+    }
+    assert JAVA_MAIN_DAEMON.exists()
+
+
+def test_daemon_partial_line_timeout():
+    # A partial line without a newline must not block reading past the timeout
+    daemon = DecompilerDaemon(
+        [
+            sys.executable,
+            "-c",
+            "import sys, time; sys.stdin.readline(); print('partial', end='', flush=True); time.sleep(10)",
+        ]
+    )
+    start_time = monotonic()
+    with pytest.raises(DaemonTimeout):
+        daemon.run([], timeout=0.5)
+    assert monotonic() - start_time < 5
+    daemon.kill()
+
+
+def fake_enjarify(file_path, jar_file, overwrite=True, quiet=False):
+    Path(jar_file).write_bytes(Path(file_path).read_bytes() + b" as jar")
+
+
+@pytest.mark.parametrize("concurrency_type", ["main", "thread"])
+def test_enjarify_concurrently(tmpdir, monkeypatch, concurrency_type):
+    if concurrency_type != "main" and get_start_method() != "fork":
+        pytest.skip("Worker processes only use the fake enjarify when forked")
+    tmpdir_path = Path(tmpdir)
+    monkeypatch.setattr(decompiler_module, "enjarify", fake_enjarify)
+    conversions: list[tuple] = []
+    if concurrency_type == "main":
+        # Conversions in worker processes cannot be counted here but are checked by the number of cached jars
+        enjarify_to_jar = decompiler_module.enjarify_to_jar
+        monkeypatch.setattr(
+            decompiler_module, "enjarify_to_jar", lambda *args: conversions.append(args) or enjarify_to_jar(*args)
+        )
+    # Split APKs with identical content are only converted once
+    file_paths = [
+        tmpdir_path / "base.apk",
+        tmpdir_path / "split1.apk",
+        tmpdir_path / "split2.apk",
+        tmpdir_path / "a.jar",
+    ]
+    for file_path, content in zip(file_paths, [b"base", b"split", b"split", b"jar"]):
+        file_path.write_bytes(content)
+
+    cache_dir = tmpdir_path / "enjarify_cache"
+    decompiler = Decompiler(
+        binaries={"jadx": "/bin/true"},
+        working_dir=tmpdir_path / "out",
+        enjarify_choice="always",
+        enjarify_cache_dir=cache_dir,
+        concurrency_type=concurrency_type,
+    )
+    jar_files = sorted(decompiler.enjarify_concurrently(file_paths))
+    assert [jar_file.read_bytes() for jar_file in jar_files] == [
+        b"jar",
+        b"base as jar",
+        b"split as jar",
+        b"split as jar",
+    ]
+    if concurrency_type == "main":
+        assert len(conversions) == 2
+    assert len(list(cache_dir.glob("*.jar"))) == 2
+
+    # Cached jars are reused by later runs
+    decompiler.working_dir = tmpdir_path / "out2"
+    conversions.clear()
+    assert len(list(decompiler.enjarify_concurrently(file_paths))) == 4
+    assert not conversions and len(list(cache_dir.glob("*.jar"))) == 2
@@ -0,0 +1,81 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+from pathlib import Path
+from apkscan.file_index import FileIndex, OutputProgress, iter_file_entries, file_ext
+
+
+def make_tree(root: Path) -> set[Path]:
+    files = {
+        root / "sources" / "com" / "example" / "Main.java",
+        root / "sources" / "com" / "example" / "Util.java",
+        root / "resources" / "AndroidManifest.xml",
+        root / "resources" / "res" / "drawable" / "icon.PNG",
+        root / "classes.dex",
+    }
+    for file in files:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_text(file.name)
+    (root / "empty_dir").mkdir()
+    return files
+
+
+def test_iter_file_entries(tmpdir):
+    root = Path(tmpdir)
+    files = make_tree(root)
+    (root / "linked_dir").symlink_to(root / "sources", target_is_directory=True)
+    assert {Path(entry.path) for entry in iter_file_entries(root)} == files
+    assert {Path(entry.path) for entry in iter_file_entries(root, {".png", ".dex"})} == {
+        file for file in files if file.suffix not in (".PNG", ".dex")
+    }
+    assert not list(iter_file_entries(root / "missing"))
+
+
+def test_file_ext():
+    for name in ("Main.java", "icon.PNG", "archive.tar.gz", ".hidden", "no_ext", "trailing."):
+        assert file_ext(name) == Path(name).suffix.lower()
+
+
+def test_file_index(tmpdir):
+    root = Path(tmpdir)
+    files = make_tree(root)
+    file_index = FileIndex.from_dir(root)
+    assert file_index == files and files == file_index
+    assert len(file_index) == len(files) and set(file_index) == files
+    assert all(file in file_index for file in files) and str(root / "classes.dex") in file_index
+    assert root / "missing.java" not in file_index and None not in file_index
+    # Directory strings are shared by files in the same directory
+    assert len(file_index.files_by_dir) == 4
+
+    streamed_files = FileIndex([root / "classes.dex", root / "resources" / "AndroidManifest.xml"])
+    file_index -= streamed_files
+    assert file_index == files - set(streamed_files)
+    assert (file_index | streamed_files) == files and (file_index | list(streamed_files)) == files
+
+    file_index.discard(root / "missing.java")
+    while file_index:
+        files.discard(file_index.pop())
+    assert len(file_index) == 0 and not file_index.files_by_dir
+    assert files == set(streamed_files)
+
+
+def test_output_progress(tmpdir):
+    root = Path(tmpdir)
+    make_tree(root)
+    output_progress = OutputProgress(root)
+    assert output_progress.changed()
+    # Files listed on the last call are checked once more then only dirs are stat'd
+    assert not output_progress.changed() and not output_progress.changed()
+    assert not output_progress.file_sizes
+
+    new_file = root / "sources" / "com" / "example" / "New.java"
+    new_file.write_text("class New {")
+    assert output_progress.changed()
+    with new_file.open("a") as f:
+        f.write("}")
+    assert output_progress.changed()
+    assert not output_progress.changed()
+
+    (root / "sources" / "com" / "other").mkdir()
+    assert output_progress.changed()
+    assert not OutputProgress(root / "missing").changed()
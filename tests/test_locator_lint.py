@@ -0,0 +1,156 @@
+# © 2024 Lucas Faudman.
+# Licensed under the MIT License (see LICENSE for details).
+# For commercial use, see LICENSE for additional terms.
+import pytest
+from fixtures import tmp_locator_files, tmp_files_to_scan
+from json import loads as json_loads
+from random import Random
+from re import compile as re_compile, IGNORECASE, DOTALL
+from apkscan import SecretScanner, SecretLocator
+from apkscan.locator_lint import LocatorLint, lint_pattern
+from apkscan.locator_matcher import make_combinable_fragment
+from apkscan.secret_scanner import INCLUDED_SECRET_LOCATOR_FILES
+
+
+@pytest.mark.parametrize(
+    "pattern, kinds",
+    [
+        (rb"(a+)+b", {"nested-quantifier"}),
+        (rb"(\w+\s?)*$", {"nested-quantifier"}),
+        (rb"(?:[a-z]+\.)+com", set()),
+        (rb"key\w+\d+", {"overlapping-repeats"}),
+        (rb"key.*=.*.*", {"overlapping-repeats"}),
+        (rb".{0,40}key", {"leading-window"}),
+        (rb"[a-z0-9.-]+\.s3\.amazonaws\.com", {"rewritten"}),
+        (rb"([a-z0-9]+)@example\.com", {"rewritten"}),
+        (rb"\bkey[a-z]+", set()),
+        (rb"([a-z]+)=\1", {"unanchored-leading-repeat"}),
+        (rb"([a-z]+)(=)?(?(2)x|y)", {"unanchored-leading-repeat"}),
+        (rb"AKIA[0-9A-Z]{16}", set()),
+    ],
+)
+def test_lint_pattern(pattern, kinds):
+    findings, rewritten = lint_pattern(re_compile(pattern))
+    assert {kind for kind, _ in findings} == kinds
+    assert (rewritten is not None) == ("rewritten" in kinds)
+
+
+@pytest.mark.parametrize(
+    "pattern, flags",
+    [
+        (rb"[a-z0-9.-]+\.s3\.amazonaws\.com", 0),
+        (rb"[a-z]+@x", IGNORECASE),
+        (rb"([a-z0-9]*)@(x+)", 0),
+        (rb".+=", DOTALL),
+        (rb"[^@]+?@[a-z]", 0),
+        (rb"\w+\d", 0),
+    ],
+)
+def test_rewrites_find_same_first_match(pattern, flags):
+    original = re_compile(pattern, flags)
+    _, rewritten = lint_pattern(original)
+    assert rewritten is not None
+    rewritten_pattern = re_compile(rewritten, flags)
+
+    random = Random(0)
+    for _ in range(500):
+        line = bytes(random.choice(b"aAzZ09.-@x=\n s3") for _ in range(random.randint(0, 40)))
+        original_match = original.search(line)
+        rewritten_match = rewritten_pattern.search(line)
+        assert (rewritten_match is None) == (original_match is None)
+        if original_match and rewritten_match:
+            assert (rewritten_match.span(), rewritten_match.groups()) == (
+                original_match.span(),
+                original_match.groups(),
+            )
+
+
+def test_group_references_are_not_rewritten(tmp_path):
+    # The guard would stop ([a-z]+)=\1 matching ab=ab inside xab=ab since it only matches from the b
+    pattern = re_compile(rb"([a-z]+)=\1")
+    assert lint_pattern(pattern)[1] is None
+    scanner = SecretScanner(concurrency_type="main")
+    scanner.secret_locators["([a-z]+)=\\1"] = SecretLocator(id="repeated", name="Repeated", pattern=pattern)
+    scanner.load_secret_locators([])
+    scanned_file = tmp_path / "scanned_file.txt"
+    scanned_file.write_bytes(b"xab=ab\n")
+    assert [result.secret for result in scanner.scan_file(scanned_file)[1]] == [b"ab=ab"]
+
+
+def test_guarded_patterns_are_still_combined():
+    _, rewritten = lint_pattern(re_compile(rb"[a-z0-9.-]+\.s3\.amazonaws\.com"))
+    assert make_combinable_fragment(re_compile(rewritten)) is not None
+    # A guard that can match a newline could fail at the start of a line in a larger buffer
+    _, rewritten = lint_pattern(re_compile(rb"\s+=", 0))
+    assert make_combinable_fragment(re_compile(rewritten)) is None
+
+
+def test_duplicates_and_subsumed():
+    patterns = [
+        rb"AKIA[0-9A-Z]{16}",
+        rb"(?:AKIA)[0-9A-Z]{16}",
+        rb"AKIA[0-9A-Z]{16}",
+        rb"[A-Z0-9]{20}",
+        rb"\bsecret_key=[a-z]{8,12}",
+        rb"key=[a-z]+",
+        rb"(api|secret)_key",
+    ]
+    secret_groups = [0, 0, 1, 0, 0, 0, 0]
+    locator_lint = LocatorLint(map(re_compile, patterns), secret_groups)
+    # Same parsed pattern and secret group
+    assert locator_lint.duplicates == [(1, 0)]
+    subsumed = set(locator_lint.subsumed)
+    # Different secret groups so not duplicates, but each matches every line the other does
+    assert {(0, 2), (2, 0), (0, 3), (2, 3), (4, 5)} <= subsumed
+    assert (3, 0) not in subsumed and (5, 4) not in subsumed and not any(6 in pair for pair in subsumed)
+    assert LocatorLint(map(re_compile, patterns), secret_groups, state=locator_lint.get_state()).get_state() == (
+        locator_lint.get_state()
+    )
+
+
+@pytest.mark.parametrize("scan_mode", ["line", "mmap"])
+def test_lint_secret_locators(tmp_path, tmp_locator_files, tmp_files_to_scan, scan_mode):
+    locator_files = [tmp_locator_files["secret_locators.json"], INCLUDED_SECRET_LOCATOR_FILES["aws"]]
+    scanners = {}
+    for lint_locators in (True, False):
+        scanner = scanners[lint_locators] = SecretScanner(
+            concurrency_type="main",
+            scan_mode=scan_mode,
+            lint_locators=lint_locators,
+            lint_report=tmp_path / "lint.json",
+        )
+        scanner.secret_locators["[a-z]+@x"] = SecretLocator(id="at-x", name="At X", pattern=re_compile(rb"[a-z]+@x"))
+        scanner.load_secret_locators(locator_files)
+    assert scanners[True].locator_lint is not None and scanners[True].locator_lint.rewrites
+    # Rewrites are kept on the scanner and locators keep their own patterns
+    assert scanners[True].secret_locators["[a-z]+@x"].pattern.pattern == rb"[a-z]+@x"
+    assert len(scanners[True].rewritten_patterns) == len(scanners[True].locator_lint.rewrites)
+    assert scanners[False].locator_lint is None
+
+    bucket_file = tmp_path / "bucket_file.java"
+    # The second match of [a-z]+@x starts right after the first so is only found by finditer without the guard
+    bucket_file.write_text(f"String url = \"{'a' * 5000}.s3.amazonaws.com\";\n{'b' * 5000}\na@xb@x\n")
+    for file_path in (*tmp_files_to_scan.values(), bucket_file):
+        assert scanners[True].scan_file(file_path) == scanners[False].scan_file(file_path)
+        assert [result.locator.id for result in scanners[True].scan_file(file_path)[1]] == [
+            result.locator.id for result in scanners[False].scan_file(file_path)[1]
+        ]
+
+    report = json_loads((tmp_path / "lint.json").read_text())
+    assert len([finding for finding in report["findings"] if finding["rewritten"]]) == len(
+        scanners[True].locator_lint.rewrites
+    )
+    assert set(report) == {"findings", "duplicates", "subsumed"}
+
+
+def test_drop_duplicate_locators(tmp_locator_files):
+    scanner = SecretScanner(concurrency_type="main", drop_duplicate_locators=True)
+    scanner.secret_locators["(?:AKIA)[0-9A-Z]{16}"] = SecretLocator(
+        id="aws-duplicate", name="AWS Duplicate", pattern=re_compile(rb"(?:AKIA)[0-9A-Z]{16}")
+    )
+    scanner.secret_locators["AKIA[0-9A-Z]{16}"] = SecretLocator(
+        id="aws", name="AWS", pattern=re_compile(rb"AKIA[0-9A-Z]{16}")
+    )
+    scanner.load_secret_locators([tmp_locator_files["secret_locators.json"]])
+    assert "AKIA[0-9A-Z]{16}" not in scanner.secret_locators
+    assert "(?:AKIA)[0-9A-Z]{16}" in scanner.secret_locators